@@ -114,6 +114,7 @@ from parsec.api.protocol.block import block_create_serializer, block_read_serial
 from parsec.api.protocol.vlob import (
     vlob_create_serializer,
     vlob_read_serializer,
+    vlob_read_batch_serializer,
     vlob_update_serializer,
     vlob_poll_changes_serializer,
     vlob_list_versions_serializer,
@@ -126,6 +127,7 @@ from parsec.api.protocol.cmds import (
     APIV1_AUTHENTICATED_CMDS,
     APIV1_ANONYMOUS_CMDS,
     APIV1_ADMINISTRATION_CMDS,
+    UNCOMPRESSED_CMDS,
 )
 
 
@@ -236,6 +238,7 @@ __all__ = (
     # Vlob
     "vlob_create_serializer",
     "vlob_read_serializer",
+    "vlob_read_batch_serializer",
     "vlob_update_serializer",
     "vlob_poll_changes_serializer",
     "vlob_list_versions_serializer",
@@ -250,4 +253,5 @@ __all__ = (
     "APIV1_AUTHENTICATED_CMDS",
     "APIV1_ANONYMOUS_CMDS",
     "APIV1_ADMINISTRATION_CMDS",
+    "UNCOMPRESSED_CMDS",
 )
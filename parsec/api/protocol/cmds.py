@@ -31,6 +31,7 @@ AUTHENTICATED_CMDS = {
     "vlob_poll_changes",
     "vlob_create",
     "vlob_read",
+    "vlob_read_batch",  # vlob_read_batch has been added in api v2.3
     "vlob_update",
     "vlob_list_versions",
     "vlob_maintenance_get_reencryption_batch",
@@ -112,3 +113,14 @@ APIV1_ADMINISTRATION_CMDS = {
     "organization_update",
     "ping",
 }
+
+# The request (or reply) of those commands mostly consists of encrypted data,
+# hence they are not worth being compressed by the transport
+UNCOMPRESSED_CMDS = {
+    "block_create",
+    "block_read",
+    "vlob_create",
+    "vlob_read",
+    "vlob_read_batch",
+    "vlob_update",
+}
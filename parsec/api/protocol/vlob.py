@@ -8,6 +8,7 @@ from parsec.api.protocol.types import DeviceIDField
 __all__ = (
     "vlob_create_serializer",
     "vlob_read_serializer",
+    "vlob_read_batch_serializer",
     "vlob_update_serializer",
     "vlob_poll_changes_serializer",
     "vlob_list_versions_serializer",
@@ -57,6 +58,39 @@ class VlobReadRepSchema(BaseRepSchema):
 vlob_read_serializer = CmdSerializer(VlobReadReqSchema, VlobReadRepSchema)
 
 
+# Read several vlobs of a realm in a single request
+class VlobReadBatchEntrySchema(BaseSchema):
+    vlob_id = fields.UUID(required=True)
+    version = fields.Integer(validate=lambda n: n is None or _validate_version(n), missing=None)
+
+
+class VlobReadBatchReqSchema(BaseReqSchema):
+    realm_id = fields.UUID(required=True)
+    encryption_revision = fields.Integer(required=True)
+    vlobs = fields.List(
+        fields.Nested(VlobReadBatchEntrySchema), required=True, validate=validate.Length(max=1000)
+    )
+
+
+class VlobReadBatchItemSchema(BaseSchema):
+    vlob_id = fields.UUID(required=True)
+    version = fields.Integer(required=True, validate=_validate_version)
+    blob = fields.Bytes(required=True)
+    author = DeviceIDField(required=True)
+    timestamp = fields.DateTime(required=True)
+
+
+class VlobReadBatchRepSchema(BaseRepSchema):
+    # Vlobs (or versions) not found in the realm are omitted
+    vlobs = fields.List(fields.Nested(VlobReadBatchItemSchema), required=True)
+    # Set if the reply has been cut to limit its size, in which case the
+    # vlobs requested after the last returned one must be requested again
+    truncated = fields.Boolean(required=True)
+
+
+vlob_read_batch_serializer = CmdSerializer(VlobReadBatchReqSchema, VlobReadBatchRepSchema)
+
+
 class VlobUpdateReqSchema(BaseReqSchema):
     encryption_revision = fields.Integer(required=True)
     vlob_id = fields.UUID(required=True)
@@ -1,7 +1,8 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import zlib
 from uuid import uuid4
-from typing import Optional, Type, Union
+from typing import Optional, Tuple, Type, Union
 import trio
 from trio import BrokenResourceError
 from trio.abc import Stream
@@ -9,7 +10,8 @@ from structlog import get_logger
 from h11 import Request as H11Request
 from wsproto import WSConnection, ConnectionType
 from wsproto.utilities import LocalProtocolError, RemoteProtocolError
-from wsproto.frame_protocol import CloseReason
+from wsproto.frame_protocol import CloseReason, FrameDecoder, FrameProtocol, Opcode, RsvBits
+from wsproto.extensions import PerMessageDeflate
 from wsproto.events import (
     Event,
     CloseConnection,
@@ -43,8 +45,69 @@ class TransportClosedByPeer(TransportError):
 # they should be only raised in case of programming error.
 
 
+class _PerMessageDeflate(PerMessageDeflate):
+    """
+    Compression can be disabled for the messages that are not worth it
+    (i.e. encrypted data), such messages are simply sent without the RSV1 bit.
+
+    The received messages are never decompressed beyond `max_inbound_bytes`,
+    otherwise a small compressed message could take up a lot of memory.
+    """
+
+    def __init__(self, max_inbound_bytes: int) -> None:
+        super().__init__()
+        self.compress_outbound = True
+        self.max_inbound_bytes = max_inbound_bytes
+        self.inbound_too_big = False
+        # Decompressed size of the message being received
+        self._inbound_bytes = 0
+
+    def frame_outbound(
+        self,
+        proto: Union[FrameDecoder, FrameProtocol],
+        opcode: Opcode,
+        rsv: RsvBits,
+        data: bytes,
+        fin: bool,
+    ) -> Tuple[RsvBits, bytes]:
+        if not self.compress_outbound:
+            return (rsv, data)
+        return super().frame_outbound(proto, opcode, rsv, data, fin)
+
+    def frame_inbound_payload_data(
+        self, proto: Union[FrameDecoder, FrameProtocol], data: bytes
+    ) -> Union[bytes, CloseReason]:
+        if not self._inbound_compressed or not self._inbound_is_compressible:
+            return data
+        assert self._decompressor is not None
+
+        # Decompress one more byte than allowed to detect the messages too big
+        max_length = self.max_inbound_bytes - self._inbound_bytes
+        try:
+            decompressed = self._decompressor.decompress(bytes(data), max_length + 1)
+        except zlib.error:
+            return CloseReason.INVALID_FRAME_PAYLOAD_DATA
+        if len(decompressed) > max_length:
+            self.inbound_too_big = True
+            return CloseReason.MESSAGE_TOO_BIG
+
+        self._inbound_bytes += len(decompressed)
+        return decompressed
+
+    def frame_inbound_complete(
+        self, proto: Union[FrameDecoder, FrameProtocol], fin: bool
+    ) -> Union[bytes, CloseReason, None]:
+        if fin:
+            self._inbound_bytes = 0
+        return super().frame_inbound_complete(proto, fin)
+
+
 class Transport:
     RECEIVE_BYTES = 2 ** 20  # 1Mo
+    # Big messages are sent as multiple frames instead of a single huge one
+    SEND_FRAGMENT_BYTES = 2 ** 16  # 64Ko
+    # Maximum size of a received message, once decompressed
+    MAX_MESSAGE_BYTES = 2 ** 24  # 16Mo
 
     def __init__(self, stream: Stream, ws: WSConnection, keepalive: Optional[int] = None):
         self.stream = stream
@@ -54,6 +117,11 @@ class Transport:
         self.logger = logger.bind(conn_id=self.conn_id)
         self._ws_events = ws.events()
         self._handshake: Optional[ServerHandshake] = None
+        # Pipelined requests and replies are sent concurrently with the
+        # receiving (that may itself send ping/pong/close frames)
+        self._send_lock = trio.Lock()
+        # Only used if negotiated during the websocket handshake
+        self._deflate = _PerMessageDeflate(max_inbound_bytes=self.MAX_MESSAGE_BYTES)
 
     # Application handshake interface
     # TODO: Investigate a better place for providing an access to the peer API version
@@ -100,6 +168,10 @@ class Transport:
             self.ws.receive_data(in_data)
 
     async def _net_send(self, wsmsg: Event) -> None:
+        async with self._send_lock:
+            await self._net_send_no_lock(wsmsg)
+
+    async def _net_send_no_lock(self, wsmsg: Event) -> None:
         try:
             await self.stream.send_all(self.ws.send(wsmsg))
 
@@ -118,7 +190,9 @@ class Transport:
 
         # Because this is a client WebSocket, we need to initiate the connection
         # handshake by sending a Request event.
-        await transport._net_send(Request(host=host, target=TRANSPORT_TARGET))
+        await transport._net_send(
+            Request(host=host, target=TRANSPORT_TARGET, extensions=[transport._deflate])
+        )
 
         # Get handshake answer
         event = await transport._next_ws_event()
@@ -150,7 +224,8 @@ class Transport:
             event = await transport._next_ws_event()
         if isinstance(event, Request):
             transport.logger.debug("Accepting WebSocket upgrade")
-            await transport._net_send(AcceptConnection())
+            # Compression is enabled only if the client supports it
+            await transport._net_send(AcceptConnection(extensions=[transport._deflate]))
             return transport
 
         transport.logger.warning("Unexpected event during WebSocket handshake", ws_event=event)
@@ -159,9 +234,10 @@ class Transport:
     async def aclose(self) -> None:
         try:
             try:
-                await self.stream.send_all(
-                    self.ws.send(CloseConnection(code=CloseReason.NORMAL_CLOSURE))
-                )
+                async with self._send_lock:
+                    await self.stream.send_all(
+                        self.ws.send(CloseConnection(code=CloseReason.NORMAL_CLOSURE))
+                    )
             except LocalProtocolError:
                 # TODO: exception occurs when ws.state is already closed...
                 pass
@@ -170,12 +246,26 @@ class Transport:
         except (BrokenResourceError, TransportError):
             pass
 
-    async def send(self, msg: bytes) -> None:
+    async def send(self, msg: bytes, compress: bool = True) -> None:
         """
         Raises:
             TransportError
         """
-        await self._net_send(BytesMessage(data=msg))
+        view = memoryview(msg)
+        # The frames of a message must not be interleaved with another message
+        async with self._send_lock:
+            # The compression setting only applies to this message
+            self._deflate.compress_outbound = compress
+            offset = 0
+            while True:
+                fragment = view[offset : offset + self.SEND_FRAGMENT_BYTES]
+                offset += len(fragment)
+                message_finished = offset >= len(view)
+                await self._net_send_no_lock(
+                    BytesMessage(data=fragment, message_finished=message_finished)
+                )
+                if message_finished:
+                    break
 
     async def recv(self) -> bytes:
         """
@@ -201,12 +291,15 @@ class Transport:
                 except LocalProtocolError:
                     # TODO: exception occurs when ws.state is already closed...
                     pass
+                # The connection has been closed on our side while decompressing
+                if self._deflate.inbound_too_big:
+                    raise TransportError("Message too big")
                 raise TransportClosedByPeer("Peer has closed connection")
 
             elif isinstance(event, BytesMessage):
-                # TODO: check that data doesn't go over MAX_BIN_LEN (1 MB)
-                # Msgpack will refuse to unpack it so we should fail early on if that happens
                 data += event.data
+                if len(data) > self.MAX_MESSAGE_BYTES:
+                    raise TransportError("Message too big")
                 if event.message_finished:
                     return data
 
@@ -14,6 +14,7 @@ from parsec._version import __version__ as parsec_version
 from parsec.backend.backend_events import BackendEvent
 from parsec.event_bus import EventBus
 from parsec.logging import get_log_level
+from parsec.utils import open_service_nursery
 from parsec.api.transport import TransportError, TransportClosedByPeer, Transport, TRANSPORT_TARGET
 from parsec.api.protocol import (
     packb,
@@ -21,6 +22,7 @@ from parsec.api.protocol import (
     ProtocolError,
     MessageSerializationError,
     InvalidMessageError,
+    UNCOMPRESSED_CMDS,
     InvitationStatus,
 )
 from parsec.backend.utils import CancelledByNewRequest, collect_apis
@@ -49,6 +51,11 @@ def _filter_binary_fields(data):
     return {k: v if not isinstance(v, bytes) else b"[...]" for k, v in data.items()}
 
 
+def _is_compressible(req):
+    cmd = req.get("cmd")
+    return not isinstance(cmd, str) or cmd not in UNCOMPRESSED_CMDS
+
+
 @asynccontextmanager
 async def backend_app_factory(config: BackendConfig, event_bus: Optional[EventBus] = None):
     event_bus = event_bus or EventBus()
@@ -369,42 +376,78 @@ class BackendApp:
             # while processing a command
             raw_req = raw_req or await transport.recv()
             req = unpackb(raw_req)
-            if get_log_level() <= LOG_LEVEL_DEBUG:
-                client_ctx.logger.debug("Request", req=_filter_binary_fields(req))
-            try:
-                cmd = req.get("cmd", "<missing>")
-                if not isinstance(cmd, str):
-                    raise KeyError()
 
-                cmd_func = api_cmds[cmd]
+            # Requests carrying an id are pipelined (introduced in API v2.4)
+            if "req_id" in req:
+                await self._handle_client_websocket_pipelined_loop(
+                    transport, client_ctx, api_cmds, req
+                )
+                return
 
-            except KeyError:
-                rep = {"status": "unknown_command", "reason": "Unknown command"}
+            compress = _is_compressible(req)
+            try:
+                rep = await self._process_request(client_ctx, api_cmds, req)
 
-            else:
-                try:
-                    rep = await cmd_func(client_ctx, req)
-
-                except InvalidMessageError as exc:
-                    rep = {
-                        "status": "bad_message",
-                        "errors": exc.errors,
-                        "reason": "Invalid message.",
-                    }
-
-                except ProtocolError as exc:
-                    rep = {"status": "bad_message", "reason": str(exc)}
-
-                except CancelledByNewRequest as exc:
-                    # Long command handling such as message_get can be cancelled
-                    # when the peer send a new request
-                    raw_req = exc.new_raw_req
-                    continue
+            except CancelledByNewRequest as exc:
+                # Long command handling such as message_get can be cancelled
+                # when the peer send a new request
+                raw_req = exc.new_raw_req
+                continue
 
-            if get_log_level() <= LOG_LEVEL_DEBUG:
-                client_ctx.logger.debug("Response", rep=_filter_binary_fields(rep))
-            else:
-                client_ctx.logger.info("Request", cmd=cmd, status=rep["status"])
             raw_rep = packb(rep)
-            await transport.send(raw_rep)
+            await transport.send(raw_rep, compress=compress)
             raw_req = None
+
+    async def _handle_client_websocket_pipelined_loop(self, transport, client_ctx, api_cmds, req):
+        # The client doesn't wait for the reply before sending its next request,
+        # so the requests are processed concurrently and each reply carries the
+        # id of its request (hence the replies can be sent in any order)
+        client_ctx.pipelined = True
+        requests_limiter = trio.Semaphore(self.config.pipelined_requests_max_concurrency)
+
+        async def _process_pipelined_request(req_id, req):
+            try:
+                compress = _is_compressible(req)
+                rep = await self._process_request(client_ctx, api_cmds, req)
+                await transport.send(packb({**rep, "req_id": req_id}), compress=compress)
+            finally:
+                requests_limiter.release()
+
+        async with open_service_nursery() as nursery:
+            while True:
+                req_id = req.pop("req_id", None)
+                if not isinstance(req_id, int):
+                    raise MessageSerializationError("Invalid request id")
+                # Stop receiving requests until a slot is available
+                await requests_limiter.acquire()
+                nursery.start_soon(_process_pipelined_request, req_id, req)
+                req = unpackb(await transport.recv())
+
+    async def _process_request(self, client_ctx, api_cmds, req):
+        if get_log_level() <= LOG_LEVEL_DEBUG:
+            client_ctx.logger.debug("Request", req=_filter_binary_fields(req))
+        try:
+            cmd = req.get("cmd", "<missing>")
+            if not isinstance(cmd, str):
+                raise KeyError()
+
+            cmd_func = api_cmds[cmd]
+
+        except KeyError:
+            rep = {"status": "unknown_command", "reason": "Unknown command"}
+
+        else:
+            try:
+                rep = await cmd_func(client_ctx, req)
+
+            except InvalidMessageError as exc:
+                rep = {"status": "bad_message", "errors": exc.errors, "reason": "Invalid message."}
+
+            except ProtocolError as exc:
+                rep = {"status": "bad_message", "reason": str(exc)}
+
+        if get_log_level() <= LOG_LEVEL_DEBUG:
+            client_ctx.logger.debug("Response", rep=_filter_binary_fields(rep))
+        else:
+            client_ctx.logger.info("Request", cmd=cmd, status=rep["status"])
+        return rep
@@ -25,11 +25,13 @@ from parsec.backend.invite import Invitation
 
 
 class BaseClientContext:
-    __slots__ = ("transport", "handshake")
+    __slots__ = ("transport", "handshake", "pipelined")
 
     def __init__(self, transport: Transport, handshake: ServerHandshake):
         self.transport = transport
         self.handshake = handshake
+        # Set once the client has switched to pipelined requests
+        self.pipelined = False
 
     @property
     def api_version(self) -> ApiVersion:
@@ -109,6 +109,9 @@ class BackendConfig:
 
     debug: bool
 
+    # Maximum number of pipelined requests processed at the same time for a single connection
+    pipelined_requests_max_concurrency: int = 16
+
     @property
     def db_type(self):
         if self.db_url.upper() == "MOCKED":
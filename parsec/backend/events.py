@@ -137,7 +137,7 @@ class EventsComponent:
 
         if msg["wait"]:
             event_data = await run_with_breathing_transport(
-                client_ctx.transport, client_ctx.receive_events_channel.receive
+                client_ctx, client_ctx.receive_events_channel.receive
             )
 
             if not event_data:
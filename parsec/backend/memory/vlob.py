@@ -292,6 +292,31 @@ class MemoryVlobComponent(BaseVlobComponent):
         except IndexError:
             raise VlobVersionError()
 
+    async def read_batch(
+        self,
+        organization_id: OrganizationID,
+        author: DeviceID,
+        realm_id: UUID,
+        encryption_revision: int,
+        vlobs: List[Tuple[UUID, Optional[int]]],
+    ) -> List[Tuple[UUID, int, bytes, DeviceID, pendulum.DateTime]]:
+        self._check_realm_read_access(
+            organization_id, realm_id, author.user_id, encryption_revision
+        )
+
+        result = []
+        for vlob_id, version in vlobs:
+            vlob = self._vlobs.get((organization_id, vlob_id))
+            if vlob is None or vlob.realm_id != realm_id:
+                continue
+            if version is None:
+                version = vlob.current_version
+            elif version > vlob.current_version:
+                continue
+            vlob_data, vlob_device_id, vlob_timestamp = vlob.data[version - 1]
+            result.append((vlob_id, version, vlob_data, vlob_device_id, vlob_timestamp))
+        return result
+
     async def update(
         self,
         organization_id: OrganizationID,
@@ -12,6 +12,7 @@ from parsec.backend.postgresql.vlob_queries import (
     query_maintenance_save_reencryption_batch,
     query_maintenance_get_reencryption_batch,
     query_read,
+    query_read_batch,
     query_poll_changes,
     query_list_versions,
     query_create,
@@ -59,6 +60,19 @@ class PGVlobComponent(BaseVlobComponent):
                 conn, organization_id, author, encryption_revision, vlob_id, version, timestamp
             )
 
+    async def read_batch(
+        self,
+        organization_id: OrganizationID,
+        author: DeviceID,
+        realm_id: UUID,
+        encryption_revision: int,
+        vlobs: List[Tuple[UUID, Optional[int]]],
+    ) -> List[Tuple[UUID, int, bytes, DeviceID, pendulum.DateTime]]:
+        async with self.dbh.pool.acquire() as conn:
+            return await query_read_batch(
+                conn, organization_id, author, realm_id, encryption_revision, vlobs
+            )
+
     @retry_on_unique_violation
     async def update(
         self,
@@ -2,7 +2,7 @@
 
 import pendulum
 from uuid import UUID
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 
 from parsec.api.protocol import DeviceID, OrganizationID
 from parsec.backend.vlob import VlobVersionError, VlobNotFoundError
@@ -143,6 +143,59 @@ async def query_read(
     return version, blob, author, created_on
 
 
+_q_read_batch = Q(
+    f"""
+SELECT DISTINCT ON(requested.position)
+    vlob_atom.vlob_id,
+    vlob_atom.version,
+    blob,
+    { q_device(_id="author", select="device_id") } as author,
+    created_on
+FROM vlob_atom
+INNER JOIN unnest($vlob_ids::UUID[], $versions::INTEGER[])
+    WITH ORDINALITY AS requested(vlob_id, version, position)
+ON vlob_atom.vlob_id = requested.vlob_id
+WHERE
+    vlob_encryption_revision = {
+        q_vlob_encryption_revision_internal_id(
+            organization_id="$organization_id",
+            realm_id="$realm_id",
+            encryption_revision="$encryption_revision",
+        )
+    }
+    AND (requested.version IS NULL OR vlob_atom.version = requested.version)
+ORDER BY requested.position, vlob_atom.version DESC
+"""
+)
+
+
+@query(in_transaction=True)
+async def query_read_batch(
+    conn,
+    organization_id: OrganizationID,
+    author: DeviceID,
+    realm_id: UUID,
+    encryption_revision: int,
+    vlobs: List[Tuple[UUID, Optional[int]]],
+) -> List[Tuple[UUID, int, bytes, DeviceID, pendulum.DateTime]]:
+    await _check_realm_and_read_access(conn, organization_id, author, realm_id, encryption_revision)
+
+    rows = await conn.fetch(
+        *_q_read_batch(
+            organization_id=organization_id,
+            realm_id=realm_id,
+            encryption_revision=encryption_revision,
+            vlob_ids=[vlob_id for vlob_id, _ in vlobs],
+            versions=[version for _, version in vlobs],
+        )
+    )
+
+    return [
+        (row["vlob_id"], row["version"], row["blob"], row["author"], row["created_on"])
+        for row in rows
+    ]
+
+
 _q_poll_changes = Q(
     f"""
 SELECT
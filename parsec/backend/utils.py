@@ -38,7 +38,7 @@ def api(
             @wraps(fn)
             async def wrapped(self, client_ctx, *args, **kwargs):
                 return await run_with_breathing_transport(
-                    client_ctx.transport, fn, self, client_ctx, *args, **kwargs
+                    client_ctx, fn, self, client_ctx, *args, **kwargs
                 )
 
         else:
@@ -97,7 +97,7 @@ class CancelledByNewRequest(Exception):
         self.new_raw_req = new_raw_req
 
 
-async def run_with_breathing_transport(transport, fn, *args, **kwargs):
+async def run_with_breathing_transport(client_ctx, fn, *args, **kwargs):
     """
     This is kind of a special case here:
     unlike other requests this one is going to (potentially) take
@@ -106,13 +106,18 @@ async def run_with_breathing_transport(transport, fn, *args, **kwargs):
     online and handles websocket pings
     """
 
+    # With pipelined requests, the connection is already monitored
+    # by the loop receiving the requests
+    if client_ctx.pipelined:
+        return await fn(*args, **kwargs)
+
     rep = None
 
     async def _keep_transport_breathing():
         # If a command is received, the client is violating the
         # request/reply pattern. We consider this as an order to stop
         # listening events.
-        raw_req = await transport.recv()
+        raw_req = await client_ctx.transport.recv()
         raise CancelledByNewRequest(raw_req)
 
     async def _do_fn(cancel_scope):
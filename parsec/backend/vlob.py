@@ -8,8 +8,10 @@ from parsec.utils import timestamps_in_the_ballpark
 from parsec.api.protocol import (
     DeviceID,
     OrganizationID,
+    HandshakeType,
     vlob_create_serializer,
     vlob_read_serializer,
+    vlob_read_batch_serializer,
     vlob_update_serializer,
     vlob_poll_changes_serializer,
     vlob_list_versions_serializer,
@@ -19,6 +21,11 @@ from parsec.api.protocol import (
 from parsec.backend.utils import catch_protocol_errors, api
 
 
+# Maximum size of the blobs returned by a single `vlob_read_batch` request, which
+# keeps the reply well below the size limit of the transport messages
+VLOB_READ_BATCH_MAX_BYTES = 2 ** 22  # 4Mo
+
+
 class VlobError(Exception):
     pass
 
@@ -124,6 +131,61 @@ class BaseVlobComponent:
             }
         )
 
+    @api("vlob_read_batch", handshake_types=[HandshakeType.AUTHENTICATED])
+    @catch_protocol_errors
+    async def api_vlob_read_batch(self, client_ctx, msg):
+        msg = vlob_read_batch_serializer.req_load(msg)
+
+        try:
+            vlobs = await self.read_batch(
+                client_ctx.organization_id,
+                client_ctx.device_id,
+                realm_id=msg["realm_id"],
+                encryption_revision=msg["encryption_revision"],
+                vlobs=[(x["vlob_id"], x["version"]) for x in msg["vlobs"]],
+            )
+
+        except VlobNotFoundError as exc:
+            return vlob_read_batch_serializer.rep_dump({"status": "not_found", "reason": str(exc)})
+
+        except VlobAccessError:
+            return vlob_read_batch_serializer.rep_dump({"status": "not_allowed"})
+
+        except VlobEncryptionRevisionError:
+            return vlob_read_batch_serializer.rep_dump({"status": "bad_encryption_revision"})
+
+        except VlobInMaintenanceError:
+            return vlob_read_batch_serializer.rep_dump({"status": "in_maintenance"})
+
+        # The vlobs are returned in the requested order, so the reply can be truncated
+        # and the client asks again for the vlobs following the last one returned
+        truncated = False
+        total_size = 0
+        for count, (_, _, blob, _, _) in enumerate(vlobs):
+            total_size += len(blob)
+            # At least one vlob is returned, no matter its size
+            if count and total_size > VLOB_READ_BATCH_MAX_BYTES:
+                vlobs = vlobs[:count]
+                truncated = True
+                break
+
+        return vlob_read_batch_serializer.rep_dump(
+            {
+                "status": "ok",
+                "truncated": truncated,
+                "vlobs": [
+                    {
+                        "vlob_id": vlob_id,
+                        "version": version,
+                        "blob": blob,
+                        "author": author,
+                        "timestamp": created_on,
+                    }
+                    for vlob_id, version, blob, author, created_on in vlobs
+                ],
+            }
+        )
+
     @api("vlob_update")
     @catch_protocol_errors
     async def api_vlob_update(self, client_ctx, msg):
@@ -329,6 +391,28 @@ class BaseVlobComponent:
         """
         raise NotImplementedError()
 
+    async def read_batch(
+        self,
+        organization_id: OrganizationID,
+        author: DeviceID,
+        realm_id: UUID,
+        encryption_revision: int,
+        vlobs: List[Tuple[UUID, Optional[int]]],
+    ) -> List[Tuple[UUID, int, bytes, DeviceID, pendulum.DateTime]]:
+        """
+        Read several vlobs of a realm at once, the vlobs provided without version
+        being read at their last version. The result follows the order of the
+        requested vlobs, those (or the versions) that cannot be found in the realm
+        being omitted.
+
+        Raises:
+            VlobAccessError
+            VlobNotFoundError: if the realm doesn't exist
+            VlobEncryptionRevisionError: if encryption_revision mismatch
+            VlobInMaintenanceError
+        """
+        raise NotImplementedError()
+
     async def update(
         self,
         organization_id: OrganizationID,
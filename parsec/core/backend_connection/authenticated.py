@@ -13,7 +13,12 @@ from parsec.api.data import EntryID
 from parsec.api.protocol import DeviceID, APIEvent, AUTHENTICATED_CMDS
 from parsec.core.types import BackendOrganizationAddr, OrganizationConfig
 from parsec.core.backend_connection import cmds
-from parsec.core.backend_connection.transport import connect_as_authenticated, TransportPool
+from parsec.core.backend_connection.transport import (
+    connect_as_authenticated,
+    TransportPool,
+    TransportPoolStatistics,
+    PipelinedTransport,
+)
 from parsec.core.backend_connection.exceptions import BackendNotAvailable, BackendConnectionRefused
 from parsec.core.backend_connection.expose_cmds import expose_cmds_with_retrier
 from parsec.core.core_events import CoreEvent
@@ -36,9 +41,11 @@ def copy_exception(exception: BaseExceptionTypeVar) -> BaseExceptionTypeVar:
 
 
 class BackendAuthenticatedCmds:
-    def __init__(self, addr: BackendOrganizationAddr, acquire_transport):
+    def __init__(self, addr: BackendOrganizationAddr, acquire_transport, max_concurrency: int = 1):
         self.addr = addr
         self.acquire_transport = acquire_transport
+        # Number of commands that can be sent concurrently without waiting for a transport
+        self.max_concurrency = max_concurrency
 
     events_subscribe = expose_cmds_with_retrier(cmds.events_subscribe)
     events_listen = expose_cmds_with_retrier(cmds.events_listen)
@@ -67,6 +74,7 @@ class BackendAuthenticatedCmds:
     vlob_poll_changes = expose_cmds_with_retrier(cmds.vlob_poll_changes)
     vlob_create = expose_cmds_with_retrier(cmds.vlob_create)
     vlob_read = expose_cmds_with_retrier(cmds.vlob_read)
+    vlob_read_batch = expose_cmds_with_retrier(cmds.vlob_read_batch)
     vlob_update = expose_cmds_with_retrier(cmds.vlob_update)
     vlob_list_versions = expose_cmds_with_retrier(cmds.vlob_list_versions)
     vlob_maintenance_get_reencryption_batch = expose_cmds_with_retrier(
@@ -134,7 +142,7 @@ def _handle_event(event_bus: EventBus, rep: dict) -> None:
         )
 
 
-def _transport_pool_factory(addr, device_id, signing_key, max_pool, keepalive):
+def _connect_factory(addr, device_id, signing_key, keepalive):
     async def _connect():
         transport = await connect_as_authenticated(
             addr, device_id=device_id, signing_key=signing_key, keepalive=keepalive
@@ -142,7 +150,7 @@ def _transport_pool_factory(addr, device_id, signing_key, max_pool, keepalive):
         transport.logger = transport.logger.bind(device_id=device_id)
         return transport
 
-    return TransportPool(_connect, max_pool=max_pool)
+    return _connect
 
 
 class BackendAuthenticatedConn:
@@ -155,18 +163,31 @@ class BackendAuthenticatedConn:
         max_cooldown: int = 30,
         max_pool: int = 4,
         keepalive: Optional[int] = None,
+        max_pipelined_requests: int = 0,
+        idle_timeout: Optional[float] = None,
     ):
         if max_pool < 2:
             raise ValueError("max_pool must be at least 2 (for event listener + query sender)")
 
         self._started = False
-        self._transport_pool = _transport_pool_factory(
-            addr, device_id, signing_key, max_pool, keepalive
+        self._connect = _connect_factory(addr, device_id, signing_key, keepalive)
+        self._transport_pool = TransportPool(
+            self._connect, max_pool=max_pool, idle_timeout=idle_timeout
         )
+        self._idle_timeout = idle_timeout
+        # If enabled, the commands share a single connection instead of
+        # using the pool (which is still used by the event listener)
+        self._max_pipelined_requests = max_pipelined_requests
+        self._pipelined_transport: Optional[PipelinedTransport] = None
+        self._pipelined_transport_lock = trio.Lock()
+        self._nursery: Optional[trio.Nursery] = None
         self._status = BackendConnStatus.LOST
         self._status_exc = None
         self._status_event_sent = False
-        self._cmds = BackendAuthenticatedCmds(addr, self._acquire_transport)
+        # One transport is kept busy by the event listener
+        self._cmds = BackendAuthenticatedCmds(
+            addr, self._acquire_transport, max_concurrency=max_pipelined_requests or max_pool - 1
+        )
         self._manager_connect_cancel_scope = None
         self._monitors_cbs: List[Callable[..., None]] = []
         self._monitors_idle_event = trio.Event()
@@ -197,6 +218,9 @@ class BackendAuthenticatedConn:
     def cmds(self) -> BackendAuthenticatedCmds:
         return self._cmds
 
+    def get_transport_pool_statistics(self) -> TransportPoolStatistics:
+        return self._transport_pool.statistics()
+
     def set_status(self, status: BackendConnStatus, status_exc: Optional[Exception] = None) -> None:
         old_status, self._status = self._status, status
         self._status_exc = status_exc
@@ -229,10 +253,31 @@ class BackendAuthenticatedConn:
     async def run(self):
         if self._started:
             raise RuntimeError("Already started")
-        async with trio.open_service_nursery() as nursery:
-            nursery.start_soon(self._run_manager)
+        async with trio.open_service_nursery() as self._nursery:
+            self._nursery.start_soon(self._run_manager)
+            if self._idle_timeout is not None:
+                self._nursery.start_soon(self._run_idle_transports_closer)
             yield
-            nursery.cancel_scope.cancel()
+            self._nursery.cancel_scope.cancel()
+
+    async def _run_idle_transports_closer(self):
+        next_check = trio.current_time() + self._idle_timeout
+        while True:
+            await trio.sleep_until(next_check)
+            # Check again as soon as the next pooled transport gets idle for too long
+            next_check = await self._transport_pool.close_idle_transports()
+            # Otherwise the transports released from now on cannot be idle
+            # for too long before the next check
+            if next_check is None:
+                next_check = trio.current_time() + self._idle_timeout
+            statistics = self._transport_pool.statistics()
+            logger.debug(
+                "Transport pool statistics",
+                connections=statistics.connections,
+                utilisation=statistics.utilisation,
+                mean_wait_time=statistics.mean_wait_time,
+                max_wait_time=statistics.max_wait_time,
+            )
 
     async def _run_manager(self):
         while True:
@@ -353,8 +398,15 @@ class BackendAuthenticatedConn:
                 raise copy_exception(self.status_exc)
 
         try:
-            async with self._transport_pool.acquire(force_fresh=force_fresh) as transport:
-                yield transport
+            pipelined_transport = None
+            if self._max_pipelined_requests and not force_fresh:
+                pipelined_transport = await self._get_pipelined_transport()
+
+            if pipelined_transport:
+                yield pipelined_transport
+            else:
+                async with self._transport_pool.acquire(force_fresh=force_fresh) as transport:
+                    yield transport
 
         except BackendNotAvailable as exc:
             if not allow_not_available:
@@ -367,6 +419,34 @@ class BackendAuthenticatedConn:
             self._cancel_manager_connect()
             raise
 
+    async def _get_pipelined_transport(self) -> Optional[PipelinedTransport]:
+        async with self._pipelined_transport_lock:
+            # A closed transport gets replaced by a fresh one
+            if self._pipelined_transport and not self._pipelined_transport.closed:
+                return self._pipelined_transport
+            self._pipelined_transport = None
+
+            transport = await self._connect()
+            # Pipelined requests have been introduced in API v2.4
+            if transport.handshake.backend_api_version < (2, 4):
+                logger.info("Backend doesn't support pipelined requests")
+                self._max_pipelined_requests = 0
+                await transport.aclose()
+                return None
+
+            self._pipelined_transport = PipelinedTransport(
+                transport, max_requests=self._max_pipelined_requests
+            )
+            self._nursery.start_soon(self._run_pipelined_transport, self._pipelined_transport)
+            return self._pipelined_transport
+
+    async def _run_pipelined_transport(self, pipelined_transport: PipelinedTransport) -> None:
+        try:
+            await pipelined_transport.run_receiver()
+        finally:
+            with trio.CancelScope(shield=True):
+                await pipelined_transport.aclose()
+
 
 @asynccontextmanager
 async def backend_authenticated_cmds_factory(
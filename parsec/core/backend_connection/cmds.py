@@ -1,6 +1,6 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Optional, Union
 from uuid import UUID
 import pendulum
 from pendulum import DateTime
@@ -8,6 +8,7 @@ from pendulum import DateTime
 from parsec.crypto import VerifyKey, PublicKey
 from parsec.api.transport import Transport, TransportError
 from parsec.api.protocol import (
+    UNCOMPRESSED_CMDS,
     OrganizationID,
     UserID,
     DeviceName,
@@ -43,6 +44,7 @@ from parsec.api.protocol import (
     events_listen_serializer,
     message_get_serializer,
     vlob_read_serializer,
+    vlob_read_batch_serializer,
     vlob_create_serializer,
     vlob_update_serializer,
     vlob_poll_changes_serializer,
@@ -76,9 +78,10 @@ from parsec.api.protocol import (
 )
 from parsec.core.types import EntryID
 from parsec.core.backend_connection.exceptions import BackendNotAvailable, BackendProtocolError
+from parsec.core.backend_connection.transport import PipelinedTransport
 
 
-async def _send_cmd(transport: Transport, serializer, **req) -> dict:
+async def _send_cmd(transport: Union[Transport, PipelinedTransport], serializer, **req) -> dict:
     """
     Raises:
         Backend
@@ -91,24 +94,35 @@ async def _send_cmd(transport: Transport, serializer, **req) -> dict:
         BackendCmdsBadResponse
     """
     transport.logger.info("Request", cmd=req["cmd"])
+    # The pipelined transport takes care of the packing, given it adds the request id
+    pipelined = isinstance(transport, PipelinedTransport)
 
     try:
-        raw_req = serializer.req_dumps(req)
+        if pipelined:
+            data_req = serializer.req_dump(req)
+        else:
+            raw_req = serializer.req_dumps(req)
 
     except ProtocolError as exc:
         transport.logger.exception("Invalid request data", cmd=req["cmd"], error=exc)
         raise BackendProtocolError("Invalid request data") from exc
 
     try:
-        await transport.send(raw_req)
-        raw_rep = await transport.recv()
+        if pipelined:
+            data_rep = await transport.request(data_req)
+        else:
+            await transport.send(raw_req, compress=req["cmd"] not in UNCOMPRESSED_CMDS)
+            raw_rep = await transport.recv()
 
     except TransportError as exc:
         transport.logger.debug("Request failed (backend not available)", cmd=req["cmd"])
         raise BackendNotAvailable(exc) from exc
 
     try:
-        rep = serializer.rep_loads(raw_rep)
+        if pipelined:
+            rep = serializer.rep_load(data_rep)
+        else:
+            rep = serializer.rep_loads(raw_rep)
 
     except ProtocolError as exc:
         transport.logger.exception("Invalid response data", cmd=req["cmd"], error=exc)
@@ -197,6 +211,22 @@ async def vlob_read(
     )
 
 
+async def vlob_read_batch(
+    transport: Transport,
+    realm_id: UUID,
+    encryption_revision: int,
+    vlobs: List[Tuple[UUID, Optional[int]]],
+) -> dict:
+    return await _send_cmd(
+        transport,
+        vlob_read_batch_serializer,
+        cmd="vlob_read_batch",
+        realm_id=realm_id,
+        encryption_revision=encryption_revision,
+        vlobs=[{"vlob_id": x[0], "version": x[1]} for x in vlobs],
+    )
+
+
 async def vlob_update(
     transport: Transport,
     encryption_revision: int,
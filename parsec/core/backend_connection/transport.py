@@ -3,16 +3,21 @@
 import os
 import trio
 import ssl
+import attr
+import itertools
 from async_generator import asynccontextmanager
 from structlog import get_logger
-from typing import Optional, Union
+from typing import Optional, Union, Dict, List
 
 from parsec.crypto import SigningKey
 from parsec.api.transport import Transport, TransportError, TransportClosedByPeer
 from parsec.api.protocol import (
     DeviceID,
+    packb,
+    unpackb,
     ProtocolError,
     HandshakeError,
+    UNCOMPRESSED_CMDS,
     BaseClientHandshake,
     AuthenticatedClientHandshake,
     InvitedClientHandshake,
@@ -180,12 +185,185 @@ async def _do_handshake(transport: Transport, handshake):
         raise BackendProtocolError(exc) from exc
 
 
+# Maximum time (in seconds) to send a pipelined request: the send cannot be
+# cancelled midway, so the transport is closed if it takes longer than that
+PIPELINED_SEND_TIMEOUT = 30
+
+
+class PipelinedTransport:
+    """Send concurrent requests over a single transport.
+
+    Each request carries an id, that the backend copies into the corresponding
+    reply: this way the requests don't have to wait for the previous replies
+    and the replies can be received in any order. The replies are received by
+    a background task that hands them over to the waiting requests.
+    """
+
+    def __init__(self, transport: Transport, max_requests: int):
+        self.transport = transport
+        self.logger = transport.logger
+        self._req_ids = itertools.count()
+        self._requests_limiter = trio.Semaphore(max_requests)
+        self._waiters: Dict[int, trio.Event] = {}
+        self._replies: Dict[int, dict] = {}
+        self._receive_cancel_scope = trio.CancelScope()
+        self._closed_exc: Optional[Exception] = None
+        # A connection stuck in the middle of a request cannot be closed gracefully
+        self._stuck = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed_exc is not None
+
+    async def run_receiver(self) -> None:
+        with self._receive_cancel_scope:
+            try:
+                while True:
+                    rep = unpackb(await self.transport.recv())
+                    req_id = rep.pop("req_id", None)
+                    # The request might have been cancelled in the meantime
+                    if req_id in self._waiters:
+                        self._replies[req_id] = rep
+                        self._waiters[req_id].set()
+
+            except (TransportError, ProtocolError) as exc:
+                self._close(exc)
+
+    def _close(self, exc: Exception) -> None:
+        if self._closed_exc is None:
+            self._closed_exc = exc
+        self._receive_cancel_scope.cancel()
+        # Wake up the pending requests, they won't get any reply
+        for waiter in self._waiters.values():
+            waiter.set()
+
+    async def aclose(self) -> None:
+        self._close(TransportError("Transport has been closed"))
+        if self._stuck:
+            await trio.aclose_forcefully(self.transport.stream)
+        else:
+            await self.transport.aclose()
+
+    async def request(self, req: dict) -> dict:
+        """
+        Raises:
+            TransportError
+        """
+        async with self._requests_limiter:
+            if self._closed_exc is not None:
+                raise TransportError(*self._closed_exc.args) from self._closed_exc
+
+            req_id = next(self._req_ids)
+            raw_req = packb({**req, "req_id": req_id})
+            self._waiters[req_id] = waiter = trio.Event()
+            try:
+                # A partially sent request would corrupt the connection
+                with trio.CancelScope(shield=True):
+                    with trio.move_on_after(PIPELINED_SEND_TIMEOUT) as send_scope:
+                        try:
+                            await self.transport.send(
+                                raw_req, compress=req["cmd"] not in UNCOMPRESSED_CMDS
+                            )
+                        except TransportError as exc:
+                            self._close(exc)
+                            raise
+
+                    if send_scope.cancelled_caught:
+                        self._stuck = True
+                        exc = TransportError("Timeout while sending the request")
+                        self._close(exc)
+                        await trio.aclose_forcefully(self.transport.stream)
+                        raise exc
+
+                await waiter.wait()
+                try:
+                    return self._replies.pop(req_id)
+                except KeyError:
+                    raise TransportError(*self._closed_exc.args) from self._closed_exc
+
+            finally:
+                del self._waiters[req_id]
+                self._replies.pop(req_id, None)
+
+
+# Weight of the last request duration in the moving average of a transport latency
+LATENCY_SMOOTHING_FACTOR = 0.2
+
+
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class TransportPoolStatistics:
+    max_pool: int
+    connections: int
+    busy_connections: int
+    acquired_count: int
+    total_wait_time: float
+    max_wait_time: float
+
+    @property
+    def mean_wait_time(self) -> float:
+        return self.total_wait_time / self.acquired_count if self.acquired_count else 0.0
+
+    @property
+    def utilisation(self) -> float:
+        return self.busy_connections / self.max_pool
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _PooledTransport:
+    transport: Transport
+    # Moving average of the durations of the requests done with this transport
+    latency: float = 0.0
+    released_on: float = 0.0
+
+
 class TransportPool:
-    def __init__(self, connect_cb, max_pool):
+    """
+    Connections are opened on demand (up to `max_pool`) and the ones that
+    have been idle for more than `idle_timeout` are closed by `close_idle_transports`.
+    """
+
+    def __init__(self, connect_cb, max_pool, idle_timeout: Optional[float] = None):
         self._connect_cb = connect_cb
-        self._transports = []
+        self._transports: List[_PooledTransport] = []
         self._closed = False
         self._lock = trio.Semaphore(max_pool)
+        self._max_pool = max_pool
+        self._idle_timeout = idle_timeout
+        self._busy_count = 0
+        self._acquired_count = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def statistics(self) -> TransportPoolStatistics:
+        return TransportPoolStatistics(
+            max_pool=self._max_pool,
+            connections=len(self._transports) + self._busy_count,
+            busy_connections=self._busy_count,
+            acquired_count=self._acquired_count,
+            total_wait_time=self._total_wait_time,
+            max_wait_time=self._max_wait_time,
+        )
+
+    async def close_idle_transports(self) -> Optional[float]:
+        """Close the transports idle for too long.
+
+        Returns the time at which the next pooled transport is going to be idle
+        for too long, or None if there is no pooled transport left.
+        """
+        if self._idle_timeout is None:
+            return None
+        now = trio.current_time()
+        idle_transports = [
+            pooled for pooled in self._transports if now - pooled.released_on >= self._idle_timeout
+        ]
+        for pooled in idle_transports:
+            self._transports.remove(pooled)
+        for pooled in idle_transports:
+            pooled.transport.logger.debug("Closing idle transport")
+            await pooled.transport.aclose()
+        if not self._transports:
+            return None
+        return min(pooled.released_on for pooled in self._transports) + self._idle_timeout
 
     @asynccontextmanager
     async def acquire(self, force_fresh=False):
@@ -194,30 +372,47 @@ class TransportPool:
             BackendConnectionError
             trio.ClosedResourceError: if used after having being closed
         """
+        wait_started_on = trio.current_time()
         async with self._lock:
-            transport = None
-            if not force_fresh:
-                try:
-                    # Fifo style to retrieve oldest first
-                    transport = self._transports.pop(0)
-                except IndexError:
-                    pass
-
-            if not transport:
+            wait_time = trio.current_time() - wait_started_on
+            self._acquired_count += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+
+            pooled = None
+            if not force_fresh and self._transports:
+                # Pick the transport that has been the fastest so far, oldest first
+                # in case of equality
+                pooled = min(self._transports, key=lambda pooled: pooled.latency)
+                self._transports.remove(pooled)
+
+            if not pooled:
                 if self._closed:
                     raise trio.ClosedResourceError()
 
-                transport = await self._connect_cb()
+                pooled = _PooledTransport(await self._connect_cb())
 
+            self._busy_count += 1
+            acquired_on = trio.current_time()
             try:
-                yield transport
+                yield pooled.transport
 
             except TransportClosedByPeer:
                 raise
 
             except Exception:
-                await transport.aclose()
+                await pooled.transport.aclose()
                 raise
 
             else:
-                self._transports.append(transport)
+                pooled.released_on = trio.current_time()
+                # A fresh transport is used for long requests (i.e. `events_listen`)
+                # that would skew its latency
+                if not force_fresh:
+                    pooled.latency += LATENCY_SMOOTHING_FACTOR * (
+                        pooled.released_on - acquired_on - pooled.latency
+                    )
+                self._transports.append(pooled)
+
+            finally:
+                self._busy_count -= 1
@@ -11,6 +11,10 @@ import binascii
 import base64
 from parsec.api.data import EntryID
 from parsec.core.types import BackendAddr
+from parsec.core.fs.storage.manifest_storage import DEFAULT_MANIFEST_CACHE_SIZE
+from parsec.core.fs.storage.workspace_storage import DEFAULT_CHUNK_MEMORY_CACHE_SIZE
+from parsec.core.fs.workspacefs.read_ahead import DEFAULT_READ_AHEAD_WINDOW
+from parsec.core.fs.workspacefs.write_buffer import DEFAULT_WRITE_BUFFER_SIZE
 
 
 logger = get_logger()
@@ -62,12 +66,39 @@ class CoreConfig:
 
     backend_max_cooldown: int = 30
     backend_connection_keepalive: Optional[int] = 29
+    # Connections are opened on demand, up to `backend_max_connections`, and
+    # closed once they have been idle for `backend_connection_idle_timeout`
     backend_max_connections: int = 4
+    backend_connection_idle_timeout: Optional[float] = 60
+    # Send the commands concurrently over a single connection (0 to disable)
+    backend_max_pipelined_requests: int = 0
 
     invitation_token_size: int = 8
 
+    workspace_storage_memory_cache_size: int = DEFAULT_CHUNK_MEMORY_CACHE_SIZE
+    # Store the cached blocks as files on disk instead of inside the cache database
+    workspace_storage_block_files: bool = False
+    workspace_storage_manifest_cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE
+    # 0 disables the read-ahead
+    workspace_read_ahead_window: int = DEFAULT_READ_AHEAD_WINDOW
+    # 0 disables the write buffering
+    workspace_write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE
+    # Defaults to the number of backend connections available for the commands
+    workspace_upload_max_concurrency: Optional[int] = None
+    # Maximum number of entries synchronized at the same time by the sync monitor,
+    # defaults to the number of backend connections available for the commands
+    sync_max_concurrency: Optional[int] = None
+    # Delays (in seconds) between a local change and its synchronization: the change
+    # must not have been modified for `sync_min_wait` (multiplied by `sync_backoff_factor`
+    # each time the entry is modified again shortly after its sync), up to `sync_max_wait`
+    sync_min_wait: float = 1
+    sync_max_wait: float = 60
+    sync_backoff_factor: float = 2
+
     mountpoint_enabled: bool = False
     disabled_workspaces: FrozenSet[EntryID] = frozenset()
+    # Workspaces whose identical blocks are uploaded only once
+    deduplicated_workspaces: FrozenSet[EntryID] = frozenset()
 
     sentry_url: Optional[str] = None
     telemetry_enabled: bool = True
@@ -102,9 +133,22 @@ def config_factory(
     prevent_sync_pattern_path: Optional[Path] = None,
     mountpoint_enabled: bool = False,
     disabled_workspaces: FrozenSet[EntryID] = frozenset(),
+    deduplicated_workspaces: FrozenSet[EntryID] = frozenset(),
     backend_max_cooldown: int = 30,
     backend_connection_keepalive: Optional[int] = 29,
     backend_max_connections: int = 4,
+    backend_connection_idle_timeout: Optional[float] = 60,
+    backend_max_pipelined_requests: int = 0,
+    workspace_storage_memory_cache_size: int = DEFAULT_CHUNK_MEMORY_CACHE_SIZE,
+    workspace_storage_block_files: bool = False,
+    workspace_storage_manifest_cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
+    workspace_read_ahead_window: int = DEFAULT_READ_AHEAD_WINDOW,
+    workspace_write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+    workspace_upload_max_concurrency: Optional[int] = None,
+    sync_max_concurrency: Optional[int] = None,
+    sync_min_wait: float = 1,
+    sync_max_wait: float = 60,
+    sync_backoff_factor: float = 2,
     telemetry_enabled: bool = True,
     debug: bool = False,
     gui_last_device: str = None,
@@ -142,9 +186,22 @@ def config_factory(
         prevent_sync_pattern_path=prevent_sync_pattern_path,
         mountpoint_enabled=mountpoint_enabled,
         disabled_workspaces=disabled_workspaces,
+        deduplicated_workspaces=deduplicated_workspaces,
         backend_max_cooldown=backend_max_cooldown,
         backend_connection_keepalive=backend_connection_keepalive,
         backend_max_connections=backend_max_connections,
+        backend_connection_idle_timeout=backend_connection_idle_timeout,
+        backend_max_pipelined_requests=backend_max_pipelined_requests,
+        workspace_storage_memory_cache_size=workspace_storage_memory_cache_size,
+        workspace_storage_block_files=workspace_storage_block_files,
+        workspace_storage_manifest_cache_size=workspace_storage_manifest_cache_size,
+        workspace_read_ahead_window=workspace_read_ahead_window,
+        workspace_write_buffer_size=workspace_write_buffer_size,
+        workspace_upload_max_concurrency=workspace_upload_max_concurrency,
+        sync_max_concurrency=sync_max_concurrency,
+        sync_min_wait=sync_min_wait,
+        sync_max_wait=sync_max_wait,
+        sync_backoff_factor=sync_backoff_factor,
         telemetry_enabled=telemetry_enabled,
         debug=debug,
         sentry_url=environ.get("SENTRY_URL") or None,
@@ -212,6 +269,13 @@ def load_config(config_dir: Path, **extra_config) -> CoreConfig:
     except (KeyError, ValueError):
         pass
 
+    try:
+        data_conf["deduplicated_workspaces"] = frozenset(
+            map(EntryID, data_conf["deduplicated_workspaces"])
+        )
+    except (KeyError, ValueError):
+        pass
+
     try:
         data_conf["preferred_org_creation_backend_addr"] = BackendAddr.from_url(
             data_conf["preferred_org_creation_backend_addr"]
@@ -254,6 +318,7 @@ def save_config(config: CoreConfig):
                 "prevent_sync_pattern": str(config.prevent_sync_pattern_path),
                 "telemetry_enabled": config.telemetry_enabled,
                 "disabled_workspaces": list(map(str, config.disabled_workspaces)),
+                "deduplicated_workspaces": list(map(str, config.deduplicated_workspaces)),
                 "backend_max_cooldown": config.backend_max_cooldown,
                 "backend_connection_keepalive": config.backend_connection_keepalive,
                 "gui_last_device": config.gui_last_device,
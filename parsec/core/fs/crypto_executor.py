@@ -0,0 +1,99 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import os
+import trio
+from trio.lowlevel import RunVar
+from typing import Callable, TypeVar, List, Sequence
+
+from parsec.crypto import SecretKey
+
+
+__all__ = (
+    "CRYPTO_THREAD_THRESHOLD",
+    "run_crypto",
+    "encrypt",
+    "decrypt",
+    "encrypt_many",
+    "decrypt_many",
+)
+
+
+R = TypeVar("R")
+
+# Data smaller than this (in bytes) is processed in the trio thread,
+# as moving it to another thread would cost more than the processing itself
+CRYPTO_THREAD_THRESHOLD = 64 * 1024
+# Maximum number of threads processing data at the same time
+CRYPTO_MAX_THREADS = os.cpu_count() or 1
+
+# The limiter is bound to the trio run, just like the default limiter of trio
+_crypto_limiter: RunVar = RunVar("crypto_limiter")
+
+
+def _get_crypto_limiter() -> trio.CapacityLimiter:
+    try:
+        return _crypto_limiter.get()
+    except LookupError:
+        limiter = trio.CapacityLimiter(CRYPTO_MAX_THREADS)
+        _crypto_limiter.set(limiter)
+        return limiter
+
+
+async def run_crypto(size: int, fn: Callable[..., R], *args: object) -> R:
+    """Run a cryptographic operation on `size` bytes of data.
+
+    The libsodium bindings release the GIL, so the operations on large data
+    (typically blocks) run in a pool of threads: this keeps the trio thread
+    responsive and allows for several cores to be used at once.
+    """
+    if size < CRYPTO_THREAD_THRESHOLD:
+        return fn(*args)
+    return await trio.to_thread.run_sync(fn, *args, limiter=_get_crypto_limiter())
+
+
+async def encrypt(key: SecretKey, data: bytes) -> bytes:
+    """
+    Raises:
+        CryptoError: if key is invalid.
+    """
+    return await run_crypto(len(data), key.encrypt, data)
+
+
+async def decrypt(key: SecretKey, ciphered: bytes) -> bytes:
+    """
+    Raises:
+        CryptoError: if key is invalid.
+    """
+    return await run_crypto(len(ciphered), key.decrypt, ciphered)
+
+
+async def _run_crypto_many(fn: Callable[[bytes], bytes], items: Sequence[bytes]) -> List[bytes]:
+    results: List[bytes] = [b""] * len(items)
+
+    async def _process(index: int) -> None:
+        results[index] = await run_crypto(len(items[index]), fn, items[index])
+
+    # Process the large items concurrently, each of them in its own thread
+    async with trio.open_nursery() as nursery:
+        for index, item in enumerate(items):
+            if len(item) < CRYPTO_THREAD_THRESHOLD:
+                results[index] = fn(item)
+            else:
+                nursery.start_soon(_process, index)
+    return results
+
+
+async def encrypt_many(key: SecretKey, items: Sequence[bytes]) -> List[bytes]:
+    """
+    Raises:
+        CryptoError: if key is invalid.
+    """
+    return await _run_crypto_many(key.encrypt, items)
+
+
+async def decrypt_many(key: SecretKey, items: Sequence[bytes]) -> List[bytes]:
+    """
+    Raises:
+        CryptoError: if key is invalid.
+    """
+    return await _run_crypto_many(key.decrypt, items)
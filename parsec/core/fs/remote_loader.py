@@ -1,15 +1,17 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import trio
 from contextlib import contextmanager
-from typing import Dict, Optional, List, Tuple, cast, Iterator, Callable, Awaitable
+from typing import Dict, Optional, List, Tuple, Sequence, cast, Iterator, Callable, Awaitable
 
 from pendulum import DateTime, now as pendulum_now
 
-from parsec.utils import timestamps_in_the_ballpark
-from parsec.crypto import HashDigest, CryptoError
+from parsec.utils import timestamps_in_the_ballpark, open_service_nursery
+from parsec.crypto import SecretKey, HashDigest, CryptoError
 from parsec.api.protocol import UserID, DeviceID, RealmRole
 from parsec.api.data import (
     DataError,
+    BlockID,
     BlockAccess,
     RealmRoleCertificateContent,
     BaseManifest as BaseRemoteManifest,
@@ -37,6 +39,7 @@ from parsec.core.remote_devices_manager import (
 )
 from parsec.core.fs.exceptions import (
     FSError,
+    FSLocalMissError,
     FSRemoteSyncError,
     FSRemoteOperationError,
     FSRemoteManifestNotFound,
@@ -52,6 +55,7 @@ from parsec.core.fs.exceptions import (
     FSDeviceNotFoundError,
     FSInvalidTrustchainEror,
 )
+from parsec.core.fs.crypto_executor import run_crypto, decrypt
 from parsec.core.fs.storage import BaseWorkspaceStorage
 
 
@@ -296,6 +300,22 @@ class UserRemoteLoader:
             raise FSError(f"Cannot create realm {realm_id}: `{rep['status']}`")
 
 
+# Context used to derive the block deduplication key from the workspace key
+BLOCK_DEDUPLICATION_KEY_CONTEXT = b"parsec block deduplication"
+
+# Maximum number of vlobs read in a single `vlob_read_batch` request
+VLOB_READ_BATCH_SIZE = 1000
+
+
+class BlockDownload:
+    """A block download other readers of the same block can wait for."""
+
+    def __init__(self) -> None:
+        self.done = trio.Event()
+        self.succeeded = False
+        self.error: Optional[Exception] = None
+
+
 class RemoteLoader(UserRemoteLoader):
     def __init__(
         self,
@@ -306,6 +326,7 @@ class RemoteLoader(UserRemoteLoader):
         backend_cmds: BackendAuthenticatedCmds,
         remote_devices_manager: RemoteDevicesManager,
         local_storage: BaseWorkspaceStorage,
+        deduplicate_blocks: bool = False,
     ):
         super().__init__(
             device,
@@ -316,6 +337,8 @@ class RemoteLoader(UserRemoteLoader):
             remote_devices_manager,
         )
         self.local_storage = local_storage
+        self.deduplicate_blocks = deduplicate_blocks
+        self._block_downloads: Dict[BlockID, BlockDownload] = {}
 
     async def load_blocks(self, accesses: List[BlockAccess]) -> None:
         """
@@ -325,8 +348,20 @@ class RemoteLoader(UserRemoteLoader):
             FSBackendOfflineError
             FSWorkspaceInMaintenance
         """
-        for access in accesses:
-            await self.load_block(access)
+        # Nothing to download
+        if not accesses:
+            return
+
+        # Download the blocks concurrently, up to the number of available transports
+        accesses_iter = iter(accesses)
+
+        async def _loader() -> None:
+            for access in accesses_iter:
+                await self.load_block(access)
+
+        async with open_service_nursery() as nursery:
+            for _ in range(min(self.backend_cmds.max_concurrency, len(accesses))):
+                nursery.start_soon(_loader)
 
     async def load_block(self, access: BlockAccess) -> None:
         """
@@ -337,6 +372,28 @@ class RemoteLoader(UserRemoteLoader):
             FSWorkspaceInMaintenance
             FSWorkspaceNoAccess
         """
+        # The block is already being downloaded, wait for the result
+        while access.id in self._block_downloads:
+            download = self._block_downloads[access.id]
+            await download.done.wait()
+            if download.succeeded:
+                return
+            if download.error is not None:
+                raise download.error
+            # The download has been cancelled, try again
+
+        download = self._block_downloads[access.id] = BlockDownload()
+        try:
+            await self._download_block(access)
+            download.succeeded = True
+        except Exception as exc:
+            download.error = exc
+            raise
+        finally:
+            del self._block_downloads[access.id]
+            download.done.set()
+
+    async def _download_block(self, access: BlockAccess) -> None:
         # Download
         with translate_backend_cmds_errors():
             rep = await self.backend_cmds.block_read(access.id)
@@ -354,7 +411,7 @@ class RemoteLoader(UserRemoteLoader):
 
         # Decryption
         try:
-            block = access.key.decrypt(rep["block"])
+            block = await decrypt(access.key, rep["block"])
 
         # Decryption error
         except CryptoError as exc:
@@ -363,6 +420,7 @@ class RemoteLoader(UserRemoteLoader):
         # TODO: let encryption manager do the digest check ?
         assert HashDigest.from_data(block) == access.digest, access
         await self.local_storage.set_clean_block(access.id, block)
+        await self._index_deduplicated_block(access, block)
 
     async def upload_block(self, access: BlockAccess, data: bytes) -> None:
         """
@@ -372,14 +430,32 @@ class RemoteLoader(UserRemoteLoader):
             FSWorkspaceInMaintenance
             FSWorkspaceNoAccess
         """
-        # Encryption
+        ciphered = await run_crypto(len(data), self.encrypt_block, access, data)
+        await self.upload_ciphered_block(access, data, ciphered)
+
+    @staticmethod
+    def encrypt_block(access: BlockAccess, data: bytes) -> bytes:
+        """
+        Raises:
+            FSError
+        """
         try:
-            ciphered = access.key.encrypt(data)
+            return access.key.encrypt(data)
 
         # Encryption error
         except CryptoError as exc:
             raise FSError(f"Cannot encrypt block: {exc}") from exc
 
+    async def upload_ciphered_block(
+        self, access: BlockAccess, data: bytes, ciphered: bytes
+    ) -> None:
+        """
+        Raises:
+            FSError
+            FSBackendOfflineError
+            FSWorkspaceInMaintenance
+            FSWorkspaceNoAccess
+        """
         # Upload block
         with translate_backend_cmds_errors():
             rep = await self.backend_cmds.block_create(access.id, self.workspace_id, ciphered)
@@ -399,6 +475,35 @@ class RemoteLoader(UserRemoteLoader):
         # Update local storage
         await self.local_storage.set_clean_block(access.id, data)
         await self.local_storage.clear_chunk(ChunkID(access.id), miss_ok=True)
+        await self._index_deduplicated_block(access, data)
+
+    # Block deduplication
+
+    def _get_deduplication_digest(self, data: bytes) -> bytes:
+        # The digest is keyed with a key derived from the workspace key,
+        # so it reveals nothing about the content of the block
+        workspace_key = self.get_workspace_entry().key
+        deduplication_key = SecretKey(workspace_key.hmac(BLOCK_DEDUPLICATION_KEY_CONTEXT))
+        # nacl's blake2b doesn't accept bytearray
+        return deduplication_key.hmac(bytes(data))
+
+    async def _index_deduplicated_block(self, access: BlockAccess, data: bytes) -> None:
+        # Only the blocks known to exist in the remote storage are indexed
+        if self.deduplicate_blocks:
+            digest = self._get_deduplication_digest(data)
+            await self.local_storage.set_deduplicated_block(digest, access)
+
+    async def find_deduplicated_block(self, data: bytes) -> Optional[BlockAccess]:
+        """
+        Return the access to an uploaded block with the same content, if any.
+        """
+        if not self.deduplicate_blocks:
+            return None
+        digest = self._get_deduplication_digest(data)
+        try:
+            return await self.local_storage.get_deduplicated_block(digest)
+        except FSLocalMissError:
+            return None
 
     async def load_manifest(
         self,
@@ -522,21 +627,151 @@ class RemoteLoader(UserRemoteLoader):
             raise FSError(f"Cannot decrypt vlob: {exc}") from exc
 
         # Finally make sure author was allowed to create this manifest
-        role_at_timestamp = await self._get_user_realm_role_at(
-            expected_author.user_id, expected_timestamp
-        )
+        await self._check_manifest_author_role(expected_author, expected_timestamp)
+
+        return remote_manifest
+
+    async def _check_manifest_author_role(self, author: DeviceID, timestamp: DateTime) -> None:
+        role_at_timestamp = await self._get_user_realm_role_at(author.user_id, timestamp)
         if role_at_timestamp is None:
             raise FSError(
-                f"Manifest was created at {expected_timestamp} by `{expected_author}` "
+                f"Manifest was created at {timestamp} by `{author}` "
                 "which had no right to access the workspace at that time"
             )
         elif role_at_timestamp == RealmRole.READER:
             raise FSError(
-                f"Manifest was created at {expected_timestamp} by `{expected_author}` "
+                f"Manifest was created at {timestamp} by `{author}` "
                 "which had write right on the workspace at that time"
             )
 
-        return remote_manifest
+    async def load_manifests(
+        self, entry_ids: Sequence[EntryID], workspace_entry: Optional[WorkspaceEntry] = None
+    ) -> Dict[EntryID, BaseRemoteManifest]:
+        """
+        Download the last version of several manifests with a single request.
+
+        The manifests not found on the backend are omitted from the result.
+
+        Raises:
+            FSError
+            FSBackendOfflineError
+            FSWorkspaceInMaintenance
+            FSBadEncryptionRevision
+            FSWorkspaceNoAccess
+            FSUserNotFoundError
+            FSDeviceNotFoundError
+            FSInvalidTrustchainError
+        """
+        # Get the current and requested workspace entry
+        # They're usually the same, except when loading from a workspace while it's in maintenance
+        current_workspace_entry = self.get_workspace_entry()
+        workspace_entry = current_workspace_entry if workspace_entry is None else workspace_entry
+        manifests: Dict[EntryID, BaseRemoteManifest] = {}
+        remaining = list(entry_ids)
+        while remaining:
+            batch = remaining[:VLOB_READ_BATCH_SIZE]
+            remaining = remaining[VLOB_READ_BATCH_SIZE:]
+            # Download the vlobs
+            with translate_backend_cmds_errors():
+                rep = await self.backend_cmds.vlob_read_batch(
+                    self.workspace_id,
+                    workspace_entry.encryption_revision,
+                    [(entry_id, None) for entry_id in batch],
+                )
+
+            # Special case for loading manifests while in maintenance (see `load_manifest`)
+            if (
+                rep["status"] == "in_maintenance"
+                and workspace_entry.encryption_revision
+                == current_workspace_entry.encryption_revision
+            ):
+                previous_workspace_entry = await self.get_previous_workspace_entry()
+                # Make sure we don't fall into an infinite loop because of some other bug
+                assert (
+                    previous_workspace_entry.encryption_revision
+                    < self.get_workspace_entry().encryption_revision
+                )
+                manifests.update(
+                    await self.load_manifests(batch, workspace_entry=previous_workspace_entry)
+                )
+                continue
+
+            if rep["status"] == "unknown_command":
+                # `vlob_read_batch` command has been introduced in API v2.3,
+                # so fallback to reading the manifests one by one
+                for entry_id in batch:
+                    try:
+                        manifests[entry_id] = await self.load_manifest(
+                            entry_id, workspace_entry=workspace_entry
+                        )
+                    except FSRemoteManifestNotFound:
+                        pass
+                continue
+            elif rep["status"] == "not_found":
+                # The realm doesn't exist yet, neither do its manifests
+                continue
+            elif rep["status"] == "not_allowed":
+                # Seems we lost the access to the realm
+                raise FSWorkspaceNoReadAccess("Cannot load manifests: no read access")
+            elif rep["status"] == "bad_encryption_revision":
+                raise FSBadEncryptionRevision(
+                    "Cannot fetch vlobs: Bad encryption revision provided"
+                )
+            elif rep["status"] == "in_maintenance":
+                raise FSWorkspaceInMaintenance(
+                    "Cannot download vlobs while the workspace is in maintenance"
+                )
+            elif rep["status"] != "ok":
+                raise FSError(f"Cannot fetch vlobs: `{rep['status']}`")
+
+            manifests.update(await self._verify_manifests(rep["vlobs"], workspace_entry))
+
+            if rep["truncated"] and rep["vlobs"]:
+                # The backend limits the size of its reply (the vlobs being returned in
+                # the requested order), so ask again for the ones after the last returned
+                last_index = batch.index(rep["vlobs"][-1]["vlob_id"])
+                remaining = batch[last_index + 1 :] + remaining
+
+        return manifests
+
+    async def _verify_manifests(
+        self, vlobs: List[dict], workspace_entry: WorkspaceEntry
+    ) -> Dict[EntryID, BaseRemoteManifest]:
+        # Fetch each author once, then decrypt and verify all the manifests in one go
+        authors: Dict[DeviceID, DeviceCertificateContent] = {}
+        for vlob in vlobs:
+            if vlob["author"] not in authors:
+                with translate_remote_devices_manager_errors():
+                    authors[vlob["author"]] = await self.remote_devices_manager.get_device(
+                        vlob["author"]
+                    )
+
+        def _decrypt_verify_and_load_all() -> Dict[EntryID, BaseRemoteManifest]:
+            return {
+                EntryID(vlob["vlob_id"]): BaseRemoteManifest.decrypt_verify_and_load(
+                    vlob["blob"],
+                    key=workspace_entry.key,
+                    author_verify_key=authors[vlob["author"]].verify_key,
+                    expected_author=vlob["author"],
+                    expected_timestamp=vlob["timestamp"],
+                    expected_version=vlob["version"],
+                    expected_id=EntryID(vlob["vlob_id"]),
+                )
+                for vlob in vlobs
+            }
+
+        try:
+            manifests = await run_crypto(
+                sum(len(vlob["blob"]) for vlob in vlobs), _decrypt_verify_and_load_all
+            )
+        except DataError as exc:
+            raise FSError(f"Cannot decrypt vlob: {exc}") from exc
+
+        # Finally make sure the authors were allowed to create those manifests
+        for vlob in vlobs:
+            await self._check_manifest_author_role(vlob["author"], vlob["timestamp"])
+
+        return manifests
 
     async def upload_manifest(self, entry_id: EntryID, manifest: BaseRemoteManifest) -> None:
         """
@@ -665,6 +900,8 @@ class RemoteLoaderTimestamped(RemoteLoader):
         self.backend_cmds = remote_loader.backend_cmds
         self.remote_devices_manager = remote_loader.remote_devices_manager
         self.local_storage = remote_loader.local_storage.to_timestamped(timestamp)
+        self.deduplicate_blocks = remote_loader.deduplicate_blocks
+        self._block_downloads = remote_loader._block_downloads
         self._realm_role_certificates_cache = None
         self._realm_role_certificates_cache_timestamp = None
         self.timestamp = timestamp
@@ -672,6 +909,11 @@ class RemoteLoaderTimestamped(RemoteLoader):
     async def upload_block(self, access: BlockAccess, data: bytes) -> None:
         raise FSError("Cannot upload block through a timestamped remote loader")
 
+    async def upload_ciphered_block(
+        self, access: BlockAccess, data: bytes, ciphered: bytes
+    ) -> None:
+        raise FSError("Cannot upload block through a timestamped remote loader")
+
     async def load_manifest(
         self,
         entry_id: EntryID,
@@ -706,6 +948,30 @@ class RemoteLoaderTimestamped(RemoteLoader):
             workspace_entry=workspace_entry,
         )
 
+    async def load_manifests(
+        self, entry_ids: Sequence[EntryID], workspace_entry: Optional[WorkspaceEntry] = None
+    ) -> Dict[EntryID, BaseRemoteManifest]:
+        """
+        The batch request only provides the last version of the manifests, so
+        the manifests at the given timestamp are downloaded one by one.
+
+        Raises:
+            FSError
+            FSBackendOfflineError
+            FSWorkspaceInMaintenance
+            FSBadEncryptionRevision
+            FSWorkspaceNoAccess
+        """
+        manifests: Dict[EntryID, BaseRemoteManifest] = {}
+        for entry_id in entry_ids:
+            try:
+                manifests[entry_id] = await self.load_manifest(
+                    entry_id, workspace_entry=workspace_entry
+                )
+            except FSRemoteManifestNotFound:
+                pass
+        return manifests
+
     async def upload_manifest(self, entry_id: EntryID, manifest: BaseRemoteManifest) -> None:
         raise FSError("Cannot upload manifest through a timestamped remote loader")
 
@@ -3,7 +3,12 @@
 from parsec.core.fs.storage.local_database import LocalDatabase
 from parsec.core.fs.storage.user_storage import UserStorage
 from parsec.core.fs.storage.manifest_storage import ManifestStorage
-from parsec.core.fs.storage.chunk_storage import ChunkStorage, BlockStorage
+from parsec.core.fs.storage.chunk_storage import (
+    ChunkCache,
+    ChunkStorage,
+    BlockStorage,
+    FileBlockStorage,
+)
 from parsec.core.fs.storage.workspace_storage import (
     BaseWorkspaceStorage,
     WorkspaceStorage,
@@ -13,8 +18,10 @@ from parsec.core.fs.storage.workspace_storage import (
 __all__ = (
     "LocalDatabase",
     "ManifestStorage",
+    "ChunkCache",
     "ChunkStorage",
     "BlockStorage",
+    "FileBlockStorage",
     "UserStorage",
     "BaseWorkspaceStorage",
     "WorkspaceStorage",
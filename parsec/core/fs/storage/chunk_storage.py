@@ -1,27 +1,146 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import os
 import time
+import shutil
+import tempfile
+from uuid import UUID
+from functools import partial
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import trio
 from pathlib import Path
-from typing import AsyncIterator, AsyncContextManager, TypeVar
+from typing import (
+    AsyncIterator,
+    AsyncContextManager,
+    TypeVar,
+    Optional,
+    Dict,
+    Tuple,
+    List,
+    Iterable,
+    Iterator,
+    Callable,
+)
 from async_generator import asynccontextmanager
 
 
-from parsec.core.types import ChunkID
+from parsec.crypto import SecretKey, HashDigest
+from parsec.core.types import ChunkID, BlockID, BlockAccess
 from parsec.core.types import LocalDevice, DEFAULT_BLOCK_SIZE
+from parsec.core.fs.crypto_executor import encrypt, decrypt, encrypt_many, decrypt_many
 from parsec.core.fs.storage.local_database import LocalDatabase, Cursor
 from parsec.core.fs.exceptions import FSLocalMissError, FSLocalStorageClosedError
 
 T = TypeVar("T", bound="ChunkStorage")
 
+# Delay (in seconds) between two writes of the pending access timestamps to the database
+ACCESSES_FLUSH_DELAY = 30
+
+# Number of blocks moved from the database to the disk in a single transaction
+BLOCK_FILES_MIGRATION_BATCH_SIZE = 16
+
+# Maximum number of chunk ids in a single `IN (...)` query, below the sqlite limit of 999 parameters
+CHUNK_IDS_QUERY_BATCH_SIZE = 500
+
+
+class ChunkCache:
+    """Size-bounded LRU cache for decrypted chunks of data.
+
+    It is meant to be shared between the storages of a given workspace.
+    This is safe since a chunk id always refers to the same data, no matter
+    which storage it comes from. Each entry keeps track of the storage it
+    has been read from, so the accesses can be accounted for properly. A
+    `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._data: "OrderedDict[ChunkID, Tuple[bytes, ChunkStorage]]" = OrderedDict()
+        # Generation of the chunks being read from the storages, bumped each time
+        # they are discarded so data read before a change doesn't end up cached
+        self._generations: Dict[ChunkID, int] = {}
+        self._readers: Dict[ChunkID, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, chunk_id: object) -> bool:
+        return chunk_id in self._data
+
+    def get(self, chunk_id: ChunkID) -> Optional[Tuple[bytes, "ChunkStorage"]]:
+        try:
+            self._data.move_to_end(chunk_id)
+        except KeyError:
+            return None
+        return self._data[chunk_id]
+
+    def set(self, chunk_id: ChunkID, data: bytes, storage: "ChunkStorage") -> None:
+        # Data bigger than the cache itself is simply not cached
+        if len(data) > self.max_size:
+            return
+        self.discard(chunk_id)
+        self._data[chunk_id] = (data, storage)
+        self.size += len(data)
+        # Evict the least recently used chunks
+        while self.size > self.max_size:
+            _, (evicted, _) = self._data.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, chunk_id: ChunkID) -> None:
+        item = self._data.pop(chunk_id, None)
+        if item is not None:
+            self.size -= len(item[0])
+        if chunk_id in self._generations:
+            self._generations[chunk_id] += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size = 0
+        for chunk_id in self._generations:
+            self._generations[chunk_id] += 1
+
+    @contextmanager
+    def reading(
+        self, chunk_ids: Iterable[ChunkID]
+    ) -> Iterator[Callable[[ChunkID, bytes, "ChunkStorage"], None]]:
+        """Provide a function to cache the chunks read from a storage, unless
+        they have been discarded while being read."""
+        generations = {}
+        for chunk_id in chunk_ids:
+            generations[chunk_id] = self._generations.setdefault(chunk_id, 0)
+            self._readers[chunk_id] = self._readers.get(chunk_id, 0) + 1
+
+        def _set(chunk_id: ChunkID, data: bytes, storage: "ChunkStorage") -> None:
+            if self._generations[chunk_id] == generations[chunk_id]:
+                self.set(chunk_id, data, storage)
+
+        try:
+            yield _set
+        finally:
+            for chunk_id in generations:
+                self._readers[chunk_id] -= 1
+                if not self._readers[chunk_id]:
+                    del self._readers[chunk_id]
+                    del self._generations[chunk_id]
+
 
 class ChunkStorage:
     """Interface to access the local chunks of data."""
 
-    def __init__(self, device: LocalDevice, localdb: LocalDatabase):
+    def __init__(
+        self, device: LocalDevice, localdb: LocalDatabase, chunk_cache: Optional[ChunkCache] = None
+    ):
         self.local_symkey = device.local_symkey
         self.localdb = localdb
+        self.chunk_cache = ChunkCache(max_size=0) if chunk_cache is None else chunk_cache
+
+        # Updating the access timestamp on each read is costly since it requires
+        # a write to the database. Instead, the timestamps are kept in memory and
+        # written in a single batch from time to time (see `WorkspaceStorage.run`).
+        self._pending_accesses: Dict[ChunkID, float] = {}
 
     @property
     def path(self) -> Path:
@@ -30,9 +149,9 @@ class ChunkStorage:
     @classmethod
     @asynccontextmanager
     async def run(
-        cls, device: LocalDevice, localdb: LocalDatabase
+        cls, device: LocalDevice, localdb: LocalDatabase, chunk_cache: Optional[ChunkCache] = None
     ) -> AsyncIterator["ChunkStorage"]:
-        async with cls(device, localdb)._run() as self:
+        async with cls(device, localdb, chunk_cache)._run() as self:
             yield self
 
     @asynccontextmanager
@@ -44,6 +163,7 @@ class ChunkStorage:
             with trio.CancelScope(shield=True):
                 # Commit the pending changes in the local database
                 try:
+                    await self.flush_accesses()
                     await self.localdb.commit()
                 # Ignore storage closed exceptions, since it follows an operational error
                 except FSLocalStorageClosedError:
@@ -60,6 +180,9 @@ class ChunkStorage:
         # an actual flush operation is performed.
         return self.localdb.open_cursor(commit=False)
 
+    def _open_read_cursor(self) -> AsyncContextManager[Cursor]:
+        return self.localdb.open_read_cursor()
+
     # Database initialization
 
     async def _create_db(self) -> None:
@@ -74,6 +197,29 @@ class ChunkStorage:
                 );"""
             )
 
+    # Access timestamps
+
+    def _register_access(self, chunk_id: ChunkID) -> None:
+        self._pending_accesses[chunk_id] = time.time()
+
+    async def _flush_accesses(self, cursor: Cursor) -> None:
+        if not self._pending_accesses:
+            return
+        accesses = [
+            (accessed_on, chunk_id.bytes)
+            for chunk_id, accessed_on in self._pending_accesses.items()
+        ]
+        self._pending_accesses.clear()
+        # Use a thread as executing a statement that modifies the content of the database might,
+        # in some case, block for several hundreds of milliseconds
+        await self.localdb.run_in_thread(
+            cursor.executemany, "UPDATE chunks SET accessed_on = ? WHERE chunk_id = ?", accesses
+        )
+
+    async def flush_accesses(self) -> None:
+        async with self._open_cursor() as cursor:
+            await self._flush_accesses(cursor)
+
     # Size and chunks
 
     async def get_nb_blocks(self) -> int:
@@ -91,45 +237,132 @@ class ChunkStorage:
     # Generic chunk operations
 
     async def is_chunk(self, chunk_id: ChunkID) -> bool:
-        async with self._open_cursor() as cursor:
+        async with self._open_read_cursor() as cursor:
             cursor.execute("SELECT chunk_id FROM chunks WHERE chunk_id = ?", (chunk_id.bytes,))
             manifest_row = cursor.fetchone()
         return bool(manifest_row)
 
     async def get_chunk(self, chunk_id: ChunkID) -> bytes:
+        # Look in the memory cache first
+        cached = self.chunk_cache.get(chunk_id)
+        if cached is not None:
+            data, storage = cached
+
+        # Look into the storage
+        else:
+            with self.chunk_cache.reading([chunk_id]) as cache_set:
+                ciphered = await self._read_chunk_data(chunk_id)
+                data, storage = await decrypt(self.local_symkey, ciphered), self
+                cache_set(chunk_id, data, self)
+
+        # The access is accounted for by the storage the chunk comes from,
+        # and periodically written to the database
+        storage._register_access(chunk_id)
+        return data
+
+    async def get_chunks(self, chunk_ids: Iterable[ChunkID]) -> Dict[ChunkID, bytes]:
+        """Return the data of the given chunks, the missing chunks being left out."""
+        result: Dict[ChunkID, bytes] = {}
+        accessed: Dict[ChunkID, ChunkStorage] = {}
+        to_read: List[ChunkID] = []
+
+        # Look in the memory cache first
+        for chunk_id in dict.fromkeys(chunk_ids):
+            cached = self.chunk_cache.get(chunk_id)
+            if cached is None:
+                to_read.append(chunk_id)
+            else:
+                result[chunk_id], accessed[chunk_id] = cached
+
+        # Look into the storage, all at once
+        if to_read:
+            with self.chunk_cache.reading(to_read) as cache_set:
+                ciphered_chunks = await self._read_chunks_data(to_read)
+                decrypted = await decrypt_many(self.local_symkey, list(ciphered_chunks.values()))
+                for chunk_id, data in zip(ciphered_chunks, decrypted):
+                    result[chunk_id] = data
+                    accessed[chunk_id] = self
+                    cache_set(chunk_id, data, self)
+
+        # The accesses are accounted for by the storages the chunks come from
+        for chunk_id, storage in accessed.items():
+            storage._register_access(chunk_id)
+        return result
+
+    async def _read_chunk_data(self, chunk_id: ChunkID) -> bytes:
+        async with self._open_read_cursor() as cursor:
+
+            def _thread_target() -> Optional[Tuple[bytes]]:
+                cursor.execute("""SELECT data FROM chunks WHERE chunk_id = ?""", (chunk_id.bytes,))
+                return cursor.fetchone()
+
+            # Use a thread so several chunks can be fetched concurrently
+            row = await self.localdb.run_in_thread(_thread_target)
+        if not row:
+            raise FSLocalMissError(chunk_id)
+        return row[0]
+
+    async def _read_chunks_data(self, chunk_ids: List[ChunkID]) -> Dict[ChunkID, bytes]:
+        async with self._open_read_cursor() as cursor:
+
+            def _thread_target() -> List[Tuple[bytes, bytes]]:
+                rows = []
+                for i in range(0, len(chunk_ids), CHUNK_IDS_QUERY_BATCH_SIZE):
+                    batch = [
+                        chunk_id.bytes for chunk_id in chunk_ids[i : i + CHUNK_IDS_QUERY_BATCH_SIZE]
+                    ]
+                    cursor.execute(
+                        f"""SELECT chunk_id, data FROM chunks
+                        WHERE chunk_id IN ({", ".join("?" * len(batch))})""",
+                        batch,
+                    )
+                    rows += cursor.fetchall()
+                return rows
+
+            # A single thread hop for all the chunks
+            rows = await self.localdb.run_in_thread(_thread_target)
+        return {ChunkID(UUID(bytes=chunk_id)): data for chunk_id, data in rows}
+
+    async def set_chunk(self, chunk_id: ChunkID, raw: bytes) -> None:
+        ciphered = await encrypt(self.local_symkey, raw)
+
+        # Update database
         async with self._open_cursor() as cursor:
             # Use a thread as executing a statement that modifies the content of the database might,
             # in some case, block for several hundreds of milliseconds
             await self.localdb.run_in_thread(
                 cursor.execute,
-                """
-                UPDATE chunks SET accessed_on = ? WHERE chunk_id = ?;
-                """,
-                (time.time(), chunk_id.bytes),
+                """INSERT OR REPLACE INTO
+                chunks (chunk_id, size, offline, accessed_on, data)
+                VALUES (?, ?, ?, ?, ?)""",
+                (chunk_id.bytes, len(ciphered), False, time.time(), ciphered),
             )
-            cursor.execute("SELECT changes()")
-            changes, = cursor.fetchone()
-            if not changes:
-                raise FSLocalMissError(chunk_id)
-            cursor.execute("""SELECT data FROM chunks WHERE chunk_id = ?""", (chunk_id.bytes,))
-            ciphered, = cursor.fetchone()
-
-        return self.local_symkey.decrypt(ciphered)
-
-    async def set_chunk(self, chunk_id: ChunkID, raw: bytes) -> None:
-        ciphered = self.local_symkey.encrypt(raw)
+            self.chunk_cache.discard(chunk_id)
+
+    async def set_chunks(self, items: Iterable[Tuple[ChunkID, bytes]]) -> None:
+        items = list(items)
+        ciphered_chunks = await encrypt_many(self.local_symkey, [raw for _, raw in items])
+        now = time.time()
+        rows = [
+            (chunk_id.bytes, len(ciphered), False, now, ciphered)
+            for (chunk_id, _), ciphered in zip(items, ciphered_chunks)
+        ]
+        if not rows:
+            return
 
         # Update database
         async with self._open_cursor() as cursor:
             # Use a thread as executing a statement that modifies the content of the database might,
             # in some case, block for several hundreds of milliseconds
             await self.localdb.run_in_thread(
-                cursor.execute,
+                cursor.executemany,
                 """INSERT OR REPLACE INTO
                 chunks (chunk_id, size, offline, accessed_on, data)
                 VALUES (?, ?, ?, ?, ?)""",
-                (chunk_id.bytes, len(ciphered), False, time.time(), ciphered),
+                rows,
             )
+            for chunk_id_bytes, *_ in rows:
+                self.chunk_cache.discard(ChunkID(UUID(bytes=chunk_id_bytes)))
 
     async def clear_chunk(self, chunk_id: ChunkID) -> None:
         async with self._open_cursor() as cursor:
@@ -138,26 +371,68 @@ class ChunkStorage:
             await self.localdb.run_in_thread(
                 cursor.execute, "DELETE FROM chunks WHERE chunk_id = ?", (chunk_id.bytes,)
             )
+            self.chunk_cache.discard(chunk_id)
+            self._pending_accesses.pop(chunk_id, None)
             cursor.execute("SELECT changes()")
             changes, = cursor.fetchone()
 
         if not changes:
             raise FSLocalMissError(chunk_id)
 
+    async def clear_chunks(self, chunk_ids: Iterable[ChunkID]) -> None:
+        """Remove the given chunks, raise `FSLocalMissError` if some of them are missing."""
+        chunk_ids = list(dict.fromkeys(chunk_ids))
+        if not chunk_ids:
+            return
+        async with self._open_cursor() as cursor:
+
+            def _thread_target() -> int:
+                cursor.executemany(
+                    "DELETE FROM chunks WHERE chunk_id = ?",
+                    [(chunk_id.bytes,) for chunk_id in chunk_ids],
+                )
+                return cursor.rowcount
+
+            # Use a thread as executing a statement that modifies the content of the database might,
+            # in some case, block for several hundreds of milliseconds
+            changes = await self.localdb.run_in_thread(_thread_target)
+            for chunk_id in chunk_ids:
+                self.chunk_cache.discard(chunk_id)
+                self._pending_accesses.pop(chunk_id, None)
+
+        if changes < len(chunk_ids):
+            raise FSLocalMissError(chunk_ids)
+
 
 class BlockStorage(ChunkStorage):
     """Interface for caching the data blocks."""
 
-    def __init__(self, device: LocalDevice, localdb: LocalDatabase, cache_size: int):
-        super().__init__(device, localdb)
+    def __init__(
+        self,
+        device: LocalDevice,
+        localdb: LocalDatabase,
+        cache_size: int,
+        chunk_cache: Optional[ChunkCache] = None,
+    ):
+        super().__init__(device, localdb, chunk_cache)
         self.cache_size = cache_size
 
+        # Keep track of the number of blocks and their total size in memory,
+        # in order to avoid counting them after each insertion.
+        # Those attributes are set by `_create_db`
+        self._nb_blocks: int
+        self._total_size: int
+
     @classmethod
     @asynccontextmanager
     async def run(  # type: ignore[override]
-        cls, device: LocalDevice, localdb: LocalDatabase, cache_size: int
-    ) -> AsyncIterator["ChunkStorage"]:
-        async with cls(device, localdb, cache_size)._run() as self:
+        cls,
+        device: LocalDevice,
+        localdb: LocalDatabase,
+        cache_size: int,
+        chunk_cache: Optional[ChunkCache] = None,
+    ) -> AsyncIterator["BlockStorage"]:
+        async with cls(device, localdb, cache_size, chunk_cache)._run() as self:
             yield self
 
     def _open_cursor(self) -> AsyncContextManager[Cursor]:
@@ -167,6 +442,81 @@ class BlockStorage(ChunkStorage):
         # least compare to the downloading of the block).
         return self.localdb.open_cursor(commit=True)
 
+    # Database initialization
+
+    async def _create_db(self) -> None:
+        await super()._create_db()
+        async with self._open_cursor() as cursor:
+            # Index the access timestamps so the garbage collection doesn't sort the whole table
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS chunks_accessed_on_idx ON chunks (accessed_on);"
+            )
+            # Index of the uploaded blocks by content digest, for deduplication
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS deduplicated_blocks
+                    (digest BLOB PRIMARY KEY NOT NULL, -- Keyed hash of the block data
+                     block_id BLOB NOT NULL, -- UUID
+                     size INTEGER NOT NULL,
+                     key BLOB NOT NULL, -- Ciphered block key
+                     data_digest BLOB NOT NULL -- Ciphered hash of the block data
+                );"""
+            )
+        # Take over the blocks left by the other backend, if any
+        await self._migrate_blocks()
+        async with self._open_cursor() as cursor:
+            # Seed the block counters
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chunks")
+            self._nb_blocks, self._total_size = cursor.fetchone()
+
+    async def _migrate_blocks(self) -> None:
+        # Blocks stored on disk by the `FileBlockStorage` are not available here,
+        # simply forget about them so they get downloaded again when needed
+        async with self._open_cursor() as cursor:
+            cursor.execute("DELETE FROM chunks WHERE length(data) = 0")
+
+    # Block data
+
+    async def _write_chunk_data(self, chunk_id: ChunkID, ciphered: bytes) -> bytes:
+        # Return the content of the `data` column
+        return ciphered
+
+    async def _remove_chunk_data(self, chunk_ids: List[ChunkID]) -> None:
+        pass
+
+    async def _clear_all_chunk_data(self) -> None:
+        pass
+
+    # Deduplication index
+
+    async def get_deduplicated_block(self, digest: bytes) -> BlockAccess:
+        async with self._open_read_cursor() as cursor:
+            cursor.execute(
+                "SELECT block_id, size, key, data_digest FROM deduplicated_blocks WHERE digest = ?",
+                (digest,),
+            )
+            row = cursor.fetchone()
+        if not row:
+            raise FSLocalMissError(digest)
+        block_id, size, ciphered_key, ciphered_data_digest = row
+        return BlockAccess(
+            id=BlockID(UUID(bytes=block_id)),
+            key=SecretKey(self.local_symkey.decrypt(ciphered_key)),
+            offset=0,
+            size=size,
+            digest=HashDigest(self.local_symkey.decrypt(ciphered_data_digest)),
+        )
+
+    async def set_deduplicated_block(self, digest: bytes, access: BlockAccess) -> None:
+        ciphered_key = self.local_symkey.encrypt(access.key)
+        ciphered_data_digest = self.local_symkey.encrypt(access.digest)
+        async with self._open_cursor() as cursor:
+            cursor.execute(
+                """INSERT OR REPLACE INTO
+                deduplicated_blocks (digest, block_id, size, key, data_digest)
+                VALUES (?, ?, ?, ?, ?)""",
+                (digest, access.id.bytes, access.size, ciphered_key, ciphered_data_digest),
+            )
+
     # Garbage collection
 
     @property
@@ -176,15 +526,67 @@ class BlockStorage(ChunkStorage):
     async def clear_all_blocks(self) -> None:
         async with self._open_cursor() as cursor:
             cursor.execute("DELETE FROM chunks")
+            await self._clear_all_chunk_data()
+        self.chunk_cache.clear()
+        self._pending_accesses.clear()
+        self._nb_blocks = 0
+        self._total_size = 0
+
+    @property
+    def size_limit(self) -> int:
+        # Stored blocks are ciphered, tolerate an extra block to account for the encryption overhead
+        return self.cache_size + DEFAULT_BLOCK_SIZE
+
+    def _needs_cleanup(self) -> bool:
+        return self._nb_blocks > self.block_limit or self._total_size > self.size_limit
+
+    async def _cleanup(self, cursor: Cursor, keep_id: ChunkID) -> None:
+        # Remove the extra blocks plus 10 % of the cache size, i.e about 100 blocks.
+        # The block that has just been added is never removed as it's about to be read.
+        max_blocks = self.block_limit - self.block_limit // 10
+        max_size = self.size_limit - self.cache_size // 10
+        nb_blocks, total_size = self._nb_blocks, self._total_size
+
+        def _thread_target() -> Tuple[List[ChunkID], int]:
+            removed_ids = []
+            removed_size = 0
+            cursor.execute(
+                "SELECT chunk_id, size FROM chunks WHERE chunk_id != ? ORDER BY accessed_on ASC",
+                (keep_id.bytes,),
+            )
+            for chunk_id, size in cursor:
+                if (
+                    nb_blocks - len(removed_ids) <= max_blocks
+                    and total_size - removed_size <= max_size
+                ):
+                    break
+                removed_ids.append(ChunkID(UUID(bytes=chunk_id)))
+                removed_size += size
+            cursor.executemany(
+                "DELETE FROM chunks WHERE chunk_id = ?", [(x.bytes,) for x in removed_ids]
+            )
+            return removed_ids, removed_size
+
+        # Use a thread as executing a statement that modifies the content of the database might,
+        # in some case, block for several hundreds of milliseconds
+        removed_ids, removed_size = await self.localdb.run_in_thread(_thread_target)
+        await self._remove_chunk_data(removed_ids)
+        self._nb_blocks -= len(removed_ids)
+        self._total_size -= removed_size
 
     # Upgraded set method
 
     async def set_chunk(self, chunk_id: ChunkID, raw: bytes) -> None:
-        ciphered = self.local_symkey.encrypt(raw)
+        ciphered = await encrypt(self.local_symkey, raw)
+        data = await self._write_chunk_data(chunk_id, ciphered)
 
         # Update database
         async with self._open_cursor() as cursor:
 
+            # Size of the previous version of the chunk, if any
+            cursor.execute("SELECT size FROM chunks WHERE chunk_id = ?", (chunk_id.bytes,))
+            previous = cursor.fetchone()
+
             # Insert the chunk
             # Use a thread as executing a statement that modifies the content of the database might,
             # in some case, block for several hundreds of milliseconds
@@ -193,28 +595,198 @@ class BlockStorage(ChunkStorage):
                 """INSERT OR REPLACE INTO
                 chunks (chunk_id, size, offline, accessed_on, data)
                 VALUES (?, ?, ?, ?, ?)""",
-                (chunk_id.bytes, len(ciphered), False, time.time(), ciphered),
+                (chunk_id.bytes, len(ciphered), False, time.time(), data),
             )
+            self.chunk_cache.discard(chunk_id)
 
-            # Count the chunks
-            cursor.execute("SELECT COUNT(*) FROM chunks")
-            nb_blocks, = cursor.fetchone()
-            extra_blocks = nb_blocks - self.block_limit
+            # Update the counters
+            if previous is None:
+                self._nb_blocks += 1
+            else:
+                self._total_size -= previous[0]
+            self._total_size += len(ciphered)
 
-            # No clean up is needed
-            if extra_blocks <= 0:
-                return
+            # Clean up if necessary
+            if self._needs_cleanup():
+                # Write the pending access timestamps so the eviction order is correct
+                await self._flush_accesses(cursor)
+                await self._cleanup(cursor, keep_id=chunk_id)
 
-            # Remove the extra block plus 10 % of the cache size, i.e about 100 blocks
-            limit = extra_blocks + self.block_limit // 10
-            # Use a thread as executing a statement that modifies the content of the database might,
-            # in some case, block for several hundreds of milliseconds
-            await self.localdb.run_in_thread(
-                cursor.execute,
-                """
-                DELETE FROM chunks WHERE chunk_id IN (
-                    SELECT chunk_id FROM chunks ORDER BY accessed_on ASC LIMIT ?
+    async def clear_chunk(self, chunk_id: ChunkID) -> None:
+        async with self._open_cursor() as cursor:
+            cursor.execute("SELECT size FROM chunks WHERE chunk_id = ?", (chunk_id.bytes,))
+            row = cursor.fetchone()
+            if row is not None:
+                # Use a thread as executing a statement that modifies the content of the database might,
+                # in some case, block for several hundreds of milliseconds
+                await self.localdb.run_in_thread(
+                    cursor.execute, "DELETE FROM chunks WHERE chunk_id = ?", (chunk_id.bytes,)
                 )
-                """,
-                (limit,),
-            )
+                self.chunk_cache.discard(chunk_id)
+                self._pending_accesses.pop(chunk_id, None)
+
+        if row is None:
+            raise FSLocalMissError(chunk_id)
+        await self._remove_chunk_data([chunk_id])
+
+        # Update the counters
+        self._nb_blocks -= 1
+        self._total_size -= row[0]
+
+    async def set_chunks(self, items: Iterable[Tuple[ChunkID, bytes]]) -> None:
+        # The counters and the cleanup are maintained one block at a time
+        for chunk_id, raw in items:
+            await self.set_chunk(chunk_id, raw)
+
+    async def clear_chunks(self, chunk_ids: Iterable[ChunkID]) -> None:
+        missing = []
+        for chunk_id in dict.fromkeys(chunk_ids):
+            try:
+                await self.clear_chunk(chunk_id)
+            except FSLocalMissError:
+                missing.append(chunk_id)
+        if missing:
+            raise FSLocalMissError(missing)
+
+
+# Block files helpers
+
+
+def _read_block_file(path: Path) -> bytes:
+    # The file size is known, so an unbuffered read allocates the result once
+    # and copies the data straight into it
+    with open(path, "rb", buffering=0) as fd:
+        return fd.read()
+
+
+def _write_block_file(path: Path, data: bytes) -> None:
+    # Write to a temporary file first so that a block file is never partially written.
+    # The temporary file name is unique so that concurrent writes of the same block
+    # don't step on each other's toes
+    path.parent.mkdir(mode=0o700, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f"{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with open(fd, "wb") as fileobj:
+            fileobj.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _remove_block_files(paths: List[Path]) -> None:
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _clear_block_files(path: Path) -> None:
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+
+class FileBlockStorage(BlockStorage):
+    """Interface for caching the data blocks as files on disk.
+
+    The ciphered blocks are stored in a sharded directory while the database
+    only keeps track of their metadata (the `data` column is left empty). This
+    keeps the database and its WAL small, and avoids copying the blocks around
+    through the sqlite3 module.
+    """
+
+    # Make the trio run_sync function patchable for the tests
+    run_in_thread = staticmethod(trio.to_thread.run_sync)
+
+    def __init__(
+        self,
+        device: LocalDevice,
+        localdb: LocalDatabase,
+        blocks_path: Path,
+        cache_size: int,
+        chunk_cache: Optional[ChunkCache] = None,
+    ):
+        super().__init__(device, localdb, cache_size, chunk_cache)
+        self.blocks_path = Path(blocks_path)
+
+    @classmethod
+    @asynccontextmanager
+    async def run(  # type: ignore[override]
+        cls,
+        device: LocalDevice,
+        localdb: LocalDatabase,
+        blocks_path: Path,
+        cache_size: int,
+        chunk_cache: Optional[ChunkCache] = None,
+    ) -> AsyncIterator["BlockStorage"]:
+        async with cls(device, localdb, blocks_path, cache_size, chunk_cache)._run() as self:
+            yield self
+
+    def _get_block_path(self, chunk_id: ChunkID) -> Path:
+        # Shard the blocks in 256 sub-directories to keep the directories small
+        return self.blocks_path / chunk_id.hex[:2] / chunk_id.hex
+
+    # Database initialization
+
+    async def _create_db(self) -> None:
+        await self.run_in_thread(
+            partial(self.blocks_path.mkdir, mode=0o700, parents=True, exist_ok=True)
+        )
+        await super()._create_db()
+
+    async def _migrate_blocks(self) -> None:
+        # Move the blocks stored in the database by the `BlockStorage` to the disk.
+        # This is done a few blocks at a time to keep the memory usage low.
+        while True:
+            async with self._open_cursor() as cursor:
+                cursor.execute(
+                    "SELECT chunk_id, data FROM chunks WHERE length(data) > 0 LIMIT ?",
+                    (BLOCK_FILES_MIGRATION_BATCH_SIZE,),
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                for chunk_id, data in rows:
+                    await self._write_chunk_data(ChunkID(UUID(bytes=chunk_id)), data)
+                # Use a thread as executing a statement that modifies the content of the database might,
+                # in some case, block for several hundreds of milliseconds
+                await self.localdb.run_in_thread(
+                    cursor.executemany,
+                    "UPDATE chunks SET data = ? WHERE chunk_id = ?",
+                    [(b"", chunk_id) for chunk_id, _ in rows],
+                )
+
+    # Block data
+
+    async def _read_chunk_data(self, chunk_id: ChunkID) -> bytes:
+        try:
+            return await self.run_in_thread(_read_block_file, self._get_block_path(chunk_id))
+        except FileNotFoundError:
+            raise FSLocalMissError(chunk_id)
+
+    async def _read_chunks_data(self, chunk_ids: List[ChunkID]) -> Dict[ChunkID, bytes]:
+        def _thread_target() -> Dict[ChunkID, bytes]:
+            result = {}
+            for chunk_id in chunk_ids:
+                try:
+                    result[chunk_id] = _read_block_file(self._get_block_path(chunk_id))
+                except FileNotFoundError:
+                    pass
+            return result
+
+        return await self.run_in_thread(_thread_target)
+
+    async def _write_chunk_data(self, chunk_id: ChunkID, ciphered: bytes) -> bytes:
+        await self.run_in_thread(_write_block_file, self._get_block_path(chunk_id), ciphered)
+        return b""
+
+    async def _remove_chunk_data(self, chunk_ids: List[ChunkID]) -> None:
+        paths = [self._get_block_path(chunk_id) for chunk_id in chunk_ids]
+        await self.run_in_thread(_remove_block_files, paths)
+
+    async def _clear_all_chunk_data(self) -> None:
+        await self.run_in_thread(_clear_block_files, self.blocks_path)
@@ -1,7 +1,7 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
 from pathlib import Path
-from typing import AsyncIterator, Optional, Union
+from typing import AsyncIterator, Optional, Union, List
 
 import trio
 from async_generator import asynccontextmanager
@@ -9,6 +9,9 @@ from sqlite3 import Connection, Cursor, OperationalError, connect as sqlite_conn
 
 from parsec.core.fs.exceptions import FSLocalStorageClosedError, FSLocalStorageOperationalError
 
+# Maximum number of read-only connections opened by a local database
+DEFAULT_READ_POOL_SIZE = 4
+
 
 class LocalDatabase:
     """Base class for managing an sqlite3 connection."""
@@ -16,23 +19,41 @@ class LocalDatabase:
     # Make the trio run_sync function patchable for the tests
     run_in_thread = staticmethod(trio.to_thread.run_sync)
 
-    def __init__(self, path: Union[str, Path, trio.Path], vacuum_threshold: Optional[int] = None):
+    def __init__(
+        self,
+        path: Union[str, Path, trio.Path],
+        vacuum_threshold: Optional[int] = None,
+        read_pool_size: int = DEFAULT_READ_POOL_SIZE,
+    ):
         # Make sure only a single task access the connection object at a time
         self._lock = trio.Lock()
 
         # Those attributes are set by the `run` async context manager
         self._conn: Connection
 
+        # Read-only connections, allowing the read operations to run concurrently
+        # with the operations on the main connection. They are created lazily and
+        # each of them is used by a single task at a time.
+        self._read_conns: List[Connection] = []
+        self._read_limiter = trio.CapacityLimiter(read_pool_size)
+
+        # Mirror of the main connection transaction state, only updated while
+        # holding the lock so the read operations can check it without it
+        self._in_transaction = False
+
         self.path = trio.Path(path)
         self.vacuum_threshold = vacuum_threshold
 
     @classmethod
     @asynccontextmanager
     async def run(
-        cls, path: Union[str, Path], vacuum_threshold: Optional[int] = None
+        cls,
+        path: Union[str, Path],
+        vacuum_threshold: Optional[int] = None,
+        read_pool_size: int = DEFAULT_READ_POOL_SIZE,
     ) -> AsyncIterator["LocalDatabase"]:
         # Instanciate the local database
-        self = cls(path, vacuum_threshold)
+        self = cls(path, vacuum_threshold, read_pool_size)
 
         # Create the connection to the sqlite database
         try:
@@ -97,6 +118,7 @@ class LocalDatabase:
                 # Mark the local database as closed
                 finally:
                     del self._conn
+                    self._close_read_connections()
 
                 # Raise the dedicated operational error
                 raise FSLocalStorageOperationalError from exception
@@ -145,8 +167,10 @@ class LocalDatabase:
                 # Local database is not already closed
                 if not self._is_closed():
 
-                    # Close the sqlite3 connection
+                    # Close the sqlite3 connections, the main connection being the
+                    # last one so it can clean up the WAL files
                     try:
+                        self._close_read_connections()
                         await self.run_in_thread(self._conn.close)
 
                     # Mark the local database as closed
@@ -157,6 +181,7 @@ class LocalDatabase:
         # Close the local database if an operational error is detected
         async with self._manage_operational_error(allow_commit=True):
             await self.run_in_thread(self._conn.commit)
+        self._in_transaction = False
 
     def _is_closed(self) -> bool:
         return not hasattr(self, "_conn")
@@ -175,19 +200,81 @@ class LocalDatabase:
             # Check connection state
             self._check_open()
 
-            # Close the local database if an operational error is detected
-            async with self._manage_operational_error():
+            try:
+                # Close the local database if an operational error is detected
+                async with self._manage_operational_error():
+
+                    # Execute SQL commands
+                    cursor = self._conn.cursor()
+                    try:
+                        yield cursor
+                    finally:
+                        cursor.close()
+
+                # Commit the transaction when finished
+                if commit and self._conn.in_transaction:
+                    await self._commit()
+
+            # Keep track of the uncommitted changes
+            finally:
+                if not self._is_closed():
+                    self._in_transaction = self._conn.in_transaction
+
+    def _create_read_connection(self) -> Connection:
+        uri = Path(self.path).absolute().as_uri() + "?mode=ro"
+        # No transaction is needed since the connection is only used for reading
+        return sqlite_connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+
+    def _close_read_connections(self) -> None:
+        while self._read_conns:
+            self._read_conns.pop().close()
+
+    @asynccontextmanager
+    async def open_read_cursor(self) -> AsyncIterator[Cursor]:
+        """Open a cursor for read-only operations.
 
-                # Execute SQL commands
-                cursor = self._conn.cursor()
+        A read-only connection from the pool is used if possible, so the read doesn't
+        have to wait for the operations running on the main connection. However the
+        pending changes are only visible from the main connection, so it is used
+        instead when a transaction is in progress.
+        """
+        # Get a slot in the read-only connection pool
+        async with self._read_limiter:
+
+            # Check connection state
+            self._check_open()
+
+            # Some changes are not committed yet
+            if self._in_transaction:
+                async with self.open_cursor(commit=False) as cursor:
+                    yield cursor
+                return
+
+            # There is no checkpoint until the cursor is used, so no pending
+            # changes can appear in the meantime
+            conn = self._read_conns.pop() if self._read_conns else self._create_read_connection()
+
+            # Execute SQL commands
+            broken = False
+            try:
+                cursor = conn.cursor()
                 try:
                     yield cursor
                 finally:
                     cursor.close()
 
-            # Commit the transaction when finished
-            if commit and self._conn.in_transaction:
-                await self._commit()
+            # An operational error has been detected
+            except OperationalError as exception:
+                broken = True
+                raise FSLocalStorageOperationalError from exception
+
+            # Release the connection, unless it is broken or the local
+            # database has been closed in the meantime
+            finally:
+                if broken or self._is_closed():
+                    conn.close()
+                else:
+                    self._read_conns.append(conn)
 
     async def commit(self) -> None:
         # Lock the access to the connection object
@@ -2,20 +2,57 @@
 
 import re
 
+import attr
 import trio
+from collections import OrderedDict
 from pathlib import Path
 from structlog import get_logger
-from typing import Dict, Tuple, Set, Optional, Union, Pattern, AsyncIterator, AsyncContextManager
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    Set,
+    Optional,
+    Union,
+    Pattern,
+    AsyncIterator,
+    AsyncContextManager,
+)
 from async_generator import asynccontextmanager
 
-from parsec.core.fs.exceptions import FSLocalMissError, FSLocalStorageClosedError
+from parsec.core.fs.exceptions import (
+    FSLocalMissError,
+    FSLocalStorageClosedError,
+    FSLocalStorageOperationalError,
+)
 from parsec.core.types import EntryID, ChunkID, LocalDevice, BaseLocalManifest, BlockID
 from parsec.core.fs.storage.local_database import LocalDatabase, Cursor
+from parsec.core.fs.storage.chunk_storage import ChunkCache
 
 logger = get_logger()
 
 EMPTY_PATTERN = r"^\b$"  # Do not match anything (https://stackoverflow.com/a/2302992/2846140)
 
+# The manifests persisted concurrently share a single commit. The commit waits at
+# most this delay (in seconds) for the overlapping writes, unless the maximum number
+# of manifests for a single commit is reached first
+GROUP_COMMIT_DELAY = 0.005
+GROUP_COMMIT_MAX_SIZE = 32
+
+# Maximum number of deserialized manifests kept in memory
+DEFAULT_MANIFEST_CACHE_SIZE = 10000
+
+
+@attr.s(slots=True, auto_attribs=True)
+class GroupCommit:
+    """Manifests waiting for the same commit."""
+
+    entry_ids: Set[EntryID] = attr.ib(factory=set)
+    ready: trio.Event = attr.ib(factory=trio.Event)
+    done: trio.Event = attr.ib(factory=trio.Event)
+    started: bool = False
+    error: Optional[Exception] = None
+
 
 class ManifestStorage:
     """Persistent storage with cache for storing manifests.
@@ -23,14 +60,30 @@ class ManifestStorage:
     Also stores the checkpoint.
     """
 
-    def __init__(self, device: LocalDevice, localdb: LocalDatabase, realm_id: EntryID):
+    def __init__(
+        self,
+        device: LocalDevice,
+        localdb: LocalDatabase,
+        realm_id: EntryID,
+        chunk_cache: Optional[ChunkCache] = None,
+        cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
+    ):
         self.device = device
         self.localdb = localdb
         self.realm_id = realm_id
+        self.cache_size = cache_size
+
+        # The chunks removed along with a manifest have to be evicted
+        # from the decrypted chunks cache as well
+        self.chunk_cache = ChunkCache(max_size=0) if chunk_cache is None else chunk_cache
 
-        # This cache contains all the manifests that have been set or accessed
-        # since the last call to `clear_memory_cache`
-        self._cache: Dict[EntryID, BaseLocalManifest] = {}
+        # This cache contains the manifests that have been set or accessed
+        # since the last call to `clear_memory_cache`, the least recently used
+        # ones being evicted when the cache size is exceeded
+        self._cache: "OrderedDict[EntryID, BaseLocalManifest]" = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
 
         # This dictionnary keeps track of all the entry ids of the manifests
         # that have been added to the cache but still needs to be written to
@@ -40,6 +93,19 @@ class ManifestStorage:
         # still requires to be flushed.
         self._cache_ahead_of_localdb: Dict[EntryID, Set[Union[ChunkID, BlockID]]] = {}
 
+        # Entry ids of the manifests set in the cache with the `need_sync` flag,
+        # so that the need sync entries can be listed without going through the
+        # whole cache (the other ones are listed by the localdb)
+        self._cache_need_sync: Set[EntryID] = set()
+
+        # Group commit state: the group that new writes join, and the group
+        # each written manifest is waiting for
+        self._group_commit: Optional[GroupCommit] = None
+        self._uncommitted: Dict[EntryID, GroupCommit] = {}
+        # Writes and commits in progress, the next commit has to wait for them
+        self._pending_writes = 0
+        self._pending_commits = 0
+
     @property
     def path(self) -> Path:
         return Path(self.localdb.path)
@@ -47,9 +113,14 @@ class ManifestStorage:
     @classmethod
     @asynccontextmanager
     async def run(
-        cls, device: LocalDevice, localdb: LocalDatabase, realm_id: EntryID
+        cls,
+        device: LocalDevice,
+        localdb: LocalDatabase,
+        realm_id: EntryID,
+        chunk_cache: Optional[ChunkCache] = None,
+        cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
     ) -> AsyncIterator["ManifestStorage"]:
-        self = cls(device, localdb, realm_id)
+        self = cls(device, localdb, realm_id, chunk_cache, cache_size)
         await self._create_db()
         try:
             yield self
@@ -67,10 +138,14 @@ class ManifestStorage:
         # (unless they are purposely kept out of the local database)
         return self.localdb.open_cursor(commit=True)
 
+    def _open_read_cursor(self) -> AsyncContextManager[Cursor]:
+        return self.localdb.open_read_cursor()
+
     async def clear_memory_cache(self, flush: bool = True) -> None:
         if flush:
             await self._flush_cache_ahead_of_persistance()
         self._cache_ahead_of_localdb.clear()
+        self._cache_need_sync.clear()
         self._cache.clear()
 
     # Database initialization
@@ -89,6 +164,15 @@ class ManifestStorage:
                 );
                 """
             )
+            # Partial index covering the entries to synchronize, so that listing
+            # them doesn't require a full scan of the table
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS vlobs_need_sync
+                ON vlobs(vlob_id, need_sync, base_version, remote_version)
+                WHERE need_sync = 1 OR base_version != remote_version;
+                """
+            )
 
             # Singleton storing the checkpoint
             cursor.execute(
@@ -186,22 +270,27 @@ class ManifestStorage:
         Raises: Nothing !
         """
         remote_changes = set()
-        local_changes = {
-            entry_id for entry_id, manifest in self._cache.items() if manifest.need_sync
-        }
+        local_changes = set(self._cache_need_sync)
 
-        async with self._open_cursor() as cursor:
-            cursor.execute(
-                "SELECT vlob_id, need_sync, base_version, remote_version "
-                "FROM vlobs WHERE need_sync = 1 OR base_version != remote_version"
-            )
-            for manifest_id, need_sync, bv, rv in cursor.fetchall():
-                manifest_id = EntryID(manifest_id)
-                if need_sync:
-                    local_changes.add(manifest_id)
-                if bv != rv:
-                    remote_changes.add(manifest_id)
-            return local_changes, remote_changes
+        async with self._open_read_cursor() as cursor:
+
+            def _thread_target() -> List[Tuple[bytes, int, int, int]]:
+                cursor.execute(
+                    "SELECT vlob_id, need_sync, base_version, remote_version "
+                    "FROM vlobs WHERE need_sync = 1 OR base_version != remote_version"
+                )
+                return cursor.fetchall()
+
+            # Use a thread so the read doesn't block the trio loop
+            rows = await self.localdb.run_in_thread(_thread_target)
+
+        for manifest_id, need_sync, bv, rv in rows:
+            manifest_id = EntryID(manifest_id)
+            if need_sync:
+                local_changes.add(manifest_id)
+            if bv != rv:
+                remote_changes.add(manifest_id)
+        return local_changes, remote_changes
 
     # Manifest operations
 
@@ -212,14 +301,22 @@ class ManifestStorage:
         """
         # Look in cache first
         try:
-            return self._cache[entry_id]
+            self._cache.move_to_end(entry_id)
         except KeyError:
-            pass
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+            return self._cache[entry_id]
 
         # Look into the database
-        async with self._open_cursor() as cursor:
-            cursor.execute("SELECT blob FROM vlobs WHERE vlob_id = ?", (entry_id.bytes,))
-            manifest_row = cursor.fetchone()
+        async with self._open_read_cursor() as cursor:
+
+            def _thread_target() -> Optional[Tuple[bytes]]:
+                cursor.execute("SELECT blob FROM vlobs WHERE vlob_id = ?", (entry_id.bytes,))
+                return cursor.fetchone()
+
+            # Use a thread so several manifests can be fetched concurrently
+            manifest_row = await self.localdb.run_in_thread(_thread_target)
 
         # Not found
         if not manifest_row:
@@ -232,7 +329,9 @@ class ManifestStorage:
             )
 
         # Always return the cached value
-        return self._cache[entry_id]
+        manifest = self._cache[entry_id]
+        await self._evict_manifests()
+        return manifest
 
     async def set_manifest(
         self,
@@ -248,6 +347,11 @@ class ManifestStorage:
 
         # Set the cache first
         self._cache[entry_id] = manifest
+        self._cache.move_to_end(entry_id)
+        if manifest.need_sync:
+            self._cache_need_sync.add(entry_id)
+        else:
+            self._cache_need_sync.discard(entry_id)
 
         # Tag the entry as ahead of localdb
         self._cache_ahead_of_localdb.setdefault(entry_id, set())
@@ -260,20 +364,38 @@ class ManifestStorage:
         if not cache_only:
             await self._ensure_manifest_persistent(entry_id)
 
-    async def _ensure_manifest_persistent(self, entry_id: EntryID) -> None:
+        # Make room in the cache
+        await self._evict_manifests()
 
-        # Get cursor
-        async with self._open_cursor() as cursor:
+    async def _evict_manifests(self) -> None:
+        while len(self._cache) > self.cache_size:
+            entry_id = next(iter(self._cache))
+
+            # The manifest has to be flushed before being evicted, and might
+            # have been accessed or modified in the meantime
+            if entry_id in self._cache_ahead_of_localdb:
+                await self._ensure_manifest_persistent(entry_id)
+                continue
+
+            # The evicted manifest is listed by the need sync index of the localdb
+            del self._cache[entry_id]
+            self._cache_need_sync.discard(entry_id)
+            self.cache_evictions += 1
+
+    async def _write_manifest(self, entry_id: EntryID) -> bool:
+        """Write the manifest without committing, return False if it wasn't necessary."""
+
+        # Get cursor, the commit is performed by the caller
+        async with self.localdb.open_cursor(commit=False) as cursor:
 
             # Flushing is not necessary
             if entry_id not in self._cache_ahead_of_localdb:
-                return
+                return False
 
             # Safely get the manifest and other information
             manifest = self._cache[entry_id]
-            pending_chunks_ids = [
-                (chunk_id.bytes,) for chunk_id in self._cache_ahead_of_localdb[entry_id]
-            ]
+            pending_chunks = list(self._cache_ahead_of_localdb[entry_id])
+            pending_chunks_ids = [(chunk_id.bytes,) for chunk_id in pending_chunks]
             local_symkey = self.device.local_symkey
 
             def _thread_target() -> None:
@@ -307,9 +429,86 @@ class ManifestStorage:
             # Run CPU and IO expensive logic in a thread
             await self.localdb.run_in_thread(_thread_target)
 
+            # The cleaned chunks should not be served from memory either
+            for chunk_id in pending_chunks:
+                self.chunk_cache.discard(ChunkID(chunk_id))
+
         # Tag entry as up-to-date only if no new manifest has been written in the meantime
         if manifest == self._cache[entry_id]:
             self._cache_ahead_of_localdb.pop(entry_id)
+        return True
+
+    async def _ensure_manifest_persistent(self, entry_id: EntryID) -> None:
+        # Write the manifest and join the next commit
+        self._pending_writes += 1
+        try:
+            written = await self._write_manifest(entry_id)
+        finally:
+            self._pending_writes -= 1
+            self._notify_group_commit()
+        if written:
+            group = self._join_group_commit(entry_id)
+        # The manifest might have been written by a concurrent call, still waiting for the commit
+        else:
+            group = self._uncommitted.get(entry_id)
+
+        # Wait for the manifest to be committed
+        if group is not None:
+            await self._wait_group_commit(group)
+
+    def _join_group_commit(self, entry_id: EntryID) -> GroupCommit:
+        if self._group_commit is None:
+            self._group_commit = GroupCommit()
+        group = self._group_commit
+        group.entry_ids.add(entry_id)
+        self._uncommitted[entry_id] = group
+        if len(group.entry_ids) >= GROUP_COMMIT_MAX_SIZE:
+            group.ready.set()
+        return group
+
+    def _notify_group_commit(self) -> None:
+        # The next commit can start as soon as there are no overlapping writes
+        group = self._group_commit
+        if group is not None and not self._pending_writes and not self._pending_commits:
+            group.ready.set()
+
+    async def _wait_group_commit(self, group: GroupCommit) -> None:
+        # Another task is in charge of the commit
+        if group.started:
+            await group.done.wait()
+            if group.error is not None:
+                raise FSLocalStorageOperationalError from group.error
+            return
+
+        # The first task to wait is in charge of the commit. Shield it
+        # since the other tasks of the group rely on it.
+        group.started = True
+        with trio.CancelScope(shield=True):
+
+            # A lone write is committed right away, otherwise give some time
+            # to the overlapping writes to join the group
+            self._notify_group_commit()
+            with trio.move_on_after(GROUP_COMMIT_DELAY):
+                await group.ready.wait()
+
+            # Close the group, the next writes are part of the next commit
+            if self._group_commit is group:
+                self._group_commit = None
+
+            # Commit the whole group at once
+            self._pending_commits += 1
+            try:
+                await self.localdb.commit()
+            except Exception as exc:
+                group.error = exc
+                raise
+            finally:
+                self._pending_commits -= 1
+                for entry_id in group.entry_ids:
+                    if self._uncommitted.get(entry_id) is group:
+                        del self._uncommitted[entry_id]
+                group.done.set()
+                self._notify_group_commit()
 
     async def ensure_manifest_persistent(self, entry_id: EntryID) -> None:
         """
@@ -317,14 +516,19 @@ class ManifestStorage:
         """
         assert isinstance(entry_id, EntryID)
         # Flush if necessary
-        if entry_id in self._cache_ahead_of_localdb:
+        if entry_id in self._cache_ahead_of_localdb or entry_id in self._uncommitted:
             await self._ensure_manifest_persistent(entry_id)
 
     async def _flush_cache_ahead_of_persistance(self) -> None:
-        # Flush until the all the cache is gone
+        # Flushing is not necessary
+        if not self._cache_ahead_of_localdb:
+            return
+
+        # Write until the all the cache is gone, then commit once
         while self._cache_ahead_of_localdb:
             entry_id = next(iter(self._cache_ahead_of_localdb))
-            await self._ensure_manifest_persistent(entry_id)
+            await self._write_manifest(entry_id)
+        await self.localdb.commit()
 
     # This method is not used in the code base but it is still tested
     # as it might come handy in a cleanup routine later
@@ -339,6 +543,7 @@ class ManifestStorage:
 
             # Safely remove from cache
             in_cache = bool(self._cache.pop(entry_id, None))
+            self._cache_need_sync.discard(entry_id)
 
             # Remove from local database
             cursor.execute("DELETE FROM vlobs WHERE vlob_id = ?", (entry_id.bytes,))
@@ -350,6 +555,7 @@ class ManifestStorage:
             pending_chunk_ids = self._cache_ahead_of_localdb.pop(entry_id, ())
             for chunk_id in pending_chunk_ids:
                 cursor.execute("DELETE FROM chunks WHERE chunk_id = ?", (chunk_id.bytes,))
+                self.chunk_cache.discard(ChunkID(chunk_id))
 
         # Raise a miss if the entry wasn't found
         if not deleted and not in_cache:
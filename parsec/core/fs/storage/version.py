@@ -5,3 +5,4 @@ STORAGE_REVISION = 1
 USER_STORAGE_NAME = f"user_data-v{STORAGE_REVISION}.sqlite"
 WORKSPACE_DATA_STORAGE_NAME = f"workspace_data-v{STORAGE_REVISION}.sqlite"
 WORKSPACE_CACHE_STORAGE_NAME = f"workspace_cache-v{STORAGE_REVISION}.sqlite"
+WORKSPACE_BLOCKS_DIRECTORY_NAME = f"workspace_blocks-v{STORAGE_REVISION}"
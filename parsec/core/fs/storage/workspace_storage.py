@@ -1,8 +1,9 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import shutil
 from pathlib import Path
 from collections import defaultdict
-from typing import Dict, Tuple, Set, Optional, Union, AsyncIterator, NoReturn, Pattern
+from typing import Dict, Tuple, Set, Optional, Union, AsyncIterator, NoReturn, Pattern, Iterable
 
 import trio
 from trio import lowlevel
@@ -11,20 +12,38 @@ from structlog import get_logger
 from async_generator import asynccontextmanager
 
 from parsec.core.types import (
+    DEFAULT_BLOCK_SIZE,
     EntryID,
     BlockID,
     ChunkID,
+    BlockAccess,
     LocalDevice,
     FileDescriptor,
     BaseLocalManifest,
     LocalFileManifest,
 )
-from parsec.core.fs.exceptions import FSError, FSLocalMissError, FSInvalidFileDescriptor
+from parsec.utils import open_service_nursery
+from parsec.core.fs.exceptions import (
+    FSError,
+    FSLocalMissError,
+    FSInvalidFileDescriptor,
+    FSLocalStorageClosedError,
+)
 
 from parsec.core.fs.storage.local_database import LocalDatabase
-from parsec.core.fs.storage.manifest_storage import ManifestStorage
-from parsec.core.fs.storage.chunk_storage import ChunkStorage, BlockStorage
-from parsec.core.fs.storage.version import WORKSPACE_DATA_STORAGE_NAME, WORKSPACE_CACHE_STORAGE_NAME
+from parsec.core.fs.storage.manifest_storage import ManifestStorage, DEFAULT_MANIFEST_CACHE_SIZE
+from parsec.core.fs.storage.chunk_storage import (
+    ACCESSES_FLUSH_DELAY,
+    ChunkCache,
+    ChunkStorage,
+    BlockStorage,
+    FileBlockStorage,
+)
+from parsec.core.fs.storage.version import (
+    WORKSPACE_DATA_STORAGE_NAME,
+    WORKSPACE_CACHE_STORAGE_NAME,
+    WORKSPACE_BLOCKS_DIRECTORY_NAME,
+)
 
 
 logger = get_logger()
@@ -32,6 +51,8 @@ logger = get_logger()
 # TODO: should be in config.py
 DEFAULT_BLOCK_CACHE_SIZE = 512 * 1024 * 1024
 DEFAULT_CHUNK_VACUUM_THRESHOLD = 512 * 1024 * 1024
+# Decrypted chunks of data kept in memory by each workspace (i.e 32 MB)
+DEFAULT_CHUNK_MEMORY_CACHE_SIZE = 64 * DEFAULT_BLOCK_SIZE
 
 
 class BaseWorkspaceStorage:
@@ -44,7 +65,7 @@ class BaseWorkspaceStorage:
         device: LocalDevice,
         path: Path,
         workspace_id: EntryID,
-        block_storage: ChunkStorage,
+        block_storage: BlockStorage,
         chunk_storage: ChunkStorage,
     ):
         self.path = path
@@ -159,8 +180,23 @@ class BaseWorkspaceStorage:
     async def get_dirty_block(self, block_id: BlockID) -> bytes:
         return await self.chunk_storage.get_chunk(ChunkID(block_id))
 
+    async def get_deduplicated_block(self, digest: bytes) -> BlockAccess:
+        return await self.block_storage.get_deduplicated_block(digest)
+
+    async def set_deduplicated_block(self, digest: bytes, access: BlockAccess) -> None:
+        return await self.block_storage.set_deduplicated_block(digest, access)
+
     # Chunk interface
 
+    async def is_chunk(self, chunk_id: ChunkID) -> bool:
+        assert isinstance(chunk_id, ChunkID)
+        # The memory cache is shared between the chunk and block storages
+        if chunk_id in self.chunk_storage.chunk_cache:
+            return True
+        if await self.chunk_storage.is_chunk(chunk_id):
+            return True
+        return await self.block_storage.is_chunk(chunk_id)
+
     async def get_chunk(self, chunk_id: ChunkID) -> bytes:
         assert isinstance(chunk_id, ChunkID)
         try:
@@ -168,10 +204,25 @@ class BaseWorkspaceStorage:
         except FSLocalMissError:
             return await self.block_storage.get_chunk(chunk_id)
 
+    async def get_chunks(self, chunk_ids: Iterable[ChunkID]) -> Dict[ChunkID, bytes]:
+        """Return the data of the given chunks, the missing chunks being left out."""
+        chunk_ids = list(chunk_ids)
+        assert all(isinstance(chunk_id, ChunkID) for chunk_id in chunk_ids)
+        result = await self.chunk_storage.get_chunks(chunk_ids)
+        if len(result) < len(set(chunk_ids)):
+            missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in result]
+            result.update(await self.block_storage.get_chunks(missing))
+        return result
+
     async def set_chunk(self, chunk_id: ChunkID, block: bytes) -> None:
         assert isinstance(chunk_id, ChunkID)
         return await self.chunk_storage.set_chunk(chunk_id, block)
 
+    async def set_chunks(self, items: Iterable[Tuple[ChunkID, bytes]]) -> None:
+        items = list(items)
+        assert all(isinstance(chunk_id, ChunkID) for chunk_id, _ in items)
+        return await self.chunk_storage.set_chunks(items)
+
     async def clear_chunk(self, chunk_id: ChunkID, miss_ok: bool = False) -> None:
         assert isinstance(chunk_id, ChunkID)
         try:
@@ -180,6 +231,15 @@ class BaseWorkspaceStorage:
             if not miss_ok:
                 raise
 
+    async def clear_chunks(self, chunk_ids: Iterable[ChunkID], miss_ok: bool = False) -> None:
+        chunk_ids = list(chunk_ids)
+        assert all(isinstance(chunk_id, ChunkID) for chunk_id in chunk_ids)
+        try:
+            await self.chunk_storage.clear_chunks(chunk_ids)
+        except FSLocalMissError:
+            if not miss_ok:
+                raise
+
     # "Prevent sync" pattern interface
 
     def get_prevent_sync_pattern(self) -> Pattern[str]:
@@ -210,7 +270,7 @@ class WorkspaceStorage(BaseWorkspaceStorage):
         workspace_id: EntryID,
         data_localdb: LocalDatabase,
         cache_localdb: LocalDatabase,
-        block_storage: ChunkStorage,
+        block_storage: BlockStorage,
         chunk_storage: ChunkStorage,
         manifest_storage: ManifestStorage,
     ):
@@ -228,9 +288,16 @@ class WorkspaceStorage(BaseWorkspaceStorage):
         workspace_id: EntryID,
         cache_size: int = DEFAULT_BLOCK_CACHE_SIZE,
         vacuum_threshold: int = DEFAULT_CHUNK_VACUUM_THRESHOLD,
+        memory_cache_size: int = DEFAULT_CHUNK_MEMORY_CACHE_SIZE,
+        block_files: bool = False,
+        manifest_cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
     ) -> AsyncIterator["WorkspaceStorage"]:
         data_path = path / WORKSPACE_DATA_STORAGE_NAME
         cache_path = path / WORKSPACE_CACHE_STORAGE_NAME
+        blocks_path = path / WORKSPACE_BLOCKS_DIRECTORY_NAME
+
+        # Decrypted chunks cache, shared by the block and chunk storages
+        chunk_cache = ChunkCache(max_size=memory_cache_size)
 
         # Local cache storage service
         async with LocalDatabase.run(cache_path) as cache_localdb:
@@ -240,18 +307,37 @@ class WorkspaceStorage(BaseWorkspaceStorage):
                 data_path, vacuum_threshold=vacuum_threshold
             ) as data_localdb:
 
-                # Block storage service
-                async with BlockStorage.run(
-                    device, cache_localdb, cache_size=cache_size
-                ) as block_storage:
+                # Block storage service, either storing the blocks as files or in the database
+                if block_files:
+                    block_storage_manager = FileBlockStorage.run(
+                        device,
+                        cache_localdb,
+                        blocks_path,
+                        cache_size=cache_size,
+                        chunk_cache=chunk_cache,
+                    )
+                else:
+                    # Remove the block files left by the other backend, if any
+                    await FileBlockStorage.run_in_thread(shutil.rmtree, blocks_path, True)
+                    block_storage_manager = BlockStorage.run(
+                        device, cache_localdb, cache_size=cache_size, chunk_cache=chunk_cache
+                    )
+
+                async with block_storage_manager as block_storage:
 
                     # Manifest storage service
                     async with ManifestStorage.run(
-                        device, data_localdb, workspace_id
+                        device,
+                        data_localdb,
+                        workspace_id,
+                        chunk_cache=chunk_cache,
+                        cache_size=manifest_cache_size,
                     ) as manifest_storage:
 
                         # Chunk storage service
-                        async with ChunkStorage.run(device, data_localdb) as chunk_storage:
+                        async with ChunkStorage.run(
+                            device, data_localdb, chunk_cache=chunk_cache
+                        ) as chunk_storage:
 
                             # Instanciate workspace storage
                             instance = cls(
@@ -268,11 +354,27 @@ class WorkspaceStorage(BaseWorkspaceStorage):
                             # Load "prevent sync" pattern
                             await instance._load_prevent_sync_pattern()
 
-                            # Yield point
-                            yield instance
+                            async with open_service_nursery() as nursery:
+                                nursery.start_soon(instance._run_accesses_flusher)
+
+                                # Yield point
+                                yield instance
+
+                                nursery.cancel_scope.cancel()
 
     # Helpers
 
+    async def _run_accesses_flusher(self) -> None:
+        # The chunk access timestamps are only kept in memory when reading
+        try:
+            while True:
+                await trio.sleep(ACCESSES_FLUSH_DELAY)
+                await self.block_storage.flush_accesses()
+                await self.chunk_storage.flush_accesses()
+        # Ignore storage closed exceptions, since it follows an operational error
+        except FSLocalStorageClosedError:
+            pass
+
     async def clear_memory_cache(self, flush: bool = True) -> None:
         await self.manifest_storage.clear_memory_cache(flush=flush)
 
@@ -384,9 +486,15 @@ class WorkspaceStorageTimestamped(BaseWorkspaceStorage):
     async def set_chunk(self, chunk_id: ChunkID, block: bytes) -> NoReturn:
         self._throw_permission_error()
 
+    async def set_chunks(self, items: Iterable[Tuple[ChunkID, bytes]]) -> NoReturn:
+        self._throw_permission_error()
+
     async def clear_chunk(self, chunk_id: ChunkID, miss_ok: bool = False) -> NoReturn:
         self._throw_permission_error()
 
+    async def clear_chunks(self, chunk_ids: Iterable[ChunkID], miss_ok: bool = False) -> NoReturn:
+        self._throw_permission_error()
+
     async def clear_manifest(self, entry_id: EntryID) -> NoReturn:
         self._throw_permission_error()
 
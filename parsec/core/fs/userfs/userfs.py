@@ -6,6 +6,7 @@ from trio_typing import TaskStatus
 from pendulum import DateTime, now as pendulum_now
 from typing import (
     Tuple,
+    FrozenSet,
     Optional,
     Union,
     Dict,
@@ -55,8 +56,14 @@ from parsec.core.backend_connection import (
 from parsec.core.remote_devices_manager import RemoteDevicesManager
 
 from parsec.core.fs.workspacefs import WorkspaceFS
+from parsec.core.fs.workspacefs.read_ahead import DEFAULT_READ_AHEAD_WINDOW
+from parsec.core.fs.workspacefs.write_buffer import DEFAULT_WRITE_BUFFER_SIZE
 from parsec.core.fs.remote_loader import UserRemoteLoader
 from parsec.core.fs.storage import UserStorage, WorkspaceStorage
+from parsec.core.fs.storage.workspace_storage import (
+    DEFAULT_CHUNK_MEMORY_CACHE_SIZE,
+    DEFAULT_MANIFEST_CACHE_SIZE,
+)
 from parsec.core.fs.userfs.merging import merge_local_user_manifests, merge_workspace_entry
 from parsec.core.fs.exceptions import (
     FSError,
@@ -174,6 +181,13 @@ class UserFS:
         remote_devices_manager: RemoteDevicesManager,
         event_bus: EventBus,
         prevent_sync_pattern: Pattern[str],
+        workspace_storage_memory_cache_size: int = DEFAULT_CHUNK_MEMORY_CACHE_SIZE,
+        workspace_storage_block_files: bool = False,
+        workspace_storage_manifest_cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
+        workspace_read_ahead_window: int = DEFAULT_READ_AHEAD_WINDOW,
+        workspace_write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+        workspace_upload_max_concurrency: Optional[int] = None,
+        deduplicated_workspaces: FrozenSet[EntryID] = frozenset(),
     ):
         self.device = device
         self.path = path
@@ -181,6 +195,13 @@ class UserFS:
         self.remote_devices_manager = remote_devices_manager
         self.event_bus = event_bus
         self.prevent_sync_pattern = prevent_sync_pattern
+        self.workspace_storage_memory_cache_size = workspace_storage_memory_cache_size
+        self.workspace_storage_block_files = workspace_storage_block_files
+        self.workspace_storage_manifest_cache_size = workspace_storage_manifest_cache_size
+        self.workspace_read_ahead_window = workspace_read_ahead_window
+        self.workspace_write_buffer_size = workspace_write_buffer_size
+        self.workspace_upload_max_concurrency = workspace_upload_max_concurrency
+        self.deduplicated_workspaces = deduplicated_workspaces
 
         self.storage: UserStorage  # Setup by UserStorage.run factory
 
@@ -224,9 +245,28 @@ class UserFS:
         remote_devices_manager: RemoteDevicesManager,
         event_bus: EventBus,
         prevent_sync_pattern: Pattern[str],
+        workspace_storage_memory_cache_size: int = DEFAULT_CHUNK_MEMORY_CACHE_SIZE,
+        workspace_storage_block_files: bool = False,
+        workspace_storage_manifest_cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
+        workspace_read_ahead_window: int = DEFAULT_READ_AHEAD_WINDOW,
+        workspace_write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+        workspace_upload_max_concurrency: Optional[int] = None,
+        deduplicated_workspaces: FrozenSet[EntryID] = frozenset(),
     ) -> AsyncIterator[UserFSTypeVar]:
         self = cls(
-            device, path, backend_cmds, remote_devices_manager, event_bus, prevent_sync_pattern
+            device,
+            path,
+            backend_cmds,
+            remote_devices_manager,
+            event_bus,
+            prevent_sync_pattern,
+            workspace_storage_memory_cache_size=workspace_storage_memory_cache_size,
+            workspace_storage_block_files=workspace_storage_block_files,
+            workspace_storage_manifest_cache_size=workspace_storage_manifest_cache_size,
+            workspace_read_ahead_window=workspace_read_ahead_window,
+            workspace_write_buffer_size=workspace_write_buffer_size,
+            workspace_upload_max_concurrency=workspace_upload_max_concurrency,
+            deduplicated_workspaces=deduplicated_workspaces,
         )
 
         # Run user storage
@@ -242,7 +282,21 @@ class UserFS:
                 for workspace_entry in self.get_user_manifest().workspaces:
                     await self._load_workspace(workspace_entry.id)
 
-                yield self
+                try:
+                    yield self
+
+                # Write the data still buffered by the open files, even when cancelled
+                finally:
+                    with trio.CancelScope(shield=True):
+                        for workspace in self._workspace_storages.values():
+                            try:
+                                await workspace.transactions.flush_write_buffers()
+                            except FSError as exc:
+                                logger.warning(
+                                    "Cannot flush the write buffers",
+                                    workspace_id=workspace.workspace_id,
+                                    reason=exc,
+                                )
 
                 # Stop the workspace storages
                 self._workspace_storage_nursery.cancel_scope.cancel()
@@ -278,9 +332,16 @@ class UserFS:
         path = self.path / str(workspace_id)
 
         async def workspace_storage_task(
-            task_status: TaskStatus[WorkspaceStorage] = trio.TASK_STATUS_IGNORED
+            task_status: TaskStatus[WorkspaceStorage] = trio.TASK_STATUS_IGNORED,
         ) -> None:
-            async with WorkspaceStorage.run(self.device, path, workspace_id) as workspace_storage:
+            async with WorkspaceStorage.run(
+                self.device,
+                path,
+                workspace_id,
+                memory_cache_size=self.workspace_storage_memory_cache_size,
+                block_files=self.workspace_storage_block_files,
+                manifest_cache_size=self.workspace_storage_manifest_cache_size,
+            ) as workspace_storage:
                 task_status.started(workspace_storage)
                 await trio.sleep_forever()
 
@@ -328,6 +389,12 @@ class UserFS:
             backend_cmds=self.backend_cmds,
             event_bus=self.event_bus,
             remote_devices_manager=self.remote_devices_manager,
+            # Read-ahead and write flushing tasks live alongside the workspace storage
+            background_nursery=self._workspace_storage_nursery,
+            read_ahead_window=self.workspace_read_ahead_window,
+            write_buffer_size=self.workspace_write_buffer_size,
+            upload_max_concurrency=self.workspace_upload_max_concurrency,
+            deduplicate_blocks=workspace_id in self.deduplicated_workspaces,
         )
 
         # Apply the current "prevent sync" pattern
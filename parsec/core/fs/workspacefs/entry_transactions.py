@@ -71,6 +71,11 @@ class EntryTransactions(FileTransactions):
                     prevent_sync_pattern=self.local_storage.get_prevent_sync_pattern(),
                 )
                 await self.local_storage.set_manifest(entry_id, local_manifest)
+
+            # Make the data buffered by the file descriptors part of the manifest
+            if isinstance(local_manifest, LocalFileManifest):
+                local_manifest = await self._manifest_flush_write_buffers(local_manifest)
+
             yield local_manifest
 
     async def _load_manifest(self, entry_id: EntryID) -> BaseLocalManifest:
@@ -147,8 +147,8 @@ def prepare_write(
         size += padding
         offset = manifest.size
 
-    # Copy buffers
-    blocks = list(manifest.blocks)
+    # Persistent blocks, only the written ones are copied
+    blocks = manifest.blocks
 
     # Loop over blocks
     for block, subsize, start, content_offset in split_write(size, offset, manifest.blocksize):
@@ -163,14 +163,11 @@ def prepare_write(
 
         # Update data structures
         removed_ids |= more_removed_ids
-        if len(blocks) == block:
-            blocks.append(new_chunks)
-        else:
-            blocks[block] = new_chunks
+        blocks = blocks.set(block, new_chunks)
 
     # Evolve manifest
     new_size = max(manifest.size, offset + size)
-    new_manifest = manifest.evolve_and_mark_updated(size=new_size, blocks=tuple(blocks))
+    new_manifest = manifest.evolve_and_mark_updated(size=new_size, blocks=blocks)
 
     # Return write result
     return new_manifest, write_operations, removed_ids
@@ -187,14 +184,14 @@ def prepare_truncate(
     removed_ids = chunk_id_set(manifest.blocks[block])
 
     # Truncate buffers
-    blocks = manifest.blocks[:block]
+    blocks = manifest.blocks.truncate(block)
     if remainder:
         chunks = manifest.blocks[block]
         stop_index = index_of_chunk_after_stop(chunks, size)
         last_chunk = chunks[stop_index - 1]
         chunks = chunks[: stop_index - 1]
         chunks += (last_chunk.evolve(stop=size),)
-        blocks += (chunks,)
+        blocks = blocks.set(block, chunks)
         removed_ids -= chunk_id_set(chunks)
 
     # Clean up
@@ -228,16 +225,10 @@ def prepare_reshape(
     def update_manifest(
         block: int, manifest: LocalFileManifest, new_chunk: Chunk
     ) -> LocalFileManifest:
-        blocks = list(manifest.blocks)
-        blocks[block] = (new_chunk,)
-        return manifest.evolve(blocks=tuple(blocks))
+        return manifest.evolve(blocks=manifest.blocks.set(block, (new_chunk,)))
 
-    # Loop over blocks
-    for block, chunks in enumerate(manifest.blocks):
-
-        # Already a block
-        if len(chunks) == 1 and chunks[0].is_block:
-            continue
+    # Loop over the blocks that are not a single block chunk yet
+    for block, chunks in manifest.blocks.iter_not_reshaped():
 
         # Update callback
         block_update = partial(update_manifest, block)
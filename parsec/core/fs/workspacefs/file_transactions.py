@@ -3,6 +3,8 @@
 from parsec.core.core_events import CoreEvent
 from typing import Tuple, List, Callable, Dict, Optional, cast, AsyncIterator
 
+import trio
+from pendulum import DateTime
 from collections import defaultdict
 from async_generator import asynccontextmanager
 
@@ -11,7 +13,12 @@ from parsec.core.types import FileDescriptor, EntryID, LocalDevice
 
 from parsec.core.fs.remote_loader import RemoteLoader
 from parsec.core.fs.storage import BaseWorkspaceStorage
-from parsec.core.fs.exceptions import FSLocalMissError, FSInvalidFileDescriptor, FSEndOfFileError
+from parsec.core.fs.exceptions import (
+    FSError,
+    FSLocalMissError,
+    FSInvalidFileDescriptor,
+    FSEndOfFileError,
+)
 
 from parsec.core.types import (
     Chunk,
@@ -22,11 +29,20 @@ from parsec.core.types import (
     LocalWorkspaceManifest,
 )
 from parsec.core.fs.workspacefs.file_operations import (
+    ChunkIDSet,
+    WriteOperationList,
     prepare_read,
     prepare_write,
     prepare_resize,
     prepare_reshape,
 )
+from parsec.core.fs.workspacefs.read_ahead import DEFAULT_READ_AHEAD_WINDOW, ReadAhead
+from parsec.core.fs.workspacefs.write_buffer import (
+    DEFAULT_WRITE_BUFFER_SIZE,
+    WRITE_BUFFER_FLUSH_DELAY,
+    WriteBuffer,
+    WriteBuffers,
+)
 from parsec.api.data import BlockAccess
 
 
@@ -73,6 +89,24 @@ class FileTransactions:
     - truncate -> affects file size and possibly file content
     - read     -> no side effect
     - flush    -> no-op
+
+    Sequential reads are detected in order to fetch the next blocks in the
+    background (see `ReadAhead`), provided a nursery is available to do so.
+
+    Contiguous writes are buffered in memory (see `WriteBuffers`) and only
+    reach the local storage once a block is complete, so most blocks are written
+    once and never reshaped. The remaining data is flushed before any other
+    access to the file, when the file descriptor is flushed or closed, when too
+    much data is buffered or after a short delay.
+
+    Once a block worth of data has been written, the file gets reshaped in the
+    background (provided a nursery is available to do so) in order to keep the
+    write latency flat. The blocks are built without holding the lock, which is
+    only taken to swap them in the manifest if their chunks didn't change in
+    the meantime. Flushing or synchronizing the file still reshapes it right away.
+
+    When the block deduplication is enabled for the workspace, the reshaped
+    blocks reuse the access of an uploaded block with the same content, if any.
     """
 
     def __init__(
@@ -83,6 +117,9 @@ class FileTransactions:
         local_storage: BaseWorkspaceStorage,
         remote_loader: RemoteLoader,
         event_bus: EventBus,
+        background_nursery: Optional[trio.Nursery] = None,
+        read_ahead_window: int = DEFAULT_READ_AHEAD_WINDOW,
+        write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
     ):
         self.workspace_id = workspace_id
         self.get_workspace_entry = get_workspace_entry
@@ -90,7 +127,15 @@ class FileTransactions:
         self.local_storage = local_storage
         self.remote_loader = remote_loader
         self.event_bus = event_bus
+        self.background_nursery = background_nursery
         self._write_count: Dict[FileDescriptor, int] = defaultdict(int)
+        self._write_buffers = WriteBuffers(write_buffer_size)
+        # Ordered set of the entries to reshape in the background
+        self._reshape_queue: Dict[EntryID, None] = {}
+        self._reshape_worker_running = False
+        self._read_ahead = ReadAhead(
+            local_storage, remote_loader, background_nursery, read_ahead_window
+        )
 
     # Event helper
 
@@ -99,38 +144,62 @@ class FileTransactions:
 
     # Helper
 
-    async def _read_chunk(self, chunk: Chunk) -> bytes:
-        data = await self.local_storage.get_chunk(chunk.id)
-        return data[chunk.start - chunk.raw_offset : chunk.stop - chunk.raw_offset]
+    def _chunk_view(self, chunk: Chunk, data: bytes) -> memoryview:
+        # Slicing a memoryview doesn't copy the underlying data
+        return memoryview(data)[chunk.start - chunk.raw_offset : chunk.stop - chunk.raw_offset]
 
     async def _write_chunk(self, chunk: Chunk, content: bytes, offset: int = 0) -> int:
-        data = padded_data(content, offset, offset + chunk.stop - chunk.start)
-        await self.local_storage.set_chunk(chunk.id, data)
-        return len(data)
-
-    async def _build_data(self, chunks: Tuple[Chunk, ...]) -> Tuple[bytes, List[BlockAccess]]:
+        return await self._write_chunks([(chunk, offset)], content)
+
+    async def _write_chunks(self, write_operations: WriteOperationList, content: bytes) -> int:
+        # Write all the chunks at once
+        items = [
+            (chunk.id, padded_data(content, offset, offset + chunk.stop - chunk.start))
+            for chunk, offset in write_operations
+        ]
+        await self.local_storage.set_chunks(items)
+        return sum(len(data) for _, data in items)
+
+    async def _build_data(self, chunks: Tuple[Chunk, ...]) -> Tuple[memoryview, List[BlockAccess]]:
         # Empty array
         if not chunks:
-            return bytearray(), []
+            return memoryview(b""), []
 
-        # Build byte array
+        # Fetch all the chunks at once
+        chunks_data = await self.local_storage.get_chunks([chunk.id for chunk in chunks])
         missing = []
-        start, stop = chunks[0].start, chunks[-1].stop
-        result = bytearray(stop - start)
         for chunk in chunks:
-            try:
-                result[chunk.start - start : chunk.stop - start] = await self._read_chunk(chunk)
-            except FSLocalMissError:
-                assert chunk.access is not None
+            if chunk.id not in chunks_data:
+                # Only the blocks can be fetched from the remote
+                if chunk.access is None:
+                    raise FSLocalMissError(chunk.id)
                 missing.append(chunk.access)
 
+        # Some blocks have to be downloaded first
+        if missing:
+            return memoryview(b""), missing
+
+        # Single chunk, return a view on its data without any copy
+        if len(chunks) == 1:
+            return self._chunk_view(chunks[0], chunks_data[chunks[0].id]), []
+
+        # Build byte array, copying each chunk exactly once
+        start, stop = chunks[0].start, chunks[-1].stop
+        result = memoryview(bytearray(stop - start))
+        for chunk in chunks:
+            result[chunk.start - start : chunk.stop - start] = self._chunk_view(
+                chunk, chunks_data[chunk.id]
+            )
+
         # Return byte array
         return result, missing
 
     # Locking helper
 
     @asynccontextmanager
-    async def _load_and_lock_file(self, fd: FileDescriptor) -> AsyncIterator[LocalFileManifest]:
+    async def _load_and_lock_file(
+        self, fd: FileDescriptor, flush_write_buffers: bool = True
+    ) -> AsyncIterator[LocalFileManifest]:
         # The FSLocalMissError exception is not considered here.
         # This is because we should be able to assume that the manifest
         # corresponding to valid file descriptor is always available locally
@@ -140,7 +209,20 @@ class FileTransactions:
 
         # Lock the entry_id
         async with self.local_storage.lock_manifest(manifest.id):
-            yield await self.local_storage.load_file_descriptor(fd)
+            manifest = await self.local_storage.load_file_descriptor(fd)
+
+            # Make the buffered data part of the manifest
+            if flush_write_buffers:
+                manifest = await self._manifest_flush_write_buffers(manifest)
+
+            yield manifest
+
+    async def _load_file(self, fd: FileDescriptor) -> LocalFileManifest:
+        manifest = await self.local_storage.load_file_descriptor(fd)
+        if not self._write_buffers.get_fds(manifest.id):
+            return manifest
+        await self.flush_write_buffers(manifest.id)
+        return await self.local_storage.load_file_descriptor(fd)
 
     # Confinement helper
 
@@ -180,11 +262,11 @@ class FileTransactions:
     # Atomic transactions
 
     async def fd_size(self, fd: FileDescriptor) -> int:
-        manifest = await self.local_storage.load_file_descriptor(fd)
+        manifest = await self._load_file(fd)
         return manifest.size
 
     async def fd_info(self, fd: FileDescriptor) -> Dict[str, object]:
-        manifest = await self.local_storage.load_file_descriptor(fd)
+        manifest = await self._load_file(fd)
         stats = manifest.to_stats()
         stats["confinement_point"] = await self._get_confinement_point(manifest.id)
         return stats
@@ -199,18 +281,29 @@ class FileTransactions:
             # Atomic change
             self.local_storage.remove_file_descriptor(fd)
 
-            # Clear write count
+            # Clear write count, write buffer and read pattern
             self._write_count.pop(fd, None)
+            self._write_buffers.remove(fd)
+            self._read_ahead.discard(fd)
 
     async def fd_write(
         self, fd: FileDescriptor, content: bytes, offset: int, constrained: bool = False
     ) -> int:
-        # Fetch and lock
-        async with self._load_and_lock_file(fd) as manifest:
+        # Fetch and lock, the buffer of the file descriptor is kept
+        async with self._load_and_lock_file(fd, flush_write_buffers=False) as manifest:
+
+            # The other file descriptors might have written the same area
+            for other_fd in self._write_buffers.get_fds(manifest.id):
+                if other_fd != fd:
+                    manifest = await self._manifest_flush_write_buffer(other_fd, manifest)
+
+            # The buffered data might extend the file
+            buffer = self._write_buffers.get(fd)
+            size = manifest.size if buffer is None else max(manifest.size, buffer.stop)
 
             # Constrained - truncate content to the right length
             if constrained:
-                end_offset = min(manifest.size, offset + len(content))
+                end_offset = min(size, offset + len(content))
                 length = max(end_offset - offset, 0)
                 content = content[:length]
 
@@ -218,23 +311,19 @@ class FileTransactions:
             if not content:
                 return 0
 
-            # Prepare
-            offset = normalize_argument(offset, manifest)
-            manifest, write_operations, removed_ids = prepare_write(manifest, len(content), offset)
+            # Normalize
+            offset = size if offset < 0 else offset
 
-            # Writing
-            for chunk, offset in write_operations:
-                self._write_count[fd] += await self._write_chunk(chunk, content, offset)
+            # Buffering is disabled
+            if not self._write_buffers.enabled:
+                manifest = await self._manifest_write(fd, manifest, content, offset)
 
-            # Atomic change
-            await self.local_storage.set_manifest(
-                manifest.id, manifest, cache_only=True, removed_ids=removed_ids
-            )
+            # Buffer the content
+            else:
+                manifest = await self._manifest_buffer_write(fd, manifest, content, offset)
 
-            # Reshaping
-            if self._write_count[fd] >= manifest.blocksize:
-                await self._manifest_reshape(manifest, cache_only=True)
-                self._write_count.pop(fd, None)
+        # Write the oldest buffers if too much data is buffered
+        await self._flush_overflowing_write_buffers()
 
         # Notify
         self._send_event(CoreEvent.FS_ENTRY_UPDATED, id=manifest.id)
@@ -256,7 +345,7 @@ class FileTransactions:
 
     async def fd_read(
         self, fd: FileDescriptor, size: int, offset: int, raise_eof: bool = False
-    ) -> bytes:
+    ) -> memoryview:
         # Loop over attemps
         missing: List[BlockAccess] = []
         while True:
@@ -277,10 +366,16 @@ class FileTransactions:
 
                 # No-op
                 if offset > manifest.size:
-                    return b""
+                    return memoryview(b"")
 
                 # Prepare
                 chunks = prepare_read(manifest, size, offset)
+
+                # Fetch the next blocks in the background
+                if not missing:
+                    stop = min(offset + size, manifest.size)
+                    self._read_ahead.record_read(fd, manifest, offset, stop)
+
                 data, missing = await self._build_data(chunks)
 
                 # Return the data
@@ -292,8 +387,134 @@ class FileTransactions:
             await self._manifest_reshape(manifest)
             await self.local_storage.ensure_manifest_persistent(manifest.id)
 
+    # Write buffers
+
+    async def flush_write_buffers(self, entry_id: Optional[EntryID] = None) -> None:
+        """Write the buffered data of the given entry (or of all the entries)
+        to the local storage.
+        """
+        entry_ids = self._write_buffers.get_entry_ids() if entry_id is None else [entry_id]
+        for buffered_entry_id in entry_ids:
+            if not self._write_buffers.get_fds(buffered_entry_id):
+                continue
+            async with self.local_storage.lock_manifest(buffered_entry_id) as manifest:
+                assert isinstance(manifest, LocalFileManifest)
+                await self._manifest_flush_write_buffers(manifest)
+
+    async def _flush_overflowing_write_buffers(self) -> None:
+        entry_ids = self._write_buffers.get_overflowing_entry_ids()
+        for entry_id in self._write_buffers.get_stale_entry_ids(trio.current_time()):
+            if entry_id not in entry_ids:
+                entry_ids.append(entry_id)
+        for entry_id in entry_ids:
+            await self.flush_write_buffers(entry_id)
+
+    async def _flush_write_buffer_later(self, fd: FileDescriptor, buffer: WriteBuffer) -> None:
+        # The buffer is replaced or removed once flushed
+        while self._write_buffers.get(fd) is buffer:
+            delay = buffer.created_on + WRITE_BUFFER_FLUSH_DELAY - trio.current_time()
+            if delay > 0:
+                await trio.sleep(delay)
+                continue
+            # The data stays buffered in case of error, the next
+            # operation on the file descriptor is going to try again
+            try:
+                await self.flush_write_buffers(buffer.entry_id)
+            except FSError:
+                pass
+            return
+
     # Transaction helpers
 
+    async def _manifest_write(
+        self,
+        fd: FileDescriptor,
+        manifest: LocalFileManifest,
+        content: bytes,
+        offset: int,
+        updated: Optional[DateTime] = None,
+    ) -> LocalFileManifest:
+        """This internal helper does not perform any locking."""
+        # Prepare
+        previously_updated = manifest.updated
+        manifest, write_operations, removed_ids = prepare_write(manifest, len(content), offset)
+
+        # Buffered data, keep the time of the actual write
+        if updated is not None:
+            manifest = manifest.evolve(updated=max(updated, previously_updated))
+
+        # Writing
+        self._write_count[fd] += await self._write_chunks(write_operations, content)
+
+        # Atomic change
+        await self.local_storage.set_manifest(
+            manifest.id, manifest, cache_only=True, removed_ids=removed_ids
+        )
+
+        # Reshaping
+        if self._write_count[fd] >= manifest.blocksize:
+            self._write_count.pop(fd, None)
+            if self.background_nursery is not None:
+                self._schedule_reshape(manifest.id)
+            else:
+                await self._manifest_reshape(manifest, cache_only=True)
+                manifest = cast(
+                    LocalFileManifest, await self.local_storage.get_manifest(manifest.id)
+                )
+
+        return manifest
+
+    async def _manifest_buffer_write(
+        self, fd: FileDescriptor, manifest: LocalFileManifest, content: bytes, offset: int
+    ) -> LocalFileManifest:
+        """This internal helper does not perform any locking."""
+        # Non-contiguous write, start a new buffer
+        buffer = self._write_buffers.get(fd)
+        if buffer is not None and buffer.stop != offset:
+            manifest = await self._manifest_flush_write_buffer(fd, manifest)
+            buffer = None
+
+        # Buffer the content
+        if buffer is None:
+            buffer = WriteBuffer(manifest.id, offset, bytearray(content))
+            self._write_buffers.add(fd, buffer)
+            if self.background_nursery is not None:
+                self.background_nursery.start_soon(self._flush_write_buffer_later, fd, buffer)
+        else:
+            self._write_buffers.extend(fd, content)
+
+        # Write the complete blocks right away
+        length = buffer.stop - buffer.stop % manifest.blocksize - buffer.start
+        if length > 0:
+            data = bytes(buffer.data[:length])
+            manifest = await self._manifest_write(
+                fd, manifest, data, buffer.start, updated=buffer.updated
+            )
+            self._write_buffers.consume(fd, length)
+            if not buffer.data:
+                self._write_buffers.remove(fd)
+
+        return manifest
+
+    async def _manifest_flush_write_buffer(
+        self, fd: FileDescriptor, manifest: LocalFileManifest
+    ) -> LocalFileManifest:
+        """This internal helper does not perform any locking."""
+        buffer = self._write_buffers.get(fd)
+        if buffer is None:
+            return manifest
+        manifest = await self._manifest_write(
+            fd, manifest, bytes(buffer.data), buffer.start, updated=buffer.updated
+        )
+        self._write_buffers.remove(fd)
+        return manifest
+
+    async def _manifest_flush_write_buffers(self, manifest: LocalFileManifest) -> LocalFileManifest:
+        """This internal helper does not perform any locking."""
+        for fd in self._write_buffers.get_fds(manifest.id):
+            manifest = await self._manifest_flush_write_buffer(fd, manifest)
+        return manifest
+
     async def _manifest_resize(
         self, manifest: LocalFileManifest, length: int, cache_only: bool = False
     ) -> None:
@@ -306,8 +527,7 @@ class FileTransactions:
         manifest, write_operations, removed_ids = prepare_resize(manifest, length)
 
         # Writing
-        for chunk, offset in write_operations:
-            await self._write_chunk(chunk, b"", offset)
+        await self._write_chunks(write_operations, b"")
 
         # Atomic change
         await self.local_storage.set_manifest(
@@ -333,10 +553,8 @@ class FileTransactions:
                 missing += extra_missing
                 continue
 
-            # Write data if necessary
-            new_chunk = destination.evolve_as_block(data)
-            if source != (destination,):
-                await self._write_chunk(new_chunk, data)
+            # Build the new block
+            new_chunk, removed_ids = await self._build_block(data, source, destination, removed_ids)
 
             # Craft the new manifest
             manifest = update(manifest, new_chunk)
@@ -352,3 +570,92 @@ class FileTransactions:
 
         # Return missing block ids
         return missing
+
+    async def _build_block(
+        self,
+        data: memoryview,
+        source: Tuple[Chunk, ...],
+        destination: Chunk,
+        removed_ids: ChunkIDSet,
+    ) -> Tuple[Chunk, ChunkIDSet]:
+        """This internal helper does not perform any locking."""
+
+        # Reuse an uploaded block with the same content, if any
+        access = await self.remote_loader.find_deduplicated_block(data)
+        if access is not None:
+            new_chunk = Chunk.from_block_acess(access.evolve(offset=destination.start))
+            await self.local_storage.set_clean_block(access.id, data)
+            if source == (destination,):
+                removed_ids = removed_ids | {destination.id}
+
+        # Write data if necessary
+        else:
+            new_chunk = destination.evolve_as_block(data)
+            if source != (destination,):
+                await self._write_chunk(new_chunk, data)
+
+        return new_chunk, removed_ids
+
+    # Background reshaping
+
+    def _schedule_reshape(self, entry_id: EntryID) -> None:
+        assert self.background_nursery is not None
+        self._reshape_queue[entry_id] = None
+        if not self._reshape_worker_running:
+            self._reshape_worker_running = True
+            self.background_nursery.start_soon(self._reshape_worker)
+
+    async def _reshape_worker(self) -> None:
+        try:
+            while self._reshape_queue:
+                entry_id = next(iter(self._reshape_queue))
+                del self._reshape_queue[entry_id]
+                # Best effort, the file is reshaped anyway before being synchronized
+                try:
+                    await self._background_reshape(entry_id)
+                except FSError:
+                    pass
+        finally:
+            self._reshape_worker_running = False
+
+    async def _background_reshape(self, entry_id: EntryID) -> None:
+        manifest = await self.local_storage.get_manifest(entry_id)
+        if not isinstance(manifest, LocalFileManifest):
+            return
+
+        for source, destination, update, removed_ids in prepare_reshape(manifest):
+
+            # Read the chunks without holding the lock,
+            # they might be removed by a concurrent change
+            try:
+                data, missing = await self._build_data(source)
+            except FSLocalMissError:
+                continue
+            if missing:
+                continue
+
+            swapped = False
+            try:
+                new_chunk, removed_ids = await self._build_block(
+                    data, source, destination, removed_ids
+                )
+
+                # Swap the block if its chunks are still the same
+                block = source[0].start // manifest.blocksize
+                async with self.local_storage.lock_manifest(entry_id) as current_manifest:
+                    if (
+                        isinstance(current_manifest, LocalFileManifest)
+                        and current_manifest.blocksize == manifest.blocksize
+                        and current_manifest.get_chunks(block) == source
+                    ):
+                        current_manifest = update(current_manifest, new_chunk)
+                        await self.local_storage.set_manifest(
+                            entry_id, current_manifest, cache_only=True, removed_ids=removed_ids
+                        )
+                        swapped = True
+
+            # Otherwise, the new chunk (if any) is not referenced by any manifest
+            finally:
+                if not swapped and source != (destination,):
+                    with trio.CancelScope(shield=True):
+                        await self.local_storage.clear_chunk(destination.id, miss_ok=True)
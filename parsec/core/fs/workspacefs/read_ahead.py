@@ -0,0 +1,111 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import trio
+import attr
+from typing import Dict, List, Optional, Set
+
+from parsec.core.types import FileDescriptor, LocalFileManifest, BlockID, ChunkID
+from parsec.core.fs.remote_loader import RemoteLoader
+from parsec.core.fs.storage import BaseWorkspaceStorage
+from parsec.core.fs.exceptions import FSError
+from parsec.core.fs.workspacefs.file_operations import prepare_read
+from parsec.api.data import BlockAccess
+
+
+__all__ = ("DEFAULT_READ_AHEAD_WINDOW", "ReadAhead")
+
+
+# Number of blocks to fetch ahead of a sequential reader
+DEFAULT_READ_AHEAD_WINDOW = 4
+# Number of consecutive sequential reads before starting to read ahead
+READ_AHEAD_SEQUENTIAL_THRESHOLD = 2
+
+
+@attr.s(slots=True, auto_attribs=True)
+class ReadAheadState:
+    next_offset: int = 0
+    sequential_reads: int = 0
+    fetched_until: int = 0
+
+
+class ReadAhead:
+    """Fetch the blocks ahead of the sequential readers of a workspace.
+
+    Each file descriptor keeps track of its read pattern. Once a few consecutive
+    reads have been detected, the next blocks of the file (up to `window` blocks
+    after the current position) are downloaded in the background into the block
+    storage, so the following reads don't have to wait for the backend.
+
+    Read-ahead is best effort: the download errors are ignored since the actual
+    read is going to try again and report them. A `window` of 0 (or no nursery)
+    disables the read-ahead.
+    """
+
+    def __init__(
+        self,
+        local_storage: BaseWorkspaceStorage,
+        remote_loader: RemoteLoader,
+        nursery: Optional[trio.Nursery],
+        window: int = DEFAULT_READ_AHEAD_WINDOW,
+    ):
+        self.local_storage = local_storage
+        self.remote_loader = remote_loader
+        self.nursery = nursery
+        self.window = window
+        self._states: Dict[FileDescriptor, ReadAheadState] = {}
+        self._fetching: Set[BlockID] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.nursery is not None and self.window > 0
+
+    def record_read(self, fd: FileDescriptor, manifest: LocalFileManifest, start: int, stop: int):
+        if not self.enabled:
+            return
+        state = self._states.setdefault(fd, ReadAheadState())
+
+        # Random access, start over
+        if start != state.next_offset:
+            state.sequential_reads = 0
+            state.fetched_until = stop
+        state.sequential_reads += 1
+        state.next_offset = stop
+        if state.sequential_reads < READ_AHEAD_SEQUENTIAL_THRESHOLD:
+            return
+
+        # Wait for half the window to be consumed before fetching more,
+        # so a single read-ahead task covers several reads
+        window_size = self.window * manifest.blocksize
+        if state.fetched_until - stop > window_size // 2:
+            return
+        fetch_start = max(stop, state.fetched_until)
+        fetch_stop = min(manifest.size, stop + window_size)
+        if fetch_start >= fetch_stop:
+            return
+        state.fetched_until = fetch_stop
+
+        # Only the chunks that are not already being fetched
+        accesses = []
+        for chunk in prepare_read(manifest, fetch_stop - fetch_start, fetch_start):
+            if chunk.access is None or chunk.access.id in self._fetching:
+                continue
+            self._fetching.add(chunk.access.id)
+            accesses.append(chunk.access)
+        if accesses:
+            self.nursery.start_soon(self._fetch_blocks, accesses)
+
+    def discard(self, fd: FileDescriptor) -> None:
+        self._states.pop(fd, None)
+
+    async def _fetch_blocks(self, accesses: List[BlockAccess]) -> None:
+        try:
+            missing = [
+                access
+                for access in accesses
+                if not await self.local_storage.is_chunk(ChunkID(access.id))
+            ]
+            await self.remote_loader.load_blocks(missing)
+        except FSError:
+            pass
+        finally:
+            self._fetching.difference_update(access.id for access in accesses)
@@ -271,6 +271,10 @@ class SyncTransactions(EntryTransactions):
         # Fetch and lock
         async with self.local_storage.lock_manifest(entry_id) as local_manifest:
 
+            # Make the data buffered by the file descriptors part of the manifest
+            if isinstance(local_manifest, LocalFileManifest):
+                local_manifest = await self._manifest_flush_write_buffers(local_manifest)
+
             # Sync cannot be performed yet
             if (
                 not final
@@ -340,7 +344,8 @@ class SyncTransactions(EntryTransactions):
                 if not isinstance(manifest, LocalFileManifest):
                     raise FSIsADirectoryError(entry_id)
 
-                # Normalize
+                # Normalize, including the buffered data
+                manifest = await self._manifest_flush_write_buffers(manifest)
                 missing = await self._manifest_reshape(manifest)
 
             # Done
@@ -375,6 +380,9 @@ class SyncTransactions(EntryTransactions):
                 if not isinstance(current_manifest, LocalFileManifest):
                     raise FSIsADirectoryError(entry_id)
 
+                # The buffered data belongs to the local version
+                current_manifest = await self._manifest_flush_write_buffers(current_manifest)
+
                 # Make sure the file still exists
                 filename = get_filename(parent_manifest, entry_id)
                 if filename is None:
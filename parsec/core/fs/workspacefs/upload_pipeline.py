@@ -0,0 +1,131 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import math
+import trio
+from typing import Sequence, Tuple
+
+from parsec.api.data import BlockAccess
+from parsec.core.fs.crypto_executor import run_crypto
+from parsec.core.fs.remote_loader import RemoteLoader
+from parsec.core.fs.storage import BaseWorkspaceStorage
+from parsec.core.fs.exceptions import FSLocalMissError
+from parsec.utils import open_service_nursery
+
+
+__all__ = ("AdaptiveConcurrency", "upload_blocks")
+
+
+class AdaptiveConcurrency:
+    """Bound the number of concurrent uploads depending on the measured link.
+
+    Enough uploads should be in flight to cover the bandwidth-delay product of
+    the link, so the uplink is saturated in spite of the round trips. Hence the
+    concurrency is set to the throughput (measured over rounds of uploads, only
+    accounting for the time spent uploading) times the minimal duration of an
+    upload, in blocks. One more upload is allowed in order to probe for more
+    throughput. It starts with a single upload and is bounded by `max_concurrency`.
+    """
+
+    def __init__(self, max_concurrency: int):
+        assert max_concurrency >= 1
+        self.max_concurrency = max_concurrency
+        self.limiter = trio.CapacityLimiter(1)
+        self.min_duration = math.inf
+        self.throughput = 0.0
+        self._uploading = 0
+        self._uploading_since = 0.0
+        self._round_time = 0.0
+        self._round_size = 0
+        self._round_uploads = 0
+
+    @property
+    def concurrency(self) -> int:
+        return int(self.limiter.total_tokens)
+
+    def _update_round_time(self) -> float:
+        now = trio.current_time()
+        if self._uploading:
+            self._round_time += now - self._uploading_since
+        self._uploading_since = now
+        return now
+
+    def upload_started(self) -> float:
+        now = self._update_round_time()
+        self._uploading += 1
+        return now
+
+    def upload_finished(self, size: int, started_on: float) -> None:
+        now = self._update_round_time()
+        self._uploading -= 1
+        if not size:
+            return
+        self.min_duration = min(self.min_duration, now - started_on)
+        self._round_size += size
+        self._round_uploads += 1
+        if self._round_uploads < self.concurrency or not self._round_time:
+            return
+
+        # End of round
+        self.throughput = self._round_size / self._round_time
+        block_size = self._round_size / self._round_uploads
+        bdp = self.throughput * self.min_duration / block_size
+        self.limiter.total_tokens = max(1, min(round(bdp) + 1, self.max_concurrency))
+        self._round_time = 0.0
+        self._round_size = self._round_uploads = 0
+
+
+async def upload_blocks(
+    remote_loader: RemoteLoader,
+    local_storage: BaseWorkspaceStorage,
+    blocks: Sequence[BlockAccess],
+    concurrency: AdaptiveConcurrency,
+) -> None:
+    """Upload the dirty blocks through a pipeline.
+
+    The stages are run concurrently, so the blocks can be read from the local
+    storage and encrypted (in a thread) while the previous ones are being sent.
+    The number of blocks being sent is bounded by `concurrency`, and the number
+    of blocks buffered between the stages by its maximum value.
+    """
+    buffer_size = concurrency.max_concurrency
+    read_send, read_receive = trio.open_memory_channel(buffer_size)
+    encrypted_send, encrypted_receive = trio.open_memory_channel(buffer_size)
+
+    async def _reader() -> None:
+        async with read_send:
+            for access in blocks:
+                try:
+                    data = await local_storage.get_dirty_block(access.id)
+                except FSLocalMissError:
+                    continue
+                await read_send.send((access, data))
+
+    async def _encrypter() -> None:
+        async with read_receive, encrypted_send:
+            async for access, data in read_receive:
+                ciphered = await run_crypto(len(data), remote_loader.encrypt_block, access, data)
+                await encrypted_send.send((access, data, ciphered))
+
+    async def _sender(borrower: object, access: BlockAccess, data: bytes, ciphered: bytes) -> None:
+        size = 0
+        started_on = concurrency.upload_started()
+        try:
+            await remote_loader.upload_ciphered_block(access, data, ciphered)
+            size = len(ciphered)
+        finally:
+            concurrency.upload_finished(size, started_on)
+            concurrency.limiter.release_on_behalf_of(borrower)
+
+    async def _dispatcher(nursery: trio.Nursery) -> None:
+        async with encrypted_receive:
+            item: Tuple[BlockAccess, bytes, bytes]
+            async for item in encrypted_receive:
+                # The limiter is shared with the other uploads of the workspace
+                borrower = object()
+                await concurrency.limiter.acquire_on_behalf_of(borrower)
+                nursery.start_soon(_sender, borrower, *item)
+
+    async with open_service_nursery() as nursery:
+        nursery.start_soon(_reader)
+        nursery.start_soon(_encrypter)
+        nursery.start_soon(_dispatcher, nursery)
@@ -182,12 +182,12 @@ class WorkspaceFile:
         if size == -1:
             result = await self._transactions.fd_read(self.fileno(), size, self._offset)
             self._offset += len(result)
-            return result
+            return bytes(result)
             # Reading size : add to offset size
         else:
             result = await self._transactions.fd_read(self.fileno(), size, self._offset)
             self._offset += len(result)
-            return result
+            return bytes(result)
 
     def readable(self) -> bool:
         self._check_open_state()
@@ -36,6 +36,9 @@ from parsec.core.backend_connection import (
 from parsec.core.fs.remote_loader import RemoteLoader
 from parsec.core.fs import workspacefs  # Needed to break cyclic import with WorkspaceFSTimestamped
 from parsec.core.fs.workspacefs.sync_transactions import SyncTransactions
+from parsec.core.fs.workspacefs.read_ahead import DEFAULT_READ_AHEAD_WINDOW
+from parsec.core.fs.workspacefs.write_buffer import DEFAULT_WRITE_BUFFER_SIZE
+from parsec.core.fs.workspacefs.upload_pipeline import AdaptiveConcurrency, upload_blocks
 from parsec.core.fs.workspacefs.versioning_helpers import VersionLister
 from parsec.core.fs.exceptions import (
     FSRemoteManifestNotFound,
@@ -54,7 +57,6 @@ from parsec.core.fs.exceptions import (
 )
 from parsec.core.fs.workspacefs.workspacefile import WorkspaceFile
 from parsec.core.fs.storage import BaseWorkspaceStorage
-from parsec.utils import open_service_nursery
 
 
 @attr.s(slots=True, frozen=True, auto_attribs=True)
@@ -79,6 +81,11 @@ class WorkspaceFS:
         backend_cmds: BackendAuthenticatedCmds,
         event_bus: EventBus,
         remote_devices_manager: RemoteDevicesManager,
+        background_nursery: Optional[trio.Nursery] = None,
+        read_ahead_window: int = DEFAULT_READ_AHEAD_WINDOW,
+        write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+        upload_max_concurrency: Optional[int] = None,
+        deduplicate_blocks: bool = False,
     ):
         self.workspace_id = workspace_id
         self.get_workspace_entry = get_workspace_entry
@@ -89,6 +96,13 @@ class WorkspaceFS:
         self.event_bus = event_bus
         self.remote_devices_manager = remote_devices_manager
         self.sync_locks: Dict[EntryID, trio.Lock] = defaultdict(trio.Lock)
+        self.background_nursery = background_nursery
+        self.read_ahead_window = read_ahead_window
+        self.write_buffer_size = write_buffer_size
+        # Default to the number of commands the backend connection can send concurrently
+        self.upload_concurrency = AdaptiveConcurrency(
+            upload_max_concurrency or backend_cmds.max_concurrency
+        )
 
         self.remote_loader = RemoteLoader(
             self.device,
@@ -98,6 +112,7 @@ class WorkspaceFS:
             self.backend_cmds,
             self.remote_devices_manager,
             self.local_storage,
+            deduplicate_blocks=deduplicate_blocks,
         )
         self.transactions = SyncTransactions(
             self.workspace_id,
@@ -106,6 +121,9 @@ class WorkspaceFS:
             self.local_storage,
             self.remote_loader,
             self.event_bus,
+            background_nursery=self.background_nursery,
+            read_ahead_window=self.read_ahead_window,
+            write_buffer_size=self.write_buffer_size,
         )
 
     def __repr__(self) -> str:
@@ -510,22 +528,9 @@ class WorkspaceFS:
             await self.minimal_sync(child)
 
     async def _upload_blocks(self, manifest: RemoteFileManifest) -> None:
-        blocks_iter = iter(manifest.blocks)
-
-        async def _uploader() -> None:
-            while True:
-                access = next(blocks_iter, None)
-                if not access:
-                    break
-                try:
-                    data = await self.local_storage.get_dirty_block(access.id)
-                except FSLocalMissError:
-                    continue
-                await self.remote_loader.upload_block(access, data)
-
-        async with open_service_nursery() as nursery:
-            for _ in range(4):
-                nursery.start_soon(_uploader)
+        await upload_blocks(
+            self.remote_loader, self.local_storage, manifest.blocks, self.upload_concurrency
+        )
 
     async def minimal_sync(self, entry_id: EntryID) -> None:
         """
@@ -561,7 +566,10 @@ class WorkspaceFS:
             pass
 
     async def _sync_by_id(
-        self, entry_id: EntryID, remote_changed: bool = True
+        self,
+        entry_id: EntryID,
+        remote_changed: bool = True,
+        remote_manifest: Optional[BaseRemoteManifest] = None,
     ) -> BaseRemoteManifest:
         """
         Synchronize the entry corresponding to a specific ID.
@@ -572,11 +580,11 @@ class WorkspaceFS:
         - one upload operation has succeeded and has been acknowledged
 
         This guarantees that any change prior to the call is saved remotely when this
-        method returns.
+        method returns. The remote manifest can be provided if it has already been
+        downloaded.
         """
         # Get the current remote manifest if it has changed
-        remote_manifest = None
-        if remote_changed:
+        if remote_changed and remote_manifest is None:
             try:
                 remote_manifest = await self.remote_loader.load_manifest(entry_id)
             except FSRemoteManifestNotFound:
@@ -645,7 +653,11 @@ class WorkspaceFS:
             await self.remote_loader.create_realm(self.workspace_id)
 
     async def sync_by_id(
-        self, entry_id: EntryID, remote_changed: bool = True, recursive: bool = True
+        self,
+        entry_id: EntryID,
+        remote_changed: bool = True,
+        recursive: bool = True,
+        remote_manifest: Optional[BaseRemoteManifest] = None,
     ) -> None:
         """
         Raises:
@@ -657,7 +669,9 @@ class WorkspaceFS:
         # Sync parent first
         try:
             async with self.sync_locks[entry_id]:
-                manifest = await self._sync_by_id(entry_id, remote_changed=remote_changed)
+                manifest = await self._sync_by_id(
+                    entry_id, remote_changed=remote_changed, remote_manifest=remote_manifest
+                )
 
         # Nothing to synchronize if the manifest does not exist locally
         except FSNoSynchronizationRequired:
@@ -20,6 +20,10 @@ class WorkspaceFSTimestamped(WorkspaceFS):
         self.backend_cmds = workspacefs.backend_cmds
         self.event_bus = workspacefs.event_bus
         self.remote_devices_manager = workspacefs.remote_devices_manager
+        self.background_nursery = workspacefs.background_nursery
+        self.read_ahead_window = workspacefs.read_ahead_window
+        # Read-only, the writes have to fail right away
+        self.write_buffer_size = 0
 
         self.timestamp = timestamp
 
@@ -31,6 +35,9 @@ class WorkspaceFSTimestamped(WorkspaceFS):
             self.local_storage,
             self.remote_loader,
             self.event_bus,
+            background_nursery=self.background_nursery,
+            read_ahead_window=self.read_ahead_window,
+            write_buffer_size=self.write_buffer_size,
         )
 
     def timestamp_get_entry(
@@ -0,0 +1,107 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import trio
+import attr
+from pendulum import DateTime, now as pendulum_now
+from typing import Dict, List, Optional
+
+from parsec.core.types import DEFAULT_BLOCK_SIZE, FileDescriptor, EntryID
+
+
+__all__ = ("DEFAULT_WRITE_BUFFER_SIZE", "WRITE_BUFFER_FLUSH_DELAY", "WriteBuffer", "WriteBuffers")
+
+
+# Maximum amount of data (in bytes) buffered by the file descriptors of a workspace
+DEFAULT_WRITE_BUFFER_SIZE = 16 * DEFAULT_BLOCK_SIZE
+# Delay (in seconds) after which the buffered data is written to the local storage
+WRITE_BUFFER_FLUSH_DELAY = 1.0
+
+
+@attr.s(slots=True, auto_attribs=True, eq=False)
+class WriteBuffer:
+    entry_id: EntryID
+    start: int
+    data: bytearray
+    # Time of the last write, to be reported by the manifest
+    updated: DateTime = attr.ib(factory=pendulum_now)
+    created_on: float = attr.ib(factory=trio.current_time)
+
+    @property
+    def stop(self) -> int:
+        return self.start + len(self.data)
+
+
+class WriteBuffers:
+    """Keep track of the data written through the file descriptors of a workspace.
+
+    Each file descriptor buffers its last contiguous writes, so the many small
+    writes performed by the operating system are merged into full blocks before
+    reaching the local storage. The buffered data is not part of the manifest:
+    it has to be flushed before the file is accessed in any other way.
+
+    The total amount of buffered data is bounded by `max_size`, the oldest
+    buffers being the first to go. A `max_size` of 0 disables the buffering.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_WRITE_BUFFER_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._buffers: Dict[FileDescriptor, WriteBuffer] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, fd: FileDescriptor) -> Optional[WriteBuffer]:
+        return self._buffers.get(fd)
+
+    def get_fds(self, entry_id: EntryID) -> List[FileDescriptor]:
+        return [fd for fd, buffer in self._buffers.items() if buffer.entry_id == entry_id]
+
+    def get_entry_ids(self) -> List[EntryID]:
+        return list({buffer.entry_id: None for buffer in self._buffers.values()})
+
+    def get_overflowing_entry_ids(self) -> List[EntryID]:
+        """Return the entries to flush in order to get back under the maximum size."""
+        result: List[EntryID] = []
+        size = self.size
+        for buffer in sorted(self._buffers.values(), key=lambda buffer: buffer.created_on):
+            if size <= self.max_size:
+                break
+            size -= len(buffer.data)
+            if buffer.entry_id not in result:
+                result.append(buffer.entry_id)
+        return result
+
+    def get_stale_entry_ids(self, now: float) -> List[EntryID]:
+        """Return the entries with data buffered for longer than the flush delay."""
+        result: List[EntryID] = []
+        for buffer in self._buffers.values():
+            if now - buffer.created_on >= WRITE_BUFFER_FLUSH_DELAY:
+                if buffer.entry_id not in result:
+                    result.append(buffer.entry_id)
+        return result
+
+    def add(self, fd: FileDescriptor, buffer: WriteBuffer) -> None:
+        assert fd not in self._buffers
+        self._buffers[fd] = buffer
+        self.size += len(buffer.data)
+
+    def extend(self, fd: FileDescriptor, content: bytes) -> None:
+        buffer = self._buffers[fd]
+        buffer.data += content
+        buffer.updated = pendulum_now()
+        self.size += len(content)
+
+    def consume(self, fd: FileDescriptor, length: int) -> None:
+        """Drop the first `length` bytes of the buffer, once written to the local storage."""
+        buffer = self._buffers[fd]
+        del buffer.data[:length]
+        buffer.start += length
+        buffer.created_on = trio.current_time()
+        self.size -= length
+
+    def remove(self, fd: FileDescriptor) -> None:
+        buffer = self._buffers.pop(fd, None)
+        if buffer is not None:
+            self.size -= len(buffer.data)
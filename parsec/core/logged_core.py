@@ -43,7 +43,7 @@ from parsec.core.remote_devices_manager import (
 )
 from parsec.core.mountpoint import mountpoint_manager_factory, MountpointManager
 from parsec.core.messages_monitor import monitor_messages
-from parsec.core.sync_monitor import monitor_sync
+from parsec.core.sync_monitor import monitor_sync, SyncDebounce
 from parsec.core.fs import UserFS
 from parsec.core.fs.exceptions import FSWorkspaceNotFoundError
 
@@ -346,16 +346,43 @@ async def logged_core_factory(
         max_cooldown=config.backend_max_cooldown,
         max_pool=config.backend_max_connections,
         keepalive=config.backend_connection_keepalive,
+        max_pipelined_requests=config.backend_max_pipelined_requests,
+        idle_timeout=config.backend_connection_idle_timeout,
     )
 
     path = config.data_base_dir / device.slug
     remote_devices_manager = RemoteDevicesManager(backend_conn.cmds, device.root_verify_key)
     async with UserFS.run(
-        device, path, backend_conn.cmds, remote_devices_manager, event_bus, prevent_sync_pattern
+        device,
+        path,
+        backend_conn.cmds,
+        remote_devices_manager,
+        event_bus,
+        prevent_sync_pattern,
+        workspace_storage_memory_cache_size=config.workspace_storage_memory_cache_size,
+        workspace_storage_block_files=config.workspace_storage_block_files,
+        workspace_storage_manifest_cache_size=config.workspace_storage_manifest_cache_size,
+        workspace_read_ahead_window=config.workspace_read_ahead_window,
+        workspace_write_buffer_size=config.workspace_write_buffer_size,
+        workspace_upload_max_concurrency=config.workspace_upload_max_concurrency,
+        deduplicated_workspaces=config.deduplicated_workspaces,
     ) as user_fs:
 
         backend_conn.register_monitor(partial(monitor_messages, user_fs, event_bus))
-        backend_conn.register_monitor(partial(monitor_sync, user_fs, event_bus))
+        sync_debounce = SyncDebounce(
+            min_wait=config.sync_min_wait,
+            max_wait=config.sync_max_wait,
+            backoff_factor=config.sync_backoff_factor,
+        )
+        backend_conn.register_monitor(
+            partial(
+                monitor_sync,
+                user_fs,
+                event_bus,
+                max_concurrency=config.sync_max_concurrency,
+                debounce=sync_debounce,
+            )
+        )
 
         async with backend_conn.run():
             async with mountpoint_manager_factory(
@@ -3,6 +3,7 @@
 from parsec.core.core_events import CoreEvent
 import os
 import errno
+import ctypes
 import trio
 from typing import Optional
 from structlog import get_logger
@@ -160,7 +161,12 @@ class FuseOperations(LoggingMixIn, Operations):
     def read(self, path: FsPath, size: int, offset: int, fh: int):
         # Atomic read
         ret = self.fs_access.fd_read(fh, size, offset, raise_eof=False)
-        # Fuse wants bytes but fd_read returns a bytearray
+        # Fuse copies the data using `ctypes.memmove`, which doesn't accept the
+        # memoryview returned by fd_read. Avoid copying it once more if possible.
+        if not ret.readonly:
+            return (ctypes.c_char * len(ret)).from_buffer(ret)
+        if isinstance(ret.obj, bytes) and len(ret.obj) == len(ret):
+            return ret.obj
         return bytes(ret)
 
     def write(self, path: FsPath, data: bytes, offset: int, fh: int):
@@ -1,15 +1,22 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
 import math
-from collections import defaultdict
+import heapq
+import itertools
+from typing import Optional, List, Tuple
+from collections import defaultdict, OrderedDict
 
+import attr
 import trio
 from trio.lowlevel import current_clock
 from structlog import get_logger
+from async_generator import asynccontextmanager
 
+from parsec.utils import open_service_nursery
 from parsec.core.core_events import CoreEvent
-from parsec.core.types import EntryID, WorkspaceRole
+from parsec.core.types import EntryID, WorkspaceRole, LocalFileManifest
 from parsec.core.fs import (
+    FSError,
     FSBackendOfflineError,
     FSBadEncryptionRevision,
     FSWorkspaceNotFoundError,
@@ -17,6 +24,7 @@ from parsec.core.fs import (
     FSWorkspaceNoWriteAccess,
     FSWorkspaceInMaintenance,
 )
+from parsec.core.fs.exceptions import FSLocalMissError
 from parsec.core.backend_connection import BackendConnectionError, BackendNotAvailable
 
 
@@ -24,8 +32,17 @@ logger = get_logger()
 
 MIN_WAIT = 1
 MAX_WAIT = 60
+# Factor applied to the quiet period of an entry modified again shortly after its sync
+BACKOFF_FACTOR = 2
 MAINTENANCE_MIN_WAIT = 30
 TICK_CRASH_COOLDOWN = 5
+# Maximum number of remote manifests downloaded at once before syncing the remote changes
+REMOTE_MANIFESTS_PREFETCH_SIZE = 1000
+
+# Priorities of the synchronizations, the lower the sooner
+SYNC_PRIORITY_USER_MANIFEST = 0
+SYNC_PRIORITY_METADATA = 1
+SYNC_PRIORITY_DATA = 2
 
 
 async def freeze_sync_monitor_mockpoint():
@@ -41,22 +58,108 @@ def timestamp():
     return current_clock().current_time()
 
 
-class LocalChange:
-    __slots__ = ("first_changed_on", "last_changed_on", "due_time")
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class SyncDebounce:
+    """Delays between the local changes and their synchronization.
+
+    A local change is synchronized once it has not been modified for its quiet
+    period, and at most `max_wait` seconds after it first occurred. The quiet
+    period starts at `min_wait` and is multiplied by `backoff_factor` each time
+    the entry is modified again less than `max_wait` seconds after its sync,
+    so that the entries modified continuously get synchronized less often.
+    """
+
+    min_wait: float = MIN_WAIT
+    max_wait: float = MAX_WAIT
+    backoff_factor: float = BACKOFF_FACTOR
+
+
+class LocalChangeBurst:
+    """
+    Entries starting to change in a row, typically written by the same
+    operation: they get synchronized together once the burst is over.
+    """
+
+    __slots__ = ("last_changed_on",)
 
     def __init__(self, now):
+        self.last_changed_on = now
+
+
+class LocalChange:
+    __slots__ = ("debounce", "burst", "quiet_period", "first_changed_on", "last_changed_on")
+
+    def __init__(self, debounce: SyncDebounce, burst: LocalChangeBurst, now, quiet_period=None):
+        self.debounce = debounce
+        self.burst = burst
+        self.quiet_period = debounce.min_wait if quiet_period is None else quiet_period
         self.first_changed_on = self.last_changed_on = now
-        self.due_time = self._compute_due_time()
 
-    def _compute_due_time(self):
-        return min(self.last_changed_on + MIN_WAIT, self.first_changed_on + MAX_WAIT)
+    @property
+    def due_time(self) -> float:
+        due_time = max(
+            self.last_changed_on + self.quiet_period,
+            self.burst.last_changed_on + self.debounce.min_wait,
+        )
+        return min(due_time, self.first_changed_on + self.debounce.max_wait)
 
     def changed(self, changed_on) -> float:
         self.last_changed_on = changed_on
-        self.due_time = self._compute_due_time()
         return self.due_time
 
 
+class SyncBudget:
+    """
+    Bound the number of synchronizations running at the same time.
+    The slots are granted by order of priority, then by order of arrival:
+    as the sync contexts ask for a slot before each synchronization, the
+    small metadata changes go first and the contexts take turns.
+    """
+
+    def __init__(self, max_concurrency: int):
+        assert max_concurrency >= 1
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    @asynccontextmanager
+    async def acquire(self, priority: int):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int) -> None:
+        if self.running < self.max_concurrency and not self._waiters:
+            self.running += 1
+            # The slot is taken, don't let a cancellation leak it
+            await trio.lowlevel.cancel_shielded_checkpoint()
+            return
+
+        waiter = (priority, next(self._counter), trio.Event())
+        heapq.heappush(self._waiters, waiter)
+        try:
+            await waiter[2].wait()
+        except BaseException:
+            # The slot has been handed over in the meantime
+            if waiter[2].is_set():
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            raise
+
+    def _release(self) -> None:
+        # Hand the slot over to the next waiter, if any
+        if self._waiters:
+            _, _, event = heapq.heappop(self._waiters)
+            event.set()
+        else:
+            self.running -= 1
+
+
 class SyncContext:
     """
     The SyncContext keeps track of local and remote changes and trigger sync
@@ -68,19 +171,34 @@ class SyncContext:
       storage to get the list of changes (entry id + version) it has missed
     """
 
-    def __init__(self, user_fs, id: EntryID, read_only: bool = False):
+    def __init__(
+        self, user_fs, id: EntryID, read_only: bool = False, debounce: Optional[SyncDebounce] = None
+    ):
         self.user_fs = user_fs
         self.id = id
         self.read_only = read_only
+        self.debounce = debounce or SyncDebounce()
         self.due_time = math.inf
         self._changes_loaded = False
         self._local_changes = {}
+        self._local_changes_burst = None
+        # Sync time and quiet period of the local changes synchronized
+        # during the last `max_wait` seconds, oldest first
+        self._synced_local_changes: "OrderedDict[EntryID, Tuple[float, float]]" = OrderedDict()
         self._remote_changes = set()
+        # Remote manifests downloaded ahead of the sync of the remote changes,
+        # or None for the entries that were not found on the backend
+        self._remote_manifests = {}
+        # Remote changes received while the remote manifests are being downloaded
+        self._prefetch_outdated = None
         self._local_confinement_points = defaultdict(set)
 
-    def _sync(self, entry_id: EntryID):
+    def _sync(self, entry_id: EntryID, remote_manifest=None):
         raise NotImplementedError
 
+    async def _load_remote_manifests(self, entry_ids: List[EntryID]) -> dict:
+        return {}
+
     def _get_backend_cmds(self):
         raise NotImplementedError
 
@@ -132,8 +250,12 @@ class SyncContext:
         now = timestamp()
         # Ignore local changes in read only mode
         if not self.read_only:
-            self._local_changes = {entry_id: LocalChange(now) for entry_id in need_sync_local}
+            burst = self._local_changes_burst = LocalChangeBurst(now)
+            self._local_changes = {
+                entry_id: LocalChange(self.debounce, burst, now) for entry_id in need_sync_local
+            }
         self._remote_changes = need_sync_remote
+        self._remote_manifests = {}
 
         # 4) Finally refresh due time according to the changes
         self._compute_due_time()
@@ -160,9 +282,7 @@ class SyncContext:
         try:
             new_due_time = self._local_changes[entry_id].changed(now)
         except KeyError:
-            local_change = LocalChange(now)
-            self._local_changes[entry_id] = local_change
-            new_due_time = local_change.due_time
+            new_due_time = self._add_local_change(entry_id, now).due_time
 
         # Trigger a wake up if necessary
         if new_due_time <= self.due_time:
@@ -171,8 +291,46 @@ class SyncContext:
 
         return wake_up
 
+    def _add_local_change(self, entry_id: EntryID, now: float) -> LocalChange:
+        # The entries starting to change less than `min_wait` seconds apart
+        # are part of the same burst
+        burst = self._local_changes_burst
+        if burst is None or burst.last_changed_on + self.debounce.min_wait < now:
+            burst = self._local_changes_burst = LocalChangeBurst(now)
+        else:
+            burst.last_changed_on = now
+
+        quiet_period = self._pop_backoff_quiet_period(entry_id, now)
+        local_change = LocalChange(self.debounce, burst, now, quiet_period)
+        self._local_changes[entry_id] = local_change
+        return local_change
+
+    def _pop_backoff_quiet_period(self, entry_id: EntryID, now: float) -> Optional[float]:
+        # Back off if the entry is modified again shortly after its sync
+        try:
+            synced_on, previous_quiet_period = self._synced_local_changes.pop(entry_id)
+        except KeyError:
+            return None
+        if now >= synced_on + self.debounce.max_wait:
+            return None
+        return min(previous_quiet_period * self.debounce.backoff_factor, self.debounce.max_wait)
+
+    def _set_local_change_synced(self, entry_id: EntryID, local_change: LocalChange, now: float):
+        self._synced_local_changes[entry_id] = (now, local_change.quiet_period)
+        self._synced_local_changes.move_to_end(entry_id)
+        # Forget about the entries that have not been modified since long enough
+        while self._synced_local_changes:
+            synced_on, _ = next(iter(self._synced_local_changes.values()))
+            if now < synced_on + self.debounce.max_wait:
+                break
+            self._synced_local_changes.popitem(last=False)
+
     def set_remote_change(self, entry_id: EntryID) -> bool:
         self._remote_changes.add(entry_id)
+        # The downloaded manifest is outdated
+        self._remote_manifests.pop(entry_id, None)
+        if self._prefetch_outdated is not None:
+            self._prefetch_outdated.add(entry_id)
         self.due_time = timestamp()
         return True
 
@@ -199,6 +357,47 @@ class SyncContext:
         await self._load_changes()
         return self.due_time
 
+    def _get_due_local_change(self, now: float) -> Optional[EntryID]:
+        return next(
+            (
+                entry_id
+                for entry_id, change_info in self._local_changes.items()
+                if change_info.due_time <= now
+            ),
+            None,
+        )
+
+    async def _get_entry_priority(self, entry_id: EntryID) -> int:
+        return SYNC_PRIORITY_METADATA
+
+    async def get_priority(self) -> int:
+        """Return the priority of the synchronization performed by the next tick."""
+        # Loading the changes and syncing the remote changes only deal with metadata
+        if not self._changes_loaded or self._remote_changes:
+            return SYNC_PRIORITY_METADATA
+        entry_id = self._get_due_local_change(timestamp())
+        if entry_id is None:
+            return SYNC_PRIORITY_METADATA
+        return await self._get_entry_priority(entry_id)
+
+    async def _prefetch_remote_manifests(self) -> None:
+        entry_ids = list(itertools.islice(self._remote_changes, REMOTE_MANIFESTS_PREFETCH_SIZE))
+        outdated = self._prefetch_outdated = set()
+        try:
+            manifests = await self._load_remote_manifests(entry_ids)
+        except FSBackendOfflineError as exc:
+            raise BackendNotAvailable from exc
+        except FSError:
+            # The entries are synchronized one by one instead, which takes
+            # care of the errors (e.g. lost access or ongoing maintenance)
+            return
+        finally:
+            self._prefetch_outdated = None
+        # Entries missing from the backend are synchronized without prefetched manifest
+        self._remote_manifests = {
+            entry_id: manifests.get(entry_id) for entry_id in entry_ids if entry_id not in outdated
+        }
+
     async def tick(self) -> float:
         now = timestamp()
         if self.due_time > now:
@@ -213,9 +412,16 @@ class SyncContext:
 
         # Remote changes sync have priority over local changes
         if self._remote_changes:
-            entry_id = self._remote_changes.pop()
+            # Download the remote manifests in batch rather than one at a time
+            if not self._remote_manifests and len(self._remote_changes) > 1:
+                await self._prefetch_remote_manifests()
+            if self._remote_manifests:
+                entry_id, remote_manifest = self._remote_manifests.popitem()
+                self._remote_changes.remove(entry_id)
+            else:
+                entry_id, remote_manifest = self._remote_changes.pop(), None
             try:
-                await self._sync(entry_id)
+                await self._sync(entry_id, remote_manifest)
             except FSBackendOfflineError as exc:
                 raise BackendNotAvailable from exc
             except FSWorkspaceNoReadAccess:
@@ -223,7 +429,7 @@ class SyncContext:
                 # This likely means a `sharing.updated` event we soon arrive
                 # and destroy this sync context.
                 # Until then just pretent nothing happened.
-                min_due_time = now + MIN_WAIT
+                min_due_time = now + self.debounce.min_wait
                 self._remote_changes.add(entry_id)
             except FSWorkspaceNoWriteAccess:
                 # We don't have write access and this entry contains local
@@ -239,16 +445,9 @@ class SyncContext:
                 self._remote_changes.add(entry_id)
 
         elif self._local_changes:
-            entry_id = next(
-                (
-                    entry_id
-                    for entry_id, change_info in self._local_changes.items()
-                    if change_info.due_time <= now
-                ),
-                None,
-            )
+            entry_id = self._get_due_local_change(now)
             if entry_id:
-                del self._local_changes[entry_id]
+                local_change = self._local_changes.pop(entry_id)
                 try:
                     await self._sync(entry_id)
                 except FSBackendOfflineError as exc:
@@ -260,14 +459,24 @@ class SyncContext:
                     # We keep track of the change (given we may be given back
                     # the write access in the future) but pretent it just accured
                     # to avoid a busy sync loop until `read_only` flag is updated.
-                    self._local_changes[entry_id] = LocalChange(now)
+                    self._add_local_change(entry_id, now)
                 except (FSWorkspaceInMaintenance, FSBadEncryptionRevision):
                     # Not the right time for the sync, retry later.
                     # `FSBadEncryptionRevision` occurs if the reencryption is quick
                     # enough to start and finish before we process the sharing.reencrypted
                     # message so we try a sync with the old encryption revision.
                     min_due_time = now + MAINTENANCE_MIN_WAIT
-                    self._local_changes[entry_id] = LocalChange(now)
+                    self._add_local_change(entry_id, now)
+                else:
+                    self._set_local_change_synced(entry_id, local_change, now)
+                    # The entry might have been modified again during its sync
+                    new_local_change = self._local_changes.get(entry_id)
+                    if new_local_change is not None:
+                        quiet_period = self._pop_backoff_quiet_period(
+                            entry_id, new_local_change.first_changed_on
+                        )
+                        if quiet_period is not None:
+                            new_local_change.quiet_period = quiet_period
 
                 # This is where we plug our vacuuming routine
                 # as it corresponds to a fresh synchronized state
@@ -279,15 +488,28 @@ class SyncContext:
 
 
 class WorkspaceSyncContext(SyncContext):
-    def __init__(self, user_fs, id: EntryID):
+    def __init__(self, user_fs, id: EntryID, debounce: Optional[SyncDebounce] = None):
         self.workspace = user_fs.get_workspace(id)
         read_only = self.workspace.get_workspace_entry().role == WorkspaceRole.READER
-        super().__init__(user_fs, id, read_only=read_only)
+        super().__init__(user_fs, id, read_only=read_only, debounce=debounce)
 
-    async def _sync(self, entry_id: EntryID):
+    async def _sync(self, entry_id: EntryID, remote_manifest=None):
         # No recursion here: only the manifest that has changed
         # (remotely or locally) should get synchronized
-        await self.workspace.sync_by_id(entry_id, recursive=False)
+        await self.workspace.sync_by_id(entry_id, recursive=False, remote_manifest=remote_manifest)
+
+    async def _load_remote_manifests(self, entry_ids: List[EntryID]) -> dict:
+        return await self.workspace.remote_loader.load_manifests(entry_ids)
+
+    async def _get_entry_priority(self, entry_id: EntryID) -> int:
+        # Synchronizing a file typically involves uploading its blocks
+        try:
+            manifest = await self.workspace.local_storage.get_manifest(entry_id)
+        except FSLocalMissError:
+            return SYNC_PRIORITY_METADATA
+        if isinstance(manifest, LocalFileManifest):
+            return SYNC_PRIORITY_DATA
+        return SYNC_PRIORITY_METADATA
 
     def _get_backend_cmds(self):
         return self.workspace.backend_cmds
@@ -297,10 +519,13 @@ class WorkspaceSyncContext(SyncContext):
 
 
 class UserManifestSyncContext(SyncContext):
-    async def _sync(self, entry_id: EntryID):
+    async def _sync(self, entry_id: EntryID, remote_manifest=None):
         assert entry_id == self.id
         await self.user_fs.sync()
 
+    async def get_priority(self) -> int:
+        return SYNC_PRIORITY_USER_MANIFEST
+
     def _get_backend_cmds(self):
         return self.user_fs.backend_cmds
 
@@ -314,8 +539,9 @@ class SyncContextStore:
     when a newly created workspace is modified for the first time)
     """
 
-    def __init__(self, user_fs):
+    def __init__(self, user_fs, debounce: Optional[SyncDebounce] = None):
         self.user_fs = user_fs
+        self.debounce = debounce
         self._ctxs = {}
 
     def iter(self):
@@ -326,10 +552,10 @@ class SyncContextStore:
             return self._ctxs[entry_id]
         except KeyError:
             if entry_id == self.user_fs.user_manifest_id:
-                ctx = UserManifestSyncContext(self.user_fs, entry_id)
+                ctx = UserManifestSyncContext(self.user_fs, entry_id, debounce=self.debounce)
             else:
                 try:
-                    ctx = WorkspaceSyncContext(self.user_fs, entry_id)
+                    ctx = WorkspaceSyncContext(self.user_fs, entry_id, debounce=self.debounce)
                 except FSWorkspaceNotFoundError:
                     # It's possible the workspace is not yet available
                     # (this can happen when a workspace is just shared with
@@ -342,9 +568,21 @@ class SyncContextStore:
     def discard(self, entry_id):
         self._ctxs.pop(entry_id, None)
 
-
-async def monitor_sync(user_fs, event_bus, task_status):
-    ctxs = SyncContextStore(user_fs)
+    def is_current(self, ctx):
+        return self._ctxs.get(ctx.id) is ctx
+
+
+async def monitor_sync(
+    user_fs,
+    event_bus,
+    task_status,
+    max_concurrency: Optional[int] = None,
+    debounce: Optional[SyncDebounce] = None,
+):
+    ctxs = SyncContextStore(user_fs, debounce)
+    budget = SyncBudget(max_concurrency or user_fs.backend_cmds.max_concurrency)
+    # Sync contexts being ticked, by id
+    running = {}
     early_wakeup = trio.Event()
 
     def _trigger_early_wakeup():
@@ -403,37 +641,62 @@ async def monitor_sync(user_fs, event_bus, task_status):
             else:
                 return math.inf
 
+    async def _ctx_worker(ctx):
+        try:
+            # Tick as long as changes are due, the budget is acquired
+            # for each tick so the contexts take turns
+            while ctx.due_time <= timestamp() and ctxs.is_current(ctx):
+                await freeze_sync_monitor_mockpoint()
+                try:
+                    priority = await ctx.get_priority()
+                except Exception:
+                    priority = SYNC_PRIORITY_METADATA
+                async with budget.acquire(priority):
+                    await _ctx_action(ctx, "tick")
+        finally:
+            del running[ctx.id]
+            # Let the monitor schedule the context again, if necessary
+            early_wakeup.set()
+
     with event_bus.connect_in_context(
         (CoreEvent.FS_ENTRY_UPDATED, _on_entry_updated),
         (CoreEvent.BACKEND_REALM_VLOBS_UPDATED, _on_realm_vlobs_updated),
         (CoreEvent.SHARING_UPDATED, _on_sharing_updated),
         (CoreEvent.FS_ENTRY_CONFINED, _on_entry_confined),
     ):
-        due_times = []
         # Init userfs sync context
         ctx = ctxs.get(user_fs.user_manifest_id)
-        due_times.append(await _ctx_action(ctx, "bootstrap"))
+        await _ctx_action(ctx, "bootstrap")
         # Init workspaces sync context
         user_manifest = user_fs.get_user_manifest()
         for entry in user_manifest.workspaces:
             if entry.role is not None:
                 ctx = ctxs.get(entry.id)
                 if ctx:
-                    due_times.append(await _ctx_action(ctx, "bootstrap"))
+                    await _ctx_action(ctx, "bootstrap")
 
         task_status.started()
-        while True:
-            next_due_time = min(due_times)
-            if next_due_time == math.inf:
-                task_status.idle()
-            with trio.move_on_at(next_due_time) as cancel_scope:
-                await early_wakeup.wait()
-                early_wakeup = trio.Event()
-            # In case of early wakeup, `_trigger_early_wakeup` is responsible
-            # for calling `task_status.awake()`
-            if cancel_scope.cancelled_caught:
-                task_status.awake()
-            due_times.clear()
-            await freeze_sync_monitor_mockpoint()
-            for ctx in ctxs.iter():
-                due_times.append(await _ctx_action(ctx, "tick"))
+        async with open_service_nursery() as nursery:
+            while True:
+                # Tick the contexts with changes due, each one in its own task
+                now = timestamp()
+                due_times = []
+                for ctx in ctxs.iter():
+                    if ctx.id in running:
+                        continue
+                    if ctx.due_time <= now:
+                        running[ctx.id] = ctx
+                        nursery.start_soon(_ctx_worker, ctx)
+                    else:
+                        due_times.append(ctx.due_time)
+
+                next_due_time = min(due_times, default=math.inf)
+                if next_due_time == math.inf and not running:
+                    task_status.idle()
+                with trio.move_on_at(next_due_time) as cancel_scope:
+                    await early_wakeup.wait()
+                    early_wakeup = trio.Event()
+                # In case of early wakeup, `_trigger_early_wakeup` is responsible
+                # for calling `task_status.awake()`
+                if cancel_scope.cancelled_caught:
+                    task_status.awake()
@@ -22,6 +22,7 @@ from parsec.core.types.manifest import (
     LocalFolderManifest,
     LocalWorkspaceManifest,
 )
+from parsec.core.types.chunk_index import ChunkIndex
 from parsec.core.types.manifest import (
     LocalUserManifest,
     BaseLocalManifest,
@@ -82,6 +83,7 @@ __all__ = (
     "BlockID",
     "Chunk",
     "ChunkID",
+    "ChunkIndex",
     # organizations
     "OrganizationStats",
     "OrganizationConfig",
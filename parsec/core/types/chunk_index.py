@@ -0,0 +1,206 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Sequence, Tuple, Union, overload
+
+if TYPE_CHECKING:
+    from parsec.core.types.manifest import Chunk
+
+
+__all__ = ("ChunkIndex",)
+
+
+Chunks = Tuple["Chunk", ...]
+
+# Each node of the tree has up to 32 children
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+
+def _is_reshaped(chunks: Chunks) -> bool:
+    return len(chunks) == 1 and chunks[0].is_block
+
+
+class _Node:
+    """A node of the tree, along with the number of blocks to reshape below it.
+
+    The children of a leaf are the chunks of the blocks, the children of the
+    other nodes are nodes.
+    """
+
+    __slots__ = ("children", "dirty")
+
+    def __init__(self, children: tuple, dirty: int):
+        self.children = children
+        self.dirty = dirty
+
+    @classmethod
+    def leaf(cls, children: Tuple[Chunks, ...]) -> "_Node":
+        return cls(children, sum(not _is_reshaped(chunks) for chunks in children))
+
+    @classmethod
+    def branch(cls, children: Tuple["_Node", ...]) -> "_Node":
+        return cls(children, sum(child.dirty for child in children))
+
+
+_EMPTY_LEAF = _Node((), 0)
+
+
+class ChunkIndex(Sequence[Chunks]):
+    """An immutable sequence of blocks, each block being a tuple of chunks.
+
+    The blocks are stored in a 32-ary tree sharing its unchanged nodes between
+    the successive versions of a file manifest, so updating, appending or
+    truncating the blocks is O(log n) instead of copying all of them. The nodes
+    also count the blocks that are not reshaped yet, so they can be found
+    without walking through the whole file.
+    """
+
+    __slots__ = ("_root", "_length", "_shift")
+
+    def __init__(self, root: _Node = _EMPTY_LEAF, length: int = 0, shift: int = 0):
+        self._root = root
+        self._length = length
+        self._shift = shift
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[Chunks]) -> "ChunkIndex":
+        if isinstance(blocks, ChunkIndex):
+            return blocks
+
+        # Build the tree bottom-up
+        items = [tuple(chunks) for chunks in blocks]
+        if not items:
+            return cls()
+        nodes = [_Node.leaf(tuple(items[i : i + WIDTH])) for i in range(0, len(items), WIDTH)]
+        shift = 0
+        while len(nodes) > 1:
+            nodes = [_Node.branch(tuple(nodes[i : i + WIDTH])) for i in range(0, len(nodes), WIDTH)]
+            shift += BITS
+        return cls(nodes[0], len(items), shift)
+
+    # Sequence interface
+
+    def __len__(self) -> int:
+        return self._length
+
+    @overload
+    def __getitem__(self, index: int) -> Chunks:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> Tuple[Chunks, ...]:
+        ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Chunks, Tuple[Chunks, ...]]:
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(self._length)))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        node = self._root
+        for shift in range(self._shift, 0, -BITS):
+            node = node.children[(index >> shift) & MASK]
+        return node.children[index & MASK]
+
+    def __iter__(self) -> Iterator[Chunks]:
+        return self._iter(self._root, self._shift)
+
+    def _iter(self, node: _Node, shift: int) -> Iterator[Chunks]:
+        if not shift:
+            yield from node.children
+            return
+        for child in node.children:
+            yield from self._iter(child, shift - BITS)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, ChunkIndex):
+            if self._root is other._root:
+                return True
+            return self._length == other._length and all(
+                chunks == other_chunks for chunks, other_chunks in zip(self, other)
+            )
+        if isinstance(other, (tuple, list)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({tuple(self)!r})"
+
+    # Reshaping
+
+    def is_reshaped(self) -> bool:
+        return not self._root.dirty
+
+    def iter_not_reshaped(self) -> Iterator[Tuple[int, Chunks]]:
+        """Iterate over the blocks that are not made of a single block chunk."""
+        return self._iter_not_reshaped(self._root, self._shift, 0)
+
+    def _iter_not_reshaped(
+        self, node: _Node, shift: int, start: int
+    ) -> Iterator[Tuple[int, Chunks]]:
+        if not shift:
+            for i, chunks in enumerate(node.children):
+                if not _is_reshaped(chunks):
+                    yield start + i, chunks
+            return
+        for i, child in enumerate(node.children):
+            if child.dirty:
+                yield from self._iter_not_reshaped(child, shift - BITS, start + (i << shift))
+
+    # Persistent updates
+
+    def set(self, index: int, chunks: Chunks) -> "ChunkIndex":
+        """Return a new index with the given block replaced, or appended if
+        `index` is the number of blocks.
+        """
+        if not 0 <= index <= self._length:
+            raise IndexError(index)
+        root, shift = self._root, self._shift
+
+        # The tree is full, add a level
+        if index >> shift >= WIDTH:
+            root = _Node.branch((root,))
+            shift += BITS
+
+        root = self._set(root, shift, index, tuple(chunks))
+        return ChunkIndex(root, max(self._length, index + 1), shift)
+
+    def _set(self, node: Optional[_Node], shift: int, index: int, chunks: Chunks) -> _Node:
+        position = (index >> shift) & MASK
+        children, dirty = ((), 0) if node is None else (node.children, node.dirty)
+        old = children[position] if position < len(children) else None
+
+        # Copy the path to the block, updating the number of blocks to reshape
+        new: Union[_Node, Chunks]
+        if shift:
+            new = self._set(old, shift - BITS, index, chunks)
+            dirty += new.dirty - (0 if old is None else old.dirty)
+        else:
+            new = chunks
+            dirty += (not _is_reshaped(chunks)) - (old is not None and not _is_reshaped(old))
+        return _Node(children[:position] + (new,) + children[position + 1 :], dirty)
+
+    def truncate(self, length: int) -> "ChunkIndex":
+        """Return a new index with the first `length` blocks only."""
+        if length >= self._length:
+            return self
+        if length <= 0:
+            return ChunkIndex()
+        root, shift = self._truncate(self._root, self._shift, length - 1), self._shift
+
+        # Remove the useless levels
+        while shift and len(root.children) == 1:
+            root = root.children[0]
+            shift -= BITS
+        return ChunkIndex(root, length, shift)
+
+    def _truncate(self, node: _Node, shift: int, last: int) -> _Node:
+        position = (last >> shift) & MASK
+        if not shift:
+            return _Node.leaf(node.children[: position + 1])
+        last_child = self._truncate(node.children[position], shift - BITS, last)
+        return _Node.branch(node.children[:position] + (last_child,))
@@ -25,7 +25,9 @@ from parsec.api.data import (
     EntryNameField,
     EntryIDField,
 )
+from parsec.api.data.base import DataValidationError
 from parsec.core.types.base import BaseLocalData
+from parsec.core.types.chunk_index import ChunkIndex
 from enum import Enum
 
 __all__ = (
@@ -236,6 +238,42 @@ class BaseLocalManifest(BaseLocalData):
     updated: DateTime
     base: BaseRemoteManifest  # base must be overwritten in subclass
 
+    # Serialization
+
+    def dump(self) -> bytes:
+        """
+        Raises:
+            DataError
+        """
+        # File and folder manifests use a compact format, much cheaper to (de)serialize
+        from parsec.core.types.manifest_packing import pack_local_manifest
+
+        raw = pack_local_manifest(self)
+        if raw is None:
+            return super().dump()
+        return raw
+
+    @classmethod
+    def load(cls, raw: bytes, **kwargs: object) -> "BaseLocalManifest":
+        """
+        Raises:
+            DataError
+        """
+        from parsec.core.types.manifest_packing import (
+            is_packed_local_manifest,
+            unpack_local_manifest,
+        )
+
+        # Manifests stored before the compact format was introduced use the legacy format
+        if not is_packed_local_manifest(raw):
+            return super().load(raw, **kwargs)
+        manifest = unpack_local_manifest(raw)
+        if not isinstance(manifest, cls):
+            raise DataValidationError(
+                f"Invalid manifest type: expected {cls.__name__}, got {type(manifest).__name__}"
+            )
+        return manifest
+
     # Properties
 
     @property
@@ -355,7 +393,7 @@ class LocalFileManifest(BaseLocalManifest):
     base: RemoteFileManifest
     size: int
     blocksize: int
-    blocks: Tuple[Tuple[Chunk, ...], ...]
+    blocks: ChunkIndex = attr.ib(converter=ChunkIndex.from_blocks)
 
     @classmethod
     def new_placeholder(
@@ -409,16 +447,11 @@ class LocalFileManifest(BaseLocalManifest):
             return ()
 
     def is_reshaped(self) -> bool:
-        for chunks in self.blocks:
-            if len(chunks) != 1:
-                return False
-            if not chunks[0].is_block:
-                return False
-        return True
+        return self.blocks.is_reshaped()
 
     def assert_integrity(self) -> None:
         current = 0
-        assert isinstance(self.blocks, tuple)
+        assert isinstance(self.blocks, ChunkIndex)
         for i, chunks in enumerate(self.blocks):
             assert i * self.blocksize == current
             assert isinstance(chunks, tuple)
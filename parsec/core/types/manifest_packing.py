@@ -0,0 +1,312 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+"""Compact binary format for the local manifests.
+
+The local manifests are serialized each time they are written to the local storage
+(e.g. at each checkpoint of a file write), so it has to be cheap. The legacy format
+goes through the marshmallow schemas and msgpack, which gets slow for big files made
+of thousands of chunks. This format is schema-less and made of fixed-width records,
+with the UUIDs stored as raw 16 bytes.
+
+Only the local file and folder manifests use this format, the other local manifests
+keep using the legacy format. Both formats are distinguished thanks to the magic
+header: a legacy manifest is a msgpack map and never starts with a null byte.
+
+Layout of a packed manifest (all integers are big-endian):
+- header: magic, format version (u8), manifest type (u8)
+- local fields, then base (remote manifest) fields
+- strings are prefixed by their size (u32), lists by their number of items (u32)
+"""
+
+from uuid import UUID
+from struct import Struct, error as StructError
+from typing import List, Optional, Tuple, Union
+from pendulum import from_timestamp
+
+from parsec.types import FrozenDict
+from parsec.crypto import SecretKey, HashDigest
+from parsec.api.protocol import DeviceID
+from parsec.api.data import (
+    EntryID,
+    EntryName,
+    BlockID,
+    BlockAccess,
+    FileManifest as RemoteFileManifest,
+    FolderManifest as RemoteFolderManifest,
+)
+from parsec.api.data.base import DataSerializationError
+from parsec.api.data.manifest import LOCAL_AUTHOR_LEGACY_PLACEHOLDER
+from parsec.core.types.manifest import Chunk, ChunkID, LocalFileManifest, LocalFolderManifest
+
+__all__ = ("is_packed_local_manifest", "pack_local_manifest", "unpack_local_manifest")
+
+
+MAGIC = b"\x00PLM"
+FORMAT_VERSION = 1
+FILE_MANIFEST_TYPE = 1
+FOLDER_MANIFEST_TYPE = 2
+
+_HEADER = Struct("!4sBB")
+_COUNT = Struct("!I")
+_ENTRY_ID = Struct("!16s")
+# need_sync, updated
+_LOCAL = Struct("!?d")
+# size, blocksize
+_LOCAL_FILE = Struct("!QQ")
+# timestamp, id, version, created, updated
+_BASE = Struct("!d16sQdd")
+# size, blocksize
+_BASE_FILE = Struct("!QQ")
+# id, key, offset, size, digest
+_BLOCK_ACCESS = Struct("!16s32sQQ32s")
+# id, start, stop, raw_offset, raw_size, has access, access (zeroed if missing)
+_CHUNK = Struct("!16sQQQQ?16s32sQQ32s")
+_NO_ACCESS = (False, bytes(16), bytes(32), 0, 0, bytes(32))
+
+LocalManifestsWithPacking = Union[LocalFileManifest, LocalFolderManifest]
+
+
+def is_packed_local_manifest(raw: bytes) -> bool:
+    return raw[: len(MAGIC)] == MAGIC
+
+
+# Packing
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode("utf8")
+    return _COUNT.pack(len(data)) + data
+
+
+def _pack_ids(ids: List[EntryID]) -> bytes:
+    return _COUNT.pack(len(ids)) + b"".join(entry_id.bytes for entry_id in ids)
+
+
+def _pack_children(children: FrozenDict) -> bytes:
+    parts = [_COUNT.pack(len(children))]
+    for name, entry_id in children.items():
+        parts.append(_pack_str(name))
+        parts.append(entry_id.bytes)
+    return b"".join(parts)
+
+
+def _pack_base(base: Union[RemoteFileManifest, RemoteFolderManifest]) -> bytes:
+    # Legacy manifests might not have an author
+    author = "" if base.author is None else str(base.author)
+    return b"".join(
+        (
+            _pack_str(author),
+            _BASE.pack(
+                base.timestamp.timestamp(),
+                base.id.bytes,
+                base.version,
+                base.created.timestamp(),
+                base.updated.timestamp(),
+            ),
+            base.parent.bytes,
+        )
+    )
+
+
+def _pack_block_access(access: BlockAccess) -> tuple:
+    return (access.id.bytes, access.key, access.offset, access.size, access.digest)
+
+
+def _pack_file_manifest(manifest: LocalFileManifest) -> bytes:
+    base = manifest.base
+    parts = [
+        _HEADER.pack(MAGIC, FORMAT_VERSION, FILE_MANIFEST_TYPE),
+        _LOCAL.pack(manifest.need_sync, manifest.updated.timestamp()),
+        _LOCAL_FILE.pack(manifest.size, manifest.blocksize),
+        _pack_base(base),
+        _BASE_FILE.pack(base.size, base.blocksize),
+        _COUNT.pack(len(base.blocks)),
+    ]
+    parts += [_BLOCK_ACCESS.pack(*_pack_block_access(access)) for access in base.blocks]
+    parts.append(_COUNT.pack(len(manifest.blocks)))
+    for chunks in manifest.blocks:
+        parts.append(_COUNT.pack(len(chunks)))
+        for chunk in chunks:
+            access = (
+                _NO_ACCESS if chunk.access is None else (True, *_pack_block_access(chunk.access))
+            )
+            parts.append(
+                _CHUNK.pack(
+                    chunk.id.bytes,
+                    chunk.start,
+                    chunk.stop,
+                    chunk.raw_offset,
+                    chunk.raw_size,
+                    *access,
+                )
+            )
+    return b"".join(parts)
+
+
+def _pack_folder_manifest(manifest: LocalFolderManifest) -> bytes:
+    return b"".join(
+        (
+            _HEADER.pack(MAGIC, FORMAT_VERSION, FOLDER_MANIFEST_TYPE),
+            _LOCAL.pack(manifest.need_sync, manifest.updated.timestamp()),
+            _pack_children(manifest.children),
+            _pack_ids(manifest.local_confinement_points),
+            _pack_ids(manifest.remote_confinement_points),
+            _pack_base(manifest.base),
+            _pack_children(manifest.base.children),
+        )
+    )
+
+
+def pack_local_manifest(manifest: object) -> Optional[bytes]:
+    """Return None if the manifest type doesn't support the compact format"""
+    # Subclasses (e.g. workspace manifest) are not supported
+    if type(manifest) is LocalFileManifest:
+        return _pack_file_manifest(manifest)
+    if type(manifest) is LocalFolderManifest:
+        return _pack_folder_manifest(manifest)
+    return None
+
+
+# Unpacking
+
+
+class _Reader:
+    __slots__ = ("raw", "offset")
+
+    def __init__(self, raw: bytes, offset: int = 0):
+        self.raw = raw
+        self.offset = offset
+
+    def unpack(self, struct: Struct) -> tuple:
+        values = struct.unpack_from(self.raw, self.offset)
+        self.offset += struct.size
+        return values
+
+    def iter_unpack(self, struct: Struct, count: int) -> List[tuple]:
+        stop = self.offset + struct.size * count
+        if stop > len(self.raw):
+            raise DataSerializationError("Invalid packed manifest: truncated data")
+        values = list(struct.iter_unpack(self.raw[self.offset : stop]))
+        self.offset = stop
+        return values
+
+    def count(self) -> int:
+        return self.unpack(_COUNT)[0]
+
+    def str(self) -> str:
+        size = self.count()
+        stop = self.offset + size
+        if stop > len(self.raw):
+            raise DataSerializationError("Invalid packed manifest: truncated data")
+        value = self.raw[self.offset : stop].decode("utf8")
+        self.offset = stop
+        return value
+
+    def entry_id(self) -> EntryID:
+        return EntryID(self.unpack(_ENTRY_ID)[0])
+
+    def ids(self) -> frozenset:
+        return frozenset(EntryID(raw) for raw, in self.iter_unpack(_ENTRY_ID, self.count()))
+
+    def children(self) -> FrozenDict:
+        return FrozenDict((EntryName(self.str()), self.entry_id()) for _ in range(self.count()))
+
+
+def _unpack_block_access(id: bytes, key: bytes, offset: int, size: int, digest: bytes):
+    return BlockAccess(
+        id=BlockID(UUID(bytes=id)),
+        key=SecretKey(key),
+        offset=offset,
+        size=size,
+        digest=HashDigest(digest),
+    )
+
+
+def _unpack_chunk(
+    id: bytes, start: int, stop: int, raw_offset: int, raw_size: int, has_access: bool, *access
+) -> Chunk:
+    return Chunk(
+        id=ChunkID(UUID(bytes=id)),
+        start=start,
+        stop=stop,
+        raw_offset=raw_offset,
+        raw_size=raw_size,
+        access=_unpack_block_access(*access) if has_access else None,
+    )
+
+
+def _unpack_base(reader: _Reader) -> dict:
+    author = reader.str()
+    timestamp, id, version, created, updated = reader.unpack(_BASE)
+    return dict(
+        author=DeviceID(author) if author else LOCAL_AUTHOR_LEGACY_PLACEHOLDER,
+        timestamp=from_timestamp(timestamp),
+        id=EntryID(id),
+        parent=reader.entry_id(),
+        version=version,
+        created=from_timestamp(created),
+        updated=from_timestamp(updated),
+    )
+
+
+def _unpack_file_manifest(reader: _Reader) -> LocalFileManifest:
+    need_sync, updated = reader.unpack(_LOCAL)
+    size, blocksize = reader.unpack(_LOCAL_FILE)
+    base = _unpack_base(reader)
+    base["size"], base["blocksize"] = reader.unpack(_BASE_FILE)
+    base["blocks"] = tuple(
+        _unpack_block_access(*values)
+        for values in reader.iter_unpack(_BLOCK_ACCESS, reader.count())
+    )
+    blocks: List[Tuple[Chunk, ...]] = []
+    for _ in range(reader.count()):
+        chunks = reader.iter_unpack(_CHUNK, reader.count())
+        blocks.append(tuple(_unpack_chunk(*values) for values in chunks))
+    return LocalFileManifest(
+        base=RemoteFileManifest(**base),
+        need_sync=need_sync,
+        updated=from_timestamp(updated),
+        size=size,
+        blocksize=blocksize,
+        blocks=tuple(blocks),
+    )
+
+
+def _unpack_folder_manifest(reader: _Reader) -> LocalFolderManifest:
+    need_sync, updated = reader.unpack(_LOCAL)
+    children = reader.children()
+    local_confinement_points = reader.ids()
+    remote_confinement_points = reader.ids()
+    base = _unpack_base(reader)
+    base["children"] = reader.children()
+    return LocalFolderManifest(
+        base=RemoteFolderManifest(**base),
+        need_sync=need_sync,
+        updated=from_timestamp(updated),
+        children=children,
+        local_confinement_points=local_confinement_points,
+        remote_confinement_points=remote_confinement_points,
+    )
+
+
+def unpack_local_manifest(raw: bytes) -> LocalManifestsWithPacking:
+    """
+    Raises:
+        DataSerializationError
+    """
+    try:
+        reader = _Reader(raw)
+        magic, version, manifest_type = reader.unpack(_HEADER)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise DataSerializationError("Invalid packed manifest: unknown format")
+        if manifest_type == FILE_MANIFEST_TYPE:
+            manifest: LocalManifestsWithPacking = _unpack_file_manifest(reader)
+        elif manifest_type == FOLDER_MANIFEST_TYPE:
+            manifest = _unpack_folder_manifest(reader)
+        else:
+            raise DataSerializationError("Invalid packed manifest: unknown manifest type")
+    except (StructError, UnicodeDecodeError, ValueError) as exc:
+        raise DataSerializationError(f"Invalid packed manifest: {exc}") from exc
+    if reader.offset != len(raw):
+        raise DataSerializationError("Invalid packed manifest: extra data")
+    return manifest
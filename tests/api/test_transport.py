@@ -1,11 +1,18 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import os
+import time
+import tracemalloc
 import pytest
 import trio
+import pendulum
+from uuid import uuid4
 from functools import partial
 
 from parsec.serde import BaseSchema, fields
-from parsec.api.transport import Transport, TransportClosedByPeer
+from parsec.api.transport import Transport, TransportError, TransportClosedByPeer
+from parsec.api.data import RealmRoleCertificateContent
+from parsec.api.protocol import packb, UserID, RealmRole
 from parsec.api.protocol.base import MsgpackSerializer
 
 
@@ -116,4 +123,151 @@ async def test_big_buffer_bench(backend_addr):
         del raw
 
 
+@pytest.fixture
+async def memory_transports_factory(backend_addr):
+    async def _memory_transports_factory():
+        server_stream, client_stream = trio.testing.memory_stream_pair()
+        transports = {}
+
+        async def _boot_server():
+            transports["server"] = await Transport.init_for_server(server_stream)
+
+        async def _boot_client():
+            transports["client"] = await Transport.init_for_client(
+                client_stream, host=backend_addr.hostname
+            )
+
+        async with trio.open_service_nursery() as nursery:
+            nursery.start_soon(_boot_client)
+            nursery.start_soon(_boot_server)
+
+        # Count the bytes and the frames that have been sent by each end
+        def _count_sent(transport, stream):
+            transport.sent_bytes = 0
+            transport.sent_frames = 0
+            send_all = stream.send_all
+
+            async def _counting_send_all(data):
+                transport.sent_bytes += len(data)
+                transport.sent_frames += 1
+                await send_all(data)
+
+            stream.send_all = _counting_send_all
+
+        _count_sent(transports["client"], client_stream)
+        _count_sent(transports["server"], server_stream)
+        return transports["client"], transports["server"]
+
+    return _memory_transports_factory
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("compress", [True, False])
+@pytest.mark.parametrize(
+    "size", [0, 10, Transport.SEND_FRAGMENT_BYTES, 3 * Transport.SEND_FRAGMENT_BYTES + 1]
+)
+async def test_send_fragmented_messages(memory_transports_factory, compress, size):
+    client_transport, server_transport = await memory_transports_factory()
+    frames = max(1, -(-size // Transport.SEND_FRAGMENT_BYTES))
+
+    for msg, compressible in ((b"x" * size, size > 10), (os.urandom(size), False)):
+        client_transport.sent_bytes = client_transport.sent_frames = 0
+        async with trio.open_service_nursery() as nursery:
+            nursery.start_soon(partial(client_transport.send, msg, compress=compress))
+            assert await server_transport.recv() == msg
+        assert client_transport.sent_frames == frames
+        # Each frame has a header of at most 14 bytes
+        max_uncompressed_size = size + 14 * frames
+        if compress and compressible:
+            assert client_transport.sent_bytes < size
+        elif not compress:
+            assert size < client_transport.sent_bytes <= max_uncompressed_size
+
+        # Transport is still usable in the other direction, where the frames are not masked
+        server_transport.sent_frames = 0
+        async with trio.open_service_nursery() as nursery:
+            nursery.start_soon(partial(server_transport.send, msg, compress=compress))
+            assert await client_transport.recv() == msg
+        assert server_transport.sent_frames == frames
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("compress", [True, False])
+async def test_recv_message_too_big(memory_transports_factory, monkeypatch, compress):
+    monkeypatch.setattr(Transport, "MAX_MESSAGE_BYTES", 1024)
+    client_transport, server_transport = await memory_transports_factory()
+
+    async with trio.open_service_nursery() as nursery:
+        nursery.start_soon(partial(client_transport.send, b"x" * 1024, compress=compress))
+        assert await server_transport.recv() == b"x" * 1024
+
+    # A message too big is rejected, no matter how small it is once compressed
+    async with trio.open_service_nursery() as nursery:
+        nursery.start_soon(partial(client_transport.send, b"x" * 10 ** 6, compress=compress))
+        with pytest.raises(TransportError) as exc:
+            await server_transport.recv()
+        assert not isinstance(exc.value, TransportClosedByPeer)
+        assert str(exc.value) == "Message too big"
+    if compress:
+        # The message has not been decompressed beyond the maximum size
+        assert server_transport._deflate.inbound_too_big
+        assert client_transport.sent_bytes < 2048
+
+
+# Basically a benchmark to measure the size on the wire, the time and the memory
+# needed to send metadata (compressed) and blocks (fragmented) messages
+@pytest.mark.slow
+@pytest.mark.trio
+async def test_send_bench(memory_transports_factory, monkeypatch, alice):
+    # Certificates are signed and already compressed, just like the ones
+    # returned by `realm_get_role_certificates`
+    realm_id = uuid4()
+    now = pendulum.now()
+    metadata = packb(
+        {
+            "status": "ok",
+            "certificates": [
+                RealmRoleCertificateContent(
+                    author=alice.device_id,
+                    timestamp=now.add(seconds=i),
+                    realm_id=realm_id,
+                    user_id=UserID(f"user{i}"),
+                    role=RealmRole.READER,
+                ).dump_and_sign(alice.signing_key)
+                for i in range(1000)
+            ],
+        }
+    )
+    block = packb({"cmd": "block_create", "block": os.urandom(512 * 1024)})
+    block_reply = packb({"status": "ok", "block": os.urandom(512 * 1024)})
+
+    async def _measure(name, msg, compress, from_server=False):
+        client_transport, server_transport = await memory_transports_factory()
+        if from_server:
+            sender, receiver = server_transport, client_transport
+        else:
+            sender, receiver = client_transport, server_transport
+        tracemalloc.start()
+        start = time.monotonic()
+        for _ in range(10):
+            async with trio.open_service_nursery() as nursery:
+                nursery.start_soon(partial(sender.send, msg, compress=compress))
+                assert await receiver.recv() == msg
+        duration = time.monotonic() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{name}: size={len(msg)} sent={sender.sent_bytes // 10} "
+            f"duration={duration:.3f}s peak_memory={peak_memory // 1024}Ko"
+        )
+
+    await _measure("metadata", metadata, compress=False)
+    await _measure("metadata compressed", metadata, compress=True)
+    await _measure("block", block, compress=False)
+    await _measure("block reply", block_reply, compress=False, from_server=True)
+    monkeypatch.setattr(Transport, "SEND_FRAGMENT_BYTES", len(block))
+    await _measure("block single frame", block, compress=False)
+    await _measure("block reply single frame", block_reply, compress=False, from_server=True)
+
+
 # TODO: test websocket can work with message sent across mutiple TCP frames
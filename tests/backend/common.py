@@ -18,6 +18,7 @@ from parsec.api.protocol import (
     realm_finish_reencryption_maintenance_serializer,
     vlob_create_serializer,
     vlob_read_serializer,
+    vlob_read_batch_serializer,
     vlob_update_serializer,
     vlob_list_versions_serializer,
     vlob_poll_changes_serializer,
@@ -210,6 +211,15 @@ vlob_read = CmdSock(
         "encryption_revision": encryption_revision,
     },
 )
+vlob_read_batch = CmdSock(
+    "vlob_read_batch",
+    vlob_read_batch_serializer,
+    parse_args=lambda self, realm_id, vlobs, encryption_revision=1: {
+        "realm_id": realm_id,
+        "vlobs": [{"vlob_id": vlob_id, "version": version} for vlob_id, version in vlobs],
+        "encryption_revision": encryption_revision,
+    },
+)
 vlob_update = CmdSock(
     "vlob_update",
     vlob_update_serializer,
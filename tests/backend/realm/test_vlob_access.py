@@ -12,10 +12,17 @@ from parsec.api.protocol import (
     vlob_update_serializer,
     vlob_list_versions_serializer,
 )
+from parsec.backend import vlob as backend_vlob_module
 from parsec.backend.realm import RealmGrantedRole
 
 from tests.common import freeze_time
-from tests.backend.common import vlob_create, vlob_update, vlob_read, vlob_list_versions
+from tests.backend.common import (
+    vlob_create,
+    vlob_update,
+    vlob_read,
+    vlob_read_batch,
+    vlob_list_versions,
+)
 
 
 VLOB_ID = UUID("00000000000000000000000000000001")
@@ -288,6 +295,111 @@ async def test_read_bad_version(alice_backend_sock, vlobs):
     assert rep == {"status": "bad_version"}
 
 
+@pytest.mark.trio
+async def test_read_batch_ok(backend, alice, alice_backend_sock, realm, other_realm, vlobs):
+    other_vlob_id = uuid4()
+    await backend.vlob.create(
+        organization_id=alice.organization_id,
+        author=alice.device_id,
+        realm_id=other_realm,
+        encryption_revision=1,
+        vlob_id=other_vlob_id,
+        timestamp=datetime(2000, 1, 2),
+        blob=b"r:B b:1 v:1",
+    )
+
+    rep = await vlob_read_batch(
+        alice_backend_sock,
+        realm,
+        [
+            (vlobs[0], None),
+            (vlobs[0], 1),
+            (vlobs[1], None),
+            # Unknown version, unknown vlob and vlob from another realm are omitted
+            (vlobs[1], 2),
+            (uuid4(), None),
+            (other_vlob_id, None),
+        ],
+    )
+    assert rep["status"] == "ok"
+    assert not rep["truncated"]
+    # The vlobs are returned in the requested order
+    assert rep["vlobs"] == [
+        {
+            "vlob_id": vlobs[0],
+            "version": 2,
+            "blob": b"r:A b:1 v:2",
+            "author": alice.device_id,
+            "timestamp": datetime(2000, 1, 3),
+        },
+        {
+            "vlob_id": vlobs[0],
+            "version": 1,
+            "blob": b"r:A b:1 v:1",
+            "author": alice.device_id,
+            "timestamp": datetime(2000, 1, 2),
+        },
+        {
+            "vlob_id": vlobs[1],
+            "version": 1,
+            "blob": b"r:A b:2 v:1",
+            "author": alice.device_id,
+            "timestamp": datetime(2000, 1, 4),
+        },
+    ]
+
+    rep = await vlob_read_batch(alice_backend_sock, realm, [])
+    assert rep == {"status": "ok", "vlobs": [], "truncated": False}
+
+
+@pytest.mark.trio
+async def test_read_batch_truncated(alice_backend_sock, realm, vlobs, monkeypatch):
+    # Each blob is 11 bytes long
+    monkeypatch.setattr(backend_vlob_module, "VLOB_READ_BATCH_MAX_BYTES", 20)
+
+    rep = await vlob_read_batch(alice_backend_sock, realm, [(vlobs[1], None), (vlobs[0], None)])
+    assert rep["status"] == "ok"
+    assert rep["truncated"]
+    assert [(x["vlob_id"], x["version"]) for x in rep["vlobs"]] == [(vlobs[1], 1)]
+
+    rep = await vlob_read_batch(alice_backend_sock, realm, [(vlobs[0], None), (vlobs[0], 1)])
+    assert rep["truncated"]
+    assert [(x["vlob_id"], x["version"]) for x in rep["vlobs"]] == [(vlobs[0], 2)]
+
+    # A vlob is always returned, even if it is bigger than the limit
+    monkeypatch.setattr(backend_vlob_module, "VLOB_READ_BATCH_MAX_BYTES", 5)
+    rep = await vlob_read_batch(alice_backend_sock, realm, [(vlobs[0], None)])
+    assert not rep["truncated"]
+    assert [(x["vlob_id"], x["version"]) for x in rep["vlobs"]] == [(vlobs[0], 2)]
+
+
+@pytest.mark.trio
+async def test_read_batch_not_found(alice_backend_sock, vlobs):
+    rep = await vlob_read_batch(alice_backend_sock, uuid4(), [(vlobs[0], None)])
+    assert rep["status"] == "not_found"
+
+
+@pytest.mark.trio
+async def test_read_batch_bad_encryption_revision(alice_backend_sock, realm, vlobs):
+    rep = await vlob_read_batch(
+        alice_backend_sock, realm, [(vlobs[0], None)], encryption_revision=42
+    )
+    assert rep == {"status": "bad_encryption_revision"}
+
+
+@pytest.mark.trio
+async def test_read_batch_check_access_rights(bob_backend_sock, realm, vlobs):
+    # Not part of the realm
+    rep = await vlob_read_batch(bob_backend_sock, realm, [(vlobs[0], None)])
+    assert rep == {"status": "not_allowed"}
+
+
+@pytest.mark.trio
+async def test_read_batch_too_many_vlobs(alice_backend_sock, realm, vlobs):
+    rep = await vlob_read_batch(alice_backend_sock, realm, [(vlobs[0], None)] * 1001)
+    assert rep["status"] == "bad_message"
+
+
 @pytest.mark.trio
 async def test_update_ok(alice_backend_sock, vlobs):
     await vlob_update(alice_backend_sock, vlobs[0], version=3, blob=b"Next version.")
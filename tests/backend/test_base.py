@@ -24,6 +24,32 @@ async def test_bad_cmd(alice_backend_sock):
     assert unpackb(rep) == {"status": "unknown_command", "reason": "Unknown command"}
 
 
+@pytest.mark.trio
+async def test_pipelined_requests(alice_backend_sock):
+    # Requests are sent without waiting for the replies
+    for req_id in range(3):
+        await alice_backend_sock.send(packb({"cmd": "ping", "ping": str(req_id), "req_id": req_id}))
+    await alice_backend_sock.send(packb({"cmd": "dummy", "req_id": 3}))
+
+    reps = [unpackb(await alice_backend_sock.recv()) for _ in range(4)]
+    assert sorted(reps, key=lambda rep: rep["req_id"]) == [
+        {"status": "ok", "pong": "0", "req_id": 0},
+        {"status": "ok", "pong": "1", "req_id": 1},
+        {"status": "ok", "pong": "2", "req_id": 2},
+        {"status": "unknown_command", "reason": "Unknown command", "req_id": 3},
+    ]
+
+
+@pytest.mark.trio
+async def test_pipelined_requests_bad_req_id(alice_backend_sock):
+    await alice_backend_sock.send(packb({"cmd": "ping", "ping": "42", "req_id": 0}))
+    assert unpackb(await alice_backend_sock.recv()) == {"status": "ok", "pong": "42", "req_id": 0}
+    # Once pipelined, the connection only accepts requests with an id
+    await alice_backend_sock.send(packb({"cmd": "ping", "ping": "42"}))
+    rep = await alice_backend_sock.recv()
+    assert unpackb(rep) == {"status": "invalid_msg_format", "reason": "Invalid message format"}
+
+
 @pytest.mark.trio
 @pytest.mark.parametrize(
     "close_on",
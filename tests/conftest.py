@@ -31,7 +31,7 @@ from parsec.core.types import BackendAddr
 from parsec.core.logged_core import logged_core_factory
 from parsec.core.backend_connection import BackendConnStatus
 from parsec.core.mountpoint.manager import get_mountpoint_runner
-from parsec.core.fs.storage import LocalDatabase, UserStorage
+from parsec.core.fs.storage import LocalDatabase, UserStorage, FileBlockStorage
 
 from parsec.backend import backend_app_factory
 from parsec.backend.config import (
@@ -420,15 +420,24 @@ def persistent_mockup(monkeypatch):
         storage_set.discard(storage)
         storage._conn = None
 
+    def open_read_cursor(storage):
+        # In-memory databases cannot be shared with read-only connections
+        return storage.open_cursor(commit=False)
+
     async def get_disk_usage(storage):
         return 0
 
     async def run_in_thread(storage, fn, *args):
         return fn(*args)
 
+    async def run_block_files_in_thread(fn, *args):
+        return fn(*args)
+
     monkeypatch.setattr(LocalDatabase, "run_in_thread", run_in_thread)
+    monkeypatch.setattr(FileBlockStorage, "run_in_thread", staticmethod(run_block_files_in_thread))
     monkeypatch.setattr(LocalDatabase, "_create_connection", _create_connection)
     monkeypatch.setattr(LocalDatabase, "_close", _close)
+    monkeypatch.setattr(LocalDatabase, "open_read_cursor", open_read_cursor)
     monkeypatch.setattr(LocalDatabase, "get_disk_usage", get_disk_usage)
 
     yield mockup_context
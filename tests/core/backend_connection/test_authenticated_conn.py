@@ -6,6 +6,7 @@ import trio
 from pendulum import datetime
 from parsec.backend.backend_events import BackendEvent
 from parsec.api.protocol import RealmRole, HandshakeType
+from parsec.api.version import ApiVersion
 from parsec.core.types import OrganizationConfig
 from parsec.core.backend_connection import (
     BackendAuthenticatedConn,
@@ -13,6 +14,7 @@ from parsec.core.backend_connection import (
     BackendNotAvailable,
     BackendConnectionRefused,
 )
+from parsec.core.backend_connection import transport as transport_module
 from parsec.core.core_events import CoreEvent
 
 
@@ -251,6 +253,119 @@ async def test_concurrency_sends(running_backend, alice, event_bus):
             await work_all_done.wait()
 
 
+@pytest.mark.trio
+async def test_pipelined_requests(running_backend, alice, event_bus):
+    conn = BackendAuthenticatedConn(
+        alice.organization_addr,
+        alice.device_id,
+        alice.signing_key,
+        event_bus,
+        max_pipelined_requests=4,
+    )
+    async with conn.run():
+        reps = {}
+
+        async def sender(x):
+            reps[x] = await conn.cmds.ping(x)
+
+        async with trio.open_service_nursery() as nursery:
+            for x in range(10):
+                nursery.start_soon(sender, str(x))
+
+        assert reps == {str(x): {"status": "ok", "pong": str(x)} for x in range(10)}
+        # All the requests have been sent over the same connection
+        assert conn._pipelined_transport is not None
+        assert not conn._pipelined_transport.closed
+
+
+@pytest.mark.trio
+async def test_pipelined_requests_unsupported(running_backend, alice, event_bus, monkeypatch):
+    conn = BackendAuthenticatedConn(
+        alice.organization_addr,
+        alice.device_id,
+        alice.signing_key,
+        event_bus,
+        max_pipelined_requests=4,
+    )
+
+    # The backend is too old for pipelined requests
+    vanilla_connect = conn._connect
+
+    async def _connect():
+        transport = await vanilla_connect()
+        transport.handshake.backend_api_version = ApiVersion(2, 3)
+        return transport
+
+    monkeypatch.setattr(conn, "_connect", _connect)
+
+    async with conn.run():
+        rep = await conn.cmds.ping("foo")
+        assert rep == {"status": "ok", "pong": "foo"}
+        # The requests go through the transport pool instead
+        assert conn._max_pipelined_requests == 0
+        assert conn._pipelined_transport is None
+        assert conn.get_transport_pool_statistics().acquired_count > 0
+
+
+@pytest.mark.trio
+async def test_pipelined_transport_reconnect(running_backend, alice, event_bus, monkeypatch):
+    conn = BackendAuthenticatedConn(
+        alice.organization_addr,
+        alice.device_id,
+        alice.signing_key,
+        event_bus,
+        max_pipelined_requests=4,
+    )
+    async with conn.run():
+        await conn.cmds.ping("foo")
+        first_transport = conn._pipelined_transport
+
+        # The backend closes the connection
+        first_transport.transport.stream.receive_stream.put_eof()
+        with trio.fail_after(1):
+            while not first_transport.closed:
+                await trio.sleep(0.01)
+
+        # A new connection is opened for the next requests
+        rep = await conn.cmds.ping("bar")
+        assert rep == {"status": "ok", "pong": "bar"}
+        second_transport = conn._pipelined_transport
+        assert second_transport is not first_transport
+        assert not second_transport.closed
+
+        # The connection gets stuck while sending a request
+        async def _send(*args, **kwargs):
+            await trio.sleep_forever()
+
+        monkeypatch.setattr(second_transport.transport, "send", _send)
+        monkeypatch.setattr(transport_module, "PIPELINED_SEND_TIMEOUT", 0.01)
+        with trio.fail_after(1):
+            rep = await conn.cmds.ping("baz")
+        # The request is retried over a fresh connection
+        assert rep == {"status": "ok", "pong": "baz"}
+        assert second_transport.closed
+        assert conn._pipelined_transport is second_transport
+
+
+@pytest.mark.trio
+async def test_idle_transports_closer(autojump_clock, running_backend, alice, event_bus):
+    conn = BackendAuthenticatedConn(
+        alice.organization_addr, alice.device_id, alice.signing_key, event_bus, idle_timeout=10
+    )
+    async with conn.run():
+        await conn.wait_idle_monitors()
+        # The transport is released between two checks
+        await trio.sleep(3)
+        await conn.cmds.ping("foo")
+        statistics = conn.get_transport_pool_statistics()
+        assert statistics.connections - statistics.busy_connections == 1
+
+        # It gets closed once idle for too long, rather than at the next periodic check
+        await trio.sleep(10.5)
+        statistics = conn.get_transport_pool_statistics()
+        assert statistics.connections - statistics.busy_connections == 0
+
+
 @pytest.mark.trio
 async def test_realm_notif_on_new_entry_sync(running_backend, alice_backend_conn, alice2_user_fs):
     wid = await alice2_user_fs.workspace_create("foo")
@@ -0,0 +1,116 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import pytest
+import trio
+
+from parsec.core.backend_connection.transport import TransportPool
+
+
+class FakeTransport:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    @property
+    def logger(self):
+        return self
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connected():
+    return []
+
+
+@pytest.fixture
+def pool_factory(connected):
+    def _pool_factory(max_pool=2, idle_timeout=None):
+        async def _connect():
+            transport = FakeTransport(len(connected))
+            connected.append(transport)
+            return transport
+
+        return TransportPool(_connect, max_pool=max_pool, idle_timeout=idle_timeout)
+
+    return _pool_factory
+
+
+@pytest.mark.trio
+async def test_pool_grows_on_demand(autojump_clock, pool_factory, connected):
+    pool = pool_factory(max_pool=2)
+
+    # Sequential requests share the same connection
+    for _ in range(3):
+        async with pool.acquire():
+            pass
+    assert len(connected) == 1
+
+    async def _request(task_status=trio.TASK_STATUS_IGNORED):
+        async with pool.acquire():
+            task_status.started()
+            await trio.sleep(1)
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(3):
+            await nursery.start(_request)
+    # Concurrent requests open new connections up to the ceiling
+    assert len(connected) == 2
+
+    statistics = pool.statistics()
+    assert statistics.connections == 2
+    assert statistics.busy_connections == 0
+    assert statistics.utilisation == 0
+    assert statistics.acquired_count == 6
+    # The last request had to wait for a connection to be released
+    assert statistics.max_wait_time == pytest.approx(1)
+    assert statistics.mean_wait_time == pytest.approx(1 / 6)
+
+
+@pytest.mark.trio
+async def test_pool_picks_fastest_transport(autojump_clock, pool_factory):
+    pool = pool_factory(max_pool=2)
+
+    async with pool.acquire() as slow:
+        async with pool.acquire() as fast:
+            assert fast is not slow
+            assert pool.statistics().utilisation == 1
+        await trio.sleep(1)
+
+    for _ in range(3):
+        async with pool.acquire() as transport:
+            assert transport is fast
+            await trio.sleep(0.1)
+
+
+@pytest.mark.trio
+async def test_pool_closes_idle_transports(autojump_clock, pool_factory, connected):
+    pool = pool_factory(max_pool=2, idle_timeout=10)
+
+    async with pool.acquire():
+        async with pool.acquire():
+            pass
+    await trio.sleep(5)
+    async with pool.acquire() as used:
+        pass
+
+    await trio.sleep(5)
+    # The remaining transport is going to be idle for too long in 5 seconds
+    assert await pool.close_idle_transports() == trio.current_time() + 5
+    assert [transport.closed for transport in connected] == [
+        transport is not used for transport in connected
+    ]
+    assert pool.statistics().connections == 1
+
+    await trio.sleep(5)
+    assert await pool.close_idle_transports() is None
+    assert [transport.closed for transport in connected] == [True, True]
+    assert pool.statistics().connections == 0
+
+    # New connections are opened on demand
+    async with pool.acquire() as transport:
+        assert transport is connected[2]
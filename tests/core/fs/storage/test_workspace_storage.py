@@ -1,14 +1,19 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import time
+import threading
 from pathlib import Path
 
+import trio
 import pytest
 from pendulum import now
 
+from parsec.api.data import DataError
 from parsec.api.data.manifest import LOCAL_AUTHOR_LEGACY_PLACEHOLDER
-from parsec.core.fs.storage import WorkspaceStorage
+from parsec.core.fs.storage import LocalDatabase, WorkspaceStorage, BlockStorage, FileBlockStorage
+from parsec.core.fs.storage.workspace_storage import DEFAULT_CHUNK_MEMORY_CACHE_SIZE
 from parsec.core.fs import FSError, FSInvalidFileDescriptor
-from parsec.core.fs.exceptions import FSLocalMissError
+from parsec.core.fs.exceptions import FSLocalMissError, FSLocalStorageOperationalError
 from parsec.core.types import (
     DEFAULT_BLOCK_SIZE,
     LocalUserManifest,
@@ -16,8 +21,11 @@ from parsec.core.types import (
     LocalFolderManifest,
     LocalFileManifest,
     EntryID,
+    ChunkID,
     Chunk,
 )
+from parsec.core.types.base import BaseLocalData
+from parsec.core.types.manifest import BaseLocalManifest
 
 
 def create_manifest(device, type=LocalWorkspaceManifest, use_legacy_none_author=False):
@@ -280,6 +288,78 @@ async def test_serialize_non_empty_local_file_manifest(tmpdir, alice, workspace_
         assert await aws2.get_manifest(manifest.id) == manifest
 
 
+def create_big_file_manifest(device, nb_chunks):
+    manifest = create_manifest(device, LocalFileManifest)
+    blocks = [(Chunk.new(i * 8, i * 8 + 8).evolve_as_block(b"01234567"),) for i in range(nb_chunks)]
+    blocks[-1] += (Chunk.new(nb_chunks * 8, nb_chunks * 8 + 3),)
+    manifest = manifest.evolve_and_mark_updated(
+        blocksize=8, size=nb_chunks * 8 + 3, blocks=tuple(blocks)
+    )
+    manifest.assert_integrity()
+    return manifest
+
+
+@pytest.mark.parametrize("type", [LocalFolderManifest, LocalFileManifest])
+def test_compact_manifest_format(alice, type):
+    if type is LocalFileManifest:
+        manifest = create_big_file_manifest(alice, 10)
+    else:
+        manifest = create_manifest(alice, type)
+        children = {"a": EntryID.new(), "b": EntryID.new()}
+        manifest = manifest.evolve_and_mark_updated(
+            children=children,
+            local_confinement_points=frozenset({children["a"]}),
+            remote_confinement_points=frozenset({EntryID.new()}),
+        )
+
+    raw = manifest.dump()
+    assert raw != BaseLocalData.dump(manifest)
+    assert BaseLocalManifest.load(raw) == manifest
+    assert type.load(raw) == manifest
+    # Type mismatch
+    other_type = LocalFileManifest if type is LocalFolderManifest else LocalFolderManifest
+    with pytest.raises(DataError):
+        other_type.load(raw)
+    # Corrupted data
+    for corrupted in (raw[:-1], raw + b"\x00", raw[:4] + b"\xff" + raw[5:]):
+        with pytest.raises(DataError):
+            BaseLocalManifest.load(corrupted)
+
+
+@pytest.mark.parametrize("type", [LocalFolderManifest, LocalFileManifest])
+@pytest.mark.trio
+async def test_deserialize_legacy_format(tmpdir, alice, workspace_id, type):
+    # Manifests stored before the compact format use the msgpack serializer
+    manifest = create_manifest(alice, type)
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id) as aws:
+        async with aws.lock_entry_id(manifest.id):
+            await aws.set_manifest(manifest.id, manifest)
+        ciphered = aws.device.local_symkey.encrypt(BaseLocalData.dump(manifest))
+        async with aws.manifest_storage._open_cursor() as cursor:
+            cursor.execute(
+                "UPDATE vlobs SET blob = ? WHERE vlob_id = ?", (ciphered, manifest.id.bytes)
+            )
+
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id) as aws2:
+        assert await aws2.get_manifest(manifest.id) == manifest
+
+
+# Basically a benchmark to compare the legacy and compact manifest formats
+@pytest.mark.slow
+def test_compact_manifest_format_bench(alice):
+    manifest = create_big_file_manifest(alice, 5000)
+    for name, dump, load in [
+        ("legacy", BaseLocalData.dump, BaseLocalData.load.__func__),
+        ("compact", LocalFileManifest.dump, LocalFileManifest.load.__func__),
+    ]:
+        start = time.monotonic()
+        raw = dump(manifest)
+        dumped = time.monotonic()
+        assert load(LocalFileManifest, raw) == manifest
+        loaded = time.monotonic()
+        print(f"{name}: size={len(raw)} dump={dumped - start:.3f}s load={loaded - dumped:.3f}s")
+
+
 @pytest.mark.trio
 async def test_realm_checkpoint(alice_workspace_storage):
     aws = alice_workspace_storage
@@ -356,6 +436,38 @@ async def test_block_interface(alice_workspace_storage):
     assert await aws.get_dirty_block(block_id) == data
 
 
+@pytest.mark.trio
+@pytest.mark.parametrize("block_files", [False, True])
+async def test_deduplicated_block_index(tmpdir, alice, workspace_id, block_files):
+    access = Chunk.new(0, 7).evolve_as_block(b"0123456").access
+    other_access = Chunk.new(0, 7).evolve_as_block(b"0123456").access
+    digest = b"a" * 64
+
+    async with WorkspaceStorage.run(
+        alice, Path(tmpdir), workspace_id, block_files=block_files
+    ) as aws:
+        with pytest.raises(FSLocalMissError):
+            await aws.get_deduplicated_block(digest)
+        await aws.set_deduplicated_block(digest, access)
+        assert await aws.get_deduplicated_block(digest) == access
+        await aws.set_deduplicated_block(digest, other_access)
+        assert await aws.get_deduplicated_block(digest) == other_access
+
+        # The index is shared with the timestamped storages
+        aws2 = aws.to_timestamped(now())
+        assert await aws2.get_deduplicated_block(digest) == other_access
+
+        # The index is not cleared along with the blocks
+        await aws.block_storage.clear_all_blocks()
+        assert await aws.get_deduplicated_block(digest) == other_access
+
+    # The index is persistent
+    async with WorkspaceStorage.run(
+        alice, Path(tmpdir), workspace_id, block_files=block_files
+    ) as aws:
+        assert await aws.get_deduplicated_block(digest) == other_access
+
+
 @pytest.mark.trio
 async def test_chunk_interface(alice_workspace_storage):
     data = b"0123456"
@@ -385,6 +497,166 @@ async def test_chunk_interface(alice_workspace_storage):
     await aws.clear_chunk(chunk.id, miss_ok=True)
 
 
+@pytest.mark.trio
+@pytest.mark.parametrize("block_files", [False, True])
+async def test_chunks_batch_interface(tmpdir, alice, workspace_id, block_files):
+    chunks = [Chunk.new(0, 7) for _ in range(600)]
+    items = [(chunk.id, str(i).encode()) for i, chunk in enumerate(chunks)]
+    block = Chunk.new(0, 7).evolve_as_block(b"block")
+
+    async with WorkspaceStorage.run(
+        alice, Path(tmpdir), workspace_id, block_files=block_files
+    ) as aws:
+        assert await aws.get_chunks([chunk.id for chunk in chunks]) == {}
+        with pytest.raises(FSLocalMissError):
+            await aws.clear_chunks([chunks[0].id])
+        await aws.clear_chunks([chunks[0].id], miss_ok=True)
+
+        # More chunks than the sqlite limit of parameters for a single query
+        await aws.set_chunks(items)
+        await aws.set_clean_block(block.access.id, b"block")
+        assert await aws.chunk_storage.get_nb_blocks() == 600
+        result = await aws.get_chunks([block.id, *(chunk.id for chunk in chunks)])
+        assert result == {block.id: b"block", **dict(items)}
+
+        # Missing chunks are left out
+        missing = Chunk.new(0, 7)
+        assert await aws.get_chunks([missing.id, chunks[1].id]) == {chunks[1].id: b"1"}
+
+        # The chunks are cleared even if some of them are missing
+        with pytest.raises(FSLocalMissError):
+            await aws.clear_chunks([missing.id, chunks[0].id, chunks[1].id])
+        assert await aws.get_chunks([chunks[0].id, chunks[1].id]) == {}
+        await aws.clear_chunks((chunk.id for chunk in chunks[2:]), miss_ok=True)
+        assert await aws.chunk_storage.get_nb_blocks() == 0
+
+        # The timestamped workspace is read-only
+        aws2 = aws.to_timestamped(now())
+        assert await aws2.get_chunks([block.id]) == {block.id: b"block"}
+        with pytest.raises(FSError):
+            await aws2.set_chunks(items)
+        with pytest.raises(FSError):
+            await aws2.clear_chunks([block.id])
+
+
+# Basically a benchmark to compare the single and batched chunk operations
+@pytest.mark.slow
+@pytest.mark.trio
+async def test_chunks_batch_bench(tmpdir, alice, workspace_id):
+    # A block written 4KB at a time, as the operating system typically does
+    items = [(Chunk.new(0, 4096).id, bytes(4096)) for _ in range(128)]
+    chunk_ids = [chunk_id for chunk_id, _ in items]
+
+    async with WorkspaceStorage.run(alice, Path(tmpdir), workspace_id) as aws:
+        start = time.monotonic()
+        for chunk_id, data in items:
+            await aws.set_chunk(chunk_id, data)
+        written = time.monotonic()
+        for chunk_id in chunk_ids:
+            await aws.get_chunk(chunk_id)
+        read = time.monotonic()
+        for chunk_id in chunk_ids:
+            await aws.clear_chunk(chunk_id)
+        cleared = time.monotonic()
+        print(
+            f"single: set={written - start:.3f}s get={read - written:.3f}s "
+            f"clear={cleared - read:.3f}s"
+        )
+
+        start = time.monotonic()
+        await aws.set_chunks(items)
+        written = time.monotonic()
+        assert len(await aws.get_chunks(chunk_ids)) == 128
+        read = time.monotonic()
+        await aws.clear_chunks(chunk_ids)
+        cleared = time.monotonic()
+        print(
+            f"batch: set={written - start:.3f}s get={read - written:.3f}s "
+            f"clear={cleared - read:.3f}s"
+        )
+
+
+@pytest.mark.trio
+async def test_chunk_memory_cache(tmpdir, alice, workspace_id):
+    data = b"\x00" * 1024
+    chunk1 = Chunk.new(0, 1024)
+    chunk2 = Chunk.new(0, 1024).evolve_as_block(data)
+    chunk3 = Chunk.new(0, 1024)
+
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, memory_cache_size=2048) as aws:
+        chunk_cache = aws.chunk_storage.chunk_cache
+        assert aws.block_storage.chunk_cache is chunk_cache
+
+        # Cache is filled on read, not on write
+        await aws.set_chunk(chunk1.id, data)
+        await aws.set_clean_block(chunk2.access.id, data)
+        assert len(chunk_cache) == 0
+        assert await aws.get_chunk(chunk1.id) == data
+        assert await aws.get_chunk(chunk2.id) == data
+        assert chunk1.id in chunk_cache
+        assert chunk2.id in chunk_cache
+        assert chunk_cache.size == 2048
+
+        # Least recently used chunk is evicted
+        assert await aws.get_chunk(chunk1.id) == data
+        await aws.set_chunk(chunk3.id, data)
+        assert await aws.get_chunk(chunk3.id) == data
+        assert chunk1.id in chunk_cache
+        assert chunk2.id not in chunk_cache
+        assert chunk_cache.size == 2048
+
+        # Overwriting or clearing a chunk invalidates the cache
+        await aws.set_chunk(chunk3.id, b"\x01" * 1024)
+        assert chunk3.id not in chunk_cache
+        assert await aws.get_chunk(chunk3.id) == b"\x01" * 1024
+        await aws.clear_chunk(chunk1.id)
+        assert chunk1.id not in chunk_cache
+        with pytest.raises(FSLocalMissError):
+            await aws.get_chunk(chunk1.id)
+
+        # Same goes for the blocks
+        assert await aws.get_chunk(chunk2.id) == data
+        await aws.clear_clean_block(chunk2.access.id)
+        assert chunk2.id not in chunk_cache
+        with pytest.raises(FSLocalMissError):
+            await aws.get_chunk(chunk2.id)
+
+
+@pytest.mark.trio
+async def test_chunk_memory_cache_concurrent_change(tmpdir, alice, workspace_id, monkeypatch):
+    chunk_id = ChunkID()
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, memory_cache_size=2048) as aws:
+        chunk_storage = aws.chunk_storage
+        await aws.set_chunk(chunk_id, b"\x00" * 1024)
+
+        read_chunk_data = chunk_storage._read_chunk_data
+        data_read = trio.Event()
+        resume = trio.Event()
+
+        async def _slow_read_chunk_data(chunk_id):
+            ciphered = await read_chunk_data(chunk_id)
+            data_read.set()
+            await resume.wait()
+            return ciphered
+
+        monkeypatch.setattr(chunk_storage, "_read_chunk_data", _slow_read_chunk_data)
+
+        async def _get_old_chunk():
+            assert await aws.get_chunk(chunk_id) == b"\x00" * 1024
+
+        # The chunk is modified while being read
+        async with trio.open_service_nursery() as nursery:
+            nursery.start_soon(_get_old_chunk)
+            await data_read.wait()
+            await aws.set_chunk(chunk_id, b"\x01" * 1024)
+            resume.set()
+
+        # The outdated data has not been cached
+        assert chunk_id not in chunk_storage.chunk_cache
+        assert await aws.get_chunk(chunk_id) == b"\x01" * 1024
+        assert chunk_id in chunk_storage.chunk_cache
+
+
 @pytest.mark.trio
 async def test_file_descriptor(alice_workspace_storage):
     aws = alice_workspace_storage
@@ -503,7 +775,8 @@ async def test_vacuum(tmpdir, alice, workspace_id):
 
 
 @pytest.mark.trio
-async def test_garbage_collection(tmpdir, alice, workspace_id):
+@pytest.mark.parametrize("block_files", (False, True))
+async def test_garbage_collection(tmpdir, alice, workspace_id, block_files):
     block_size = DEFAULT_BLOCK_SIZE
     cache_size = 1 * block_size
     data = b"\x00" * block_size
@@ -511,7 +784,9 @@ async def test_garbage_collection(tmpdir, alice, workspace_id):
     chunk2 = Chunk.new(0, block_size).evolve_as_block(data)
     chunk3 = Chunk.new(0, block_size).evolve_as_block(data)
 
-    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, cache_size=cache_size) as aws:
+    async with WorkspaceStorage.run(
+        alice, tmpdir, workspace_id, cache_size=cache_size, block_files=block_files
+    ) as aws:
         assert await aws.block_storage.get_nb_blocks() == 0
         await aws.set_clean_block(chunk1.access.id, data)
         assert await aws.block_storage.get_nb_blocks() == 1
@@ -523,6 +798,355 @@ async def test_garbage_collection(tmpdir, alice, workspace_id):
         assert await aws.block_storage.get_nb_blocks() == 0
 
 
+@pytest.mark.trio
+async def test_garbage_collection_by_size(tmpdir, alice, workspace_id):
+    block_size = DEFAULT_BLOCK_SIZE
+    cache_size = 4 * block_size
+    small_data = b"\x00" * 1024
+    big_data = b"\x00" * 3 * block_size
+    small_chunk = Chunk.new(0, 1024).evolve_as_block(small_data)
+    big_chunks = [Chunk.new(0, 3 * block_size).evolve_as_block(big_data) for _ in range(3)]
+
+    async def assert_counters(block_storage):
+        assert block_storage._nb_blocks == await block_storage.get_nb_blocks()
+        assert block_storage._total_size == await block_storage.get_total_size()
+
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, cache_size=cache_size) as aws:
+        await aws.set_clean_block(small_chunk.access.id, small_data)
+        await assert_counters(aws.block_storage)
+
+        # Blocks bigger than the default block size are evicted according to their size
+        for chunk in big_chunks:
+            await aws.set_clean_block(chunk.access.id, big_data)
+            await assert_counters(aws.block_storage)
+        assert await aws.block_storage.get_nb_blocks() == 1
+        assert await aws.block_storage.is_chunk(big_chunks[-1].id)
+
+        # Counters are kept up to date
+        await aws.set_clean_block(big_chunks[-1].access.id, small_data)
+        await assert_counters(aws.block_storage)
+        await aws.clear_clean_block(big_chunks[-1].access.id)
+        await assert_counters(aws.block_storage)
+        await aws.set_clean_block(small_chunk.access.id, small_data)
+        await assert_counters(aws.block_storage)
+
+    # Counters are restored from the database
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, cache_size=cache_size) as aws:
+        await assert_counters(aws.block_storage)
+        assert aws.block_storage._nb_blocks == 1
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("memory_cache_size", (0, DEFAULT_CHUNK_MEMORY_CACHE_SIZE))
+async def test_garbage_collection_access_order(tmpdir, alice, workspace_id, memory_cache_size):
+    block_size = DEFAULT_BLOCK_SIZE
+    cache_size = 2 * block_size
+    data = b"\x00" * block_size
+    chunk1 = Chunk.new(0, block_size).evolve_as_block(data)
+    chunk2 = Chunk.new(0, block_size).evolve_as_block(data)
+    chunk3 = Chunk.new(0, block_size).evolve_as_block(data)
+
+    async with WorkspaceStorage.run(
+        alice, tmpdir, workspace_id, cache_size=cache_size, memory_cache_size=memory_cache_size
+    ) as aws:
+        await aws.set_clean_block(chunk1.access.id, data)
+        await aws.set_clean_block(chunk2.access.id, data)
+
+        # Reading a block does not write to the database
+        assert await aws.get_chunk(chunk1.id) == data
+        assert chunk1.id in aws.block_storage._pending_accesses
+
+        # Neither does writing a block, unless some blocks get evicted
+        await aws.set_clean_block(chunk1.access.id, data)
+        assert chunk1.id in aws.block_storage._pending_accesses
+
+        # Pending accesses are taken into account by the garbage collection
+        await aws.set_clean_block(chunk3.access.id, data)
+        assert not aws.block_storage._pending_accesses
+        assert await aws.block_storage.get_nb_blocks() == 2
+        assert await aws.block_storage.is_chunk(chunk1.id)
+        assert not await aws.block_storage.is_chunk(chunk2.id)
+        assert await aws.block_storage.is_chunk(chunk3.id)
+
+
+@pytest.mark.trio
+async def test_accesses_periodic_flush(autojump_clock, tmpdir, alice, workspace_id, monkeypatch):
+    data = b"\x00" * 1024
+    chunk1 = Chunk.new(0, 1024).evolve_as_block(data)
+    chunk2 = Chunk.new(0, 1024)
+
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id) as aws:
+        await aws.set_clean_block(chunk1.access.id, data)
+        await aws.set_chunk(chunk2.id, data)
+        assert await aws.get_chunk(chunk1.id) == data
+        assert await aws.get_chunk(chunk2.id) == data
+
+        flushed = trio.Event()
+        flush_accesses = aws.chunk_storage.flush_accesses
+
+        async def _flush_accesses():
+            await flush_accesses()
+            flushed.set()
+
+        monkeypatch.setattr(aws.chunk_storage, "flush_accesses", _flush_accesses)
+
+        # Pending accesses are written even if no more chunk is read
+        await flushed.wait()
+        assert not aws.block_storage._pending_accesses
+        assert not aws.chunk_storage._pending_accesses
+
+        async with aws.block_storage._open_cursor() as cursor:
+            cursor.execute("SELECT accessed_on FROM chunks WHERE chunk_id = ?", (chunk1.id.bytes,))
+            accessed_on, = cursor.fetchone()
+        assert accessed_on > 0
+
+
+@pytest.mark.trio
+async def test_block_files(tmpdir, alice, workspace_id):
+    data = b"\x00" * DEFAULT_BLOCK_SIZE
+    chunk1 = Chunk.new(0, DEFAULT_BLOCK_SIZE).evolve_as_block(data)
+    chunk2 = Chunk.new(0, DEFAULT_BLOCK_SIZE).evolve_as_block(data)
+    blocks_path = Path(tmpdir) / "workspace_blocks-v1"
+
+    def block_files():
+        return {x.name for x in blocks_path.glob("*/*")}
+
+    # Blocks stored in the database
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id) as aws:
+        assert type(aws.block_storage) is BlockStorage
+        await aws.set_clean_block(chunk1.access.id, data)
+
+    # Blocks are moved to the disk
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, block_files=True) as aws:
+        assert type(aws.block_storage) is FileBlockStorage
+        assert block_files() == {chunk1.id.hex}
+        assert await aws.get_chunk(chunk1.id) == data
+        assert await aws.block_storage.get_total_size() == len(alice.local_symkey.encrypt(data))
+
+        await aws.set_clean_block(chunk2.access.id, data)
+        assert block_files() == {chunk1.id.hex, chunk2.id.hex}
+        assert await aws.get_chunk(chunk2.id) == data
+
+        await aws.clear_clean_block(chunk2.access.id)
+        assert block_files() == {chunk1.id.hex}
+        with pytest.raises(FSLocalMissError):
+            await aws.block_storage.get_chunk(chunk2.id)
+
+        # Concurrent writes of the same block don't share a temporary file
+        block_path = aws.block_storage._get_block_path(chunk1.id)
+        other_tmp_path = block_path.with_suffix(".tmp")
+        other_tmp_path.write_bytes(b"other writer")
+        await aws.set_clean_block(chunk1.access.id, data)
+        assert other_tmp_path.read_bytes() == b"other writer"
+        other_tmp_path.unlink()
+        assert block_files() == {chunk1.id.hex}
+        assert await aws.block_storage.get_chunk(chunk1.id) == data
+
+    # Blocks stored on disk are forgotten by the database backend
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id) as aws:
+        assert not blocks_path.exists()
+        assert await aws.block_storage.get_nb_blocks() == 0
+        with pytest.raises(FSLocalMissError):
+            await aws.block_storage.get_chunk(chunk1.id)
+
+
+@pytest.mark.trio
+async def test_read_cursor(alice_workspace_storage):
+    aws = alice_workspace_storage
+    localdb = aws.data_localdb
+    manifest = create_manifest(aws.device, LocalFileManifest)
+    await aws.set_manifest(manifest.id, manifest, check_lock_status=False)
+    await aws.clear_memory_cache()
+
+    # Committed data is read without waiting for the main connection
+    async with localdb._lock:
+        assert await aws.get_manifest(manifest.id) == manifest
+        assert await aws.get_need_sync_entries() == ({manifest.id}, set())
+    assert len(localdb._read_conns) == 1
+
+    # The reads don't run in the trio thread
+    conn = localdb._read_conns[0]
+    statement_threads = set()
+    conn.set_trace_callback(lambda _: statement_threads.add(threading.get_ident()))
+    await aws.clear_memory_cache()
+    assert await aws.get_manifest(manifest.id) == manifest
+    assert await aws.get_need_sync_entries() == ({manifest.id}, set())
+    assert statement_threads
+    assert threading.get_ident() not in statement_threads
+    conn.set_trace_callback(None)
+
+    async def _count_chunks():
+        async with localdb.open_read_cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM chunks")
+            (count,) = cursor.fetchone()
+            return count
+
+    # Pending changes are read from the main connection
+    chunk_id = ChunkID()
+    await aws.set_chunk(chunk_id, b"data")
+    assert localdb._conn.in_transaction
+    assert await aws.get_chunk(chunk_id) == b"data"
+    assert await _count_chunks() == 1
+
+    # Those changes are not visible from the read-only connections yet
+    conn = localdb._read_conns[0]
+    assert conn.execute("SELECT COUNT(*) FROM chunks").fetchone() == (0,)
+
+    # The transaction state is tracked even if the operation fails
+    await localdb.commit()
+    with pytest.raises(ZeroDivisionError):
+        async with localdb.open_cursor(commit=False) as cursor:
+            cursor.execute("DELETE FROM chunks")
+            1 / 0
+    assert localdb._conn.in_transaction
+    assert await _count_chunks() == 0
+    await localdb.commit()
+    async with localdb._lock:
+        assert await _count_chunks() == 0
+
+    # The read-only connections cannot write
+    with pytest.raises(FSLocalStorageOperationalError):
+        async with localdb.open_read_cursor() as cursor:
+            cursor.execute("DELETE FROM vlobs")
+    assert not localdb._read_conns
+
+
+@pytest.mark.trio
+async def test_read_pool_size(tmpdir):
+    async with LocalDatabase.run(Path(tmpdir) / "test.sqlite", read_pool_size=1) as localdb:
+        async with localdb.open_read_cursor():
+            # The only read-only connection is in use
+            assert localdb._read_limiter.available_tokens == 0
+
+
+@pytest.mark.trio
+async def test_group_commit(alice_workspace_storage, monkeypatch):
+    aws = alice_workspace_storage
+    manifests = [create_manifest(aws.device, LocalFileManifest) for _ in range(10)]
+    for manifest in manifests:
+        await aws.set_manifest(manifest.id, manifest, cache_only=True, check_lock_status=False)
+
+    commits = []
+    vanilla_commit = aws.data_localdb.commit
+
+    async def _commit():
+        commits.append(len(aws.manifest_storage._uncommitted))
+        await vanilla_commit()
+
+    monkeypatch.setattr(aws.data_localdb, "commit", _commit)
+    monkeypatch.setattr("parsec.core.fs.storage.manifest_storage.GROUP_COMMIT_DELAY", 60)
+    monkeypatch.setattr("parsec.core.fs.storage.manifest_storage.GROUP_COMMIT_MAX_SIZE", 10)
+
+    # Concurrent writes share the same commit
+    async with trio.open_nursery() as nursery:
+        for manifest in manifests:
+            nursery.start_soon(aws.manifest_storage.ensure_manifest_persistent, manifest.id)
+    assert commits == [10]
+    assert not aws.manifest_storage._uncommitted
+    assert not aws.data_localdb._conn.in_transaction
+
+    # A manifest waiting for a commit is not acknowledged before the commit
+    monkeypatch.setattr("parsec.core.fs.storage.manifest_storage.GROUP_COMMIT_DELAY", 0.1)
+    manifest = manifests[0].evolve(need_sync=False)
+    await aws.set_manifest(manifest.id, manifest, cache_only=True, check_lock_status=False)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(aws.manifest_storage.ensure_manifest_persistent, manifest.id)
+        with trio.fail_after(1):
+            while manifest.id not in aws.manifest_storage._uncommitted:
+                await trio.sleep(0)
+        await aws.manifest_storage.ensure_manifest_persistent(manifest.id)
+        assert commits == [10, 1]
+        assert manifest.id not in aws.manifest_storage._uncommitted
+
+
+@pytest.mark.trio
+async def test_group_commit_lone_writer(autojump_clock, alice_workspace_storage, monkeypatch):
+    aws = alice_workspace_storage
+    manifest = create_manifest(aws.device, LocalFileManifest)
+    await aws.set_manifest(manifest.id, manifest, cache_only=True, check_lock_status=False)
+    monkeypatch.setattr("parsec.core.fs.storage.manifest_storage.GROUP_COMMIT_DELAY", 3600)
+
+    # A lone write doesn't wait for other writes to join its commit
+    start = trio.current_time()
+    await aws.manifest_storage.ensure_manifest_persistent(manifest.id)
+    assert trio.current_time() - start < 3600
+    assert not aws.manifest_storage._uncommitted
+    assert not aws.data_localdb._conn.in_transaction
+
+
+@pytest.mark.trio
+async def test_manifest_cache_eviction(tmpdir, alice, workspace_id):
+    manifests = [create_manifest(alice, LocalFileManifest) for _ in range(4)]
+
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, manifest_cache_size=2) as aws:
+        ms = aws.manifest_storage
+        for manifest in manifests[:2]:
+            await aws.set_manifest(manifest.id, manifest, check_lock_status=False)
+        await aws.set_manifest(
+            manifests[2].id, manifests[2], cache_only=True, check_lock_status=False
+        )
+        assert list(ms._cache) == [manifests[1].id, manifests[2].id]
+        assert ms.cache_evictions == 1
+
+        # The least recently used manifest is evicted
+        assert await aws.get_manifest(manifests[1].id) == manifests[1]
+        assert await aws.get_manifest(manifests[0].id) == manifests[0]
+        assert list(ms._cache) == [manifests[1].id, manifests[0].id]
+        assert (ms.cache_hits, ms.cache_misses, ms.cache_evictions) == (1, 1, 2)
+
+        # Manifests ahead of the local database are flushed before being evicted
+        assert await aws.get_manifest(manifests[2].id) == manifests[2]
+        await aws.set_manifest(
+            manifests[3].id, manifests[3], cache_only=True, check_lock_status=False
+        )
+        assert list(ms._cache) == [manifests[2].id, manifests[3].id]
+        await aws.set_manifest(
+            manifests[0].id, manifests[0], cache_only=True, check_lock_status=False
+        )
+        assert list(ms._cache) == [manifests[3].id, manifests[0].id]
+        assert manifests[2].id not in ms._cache_ahead_of_localdb
+        assert await aws.get_manifest(manifests[2].id) == manifests[2]
+
+
+@pytest.mark.trio
+async def test_need_sync_entries_index(tmpdir, alice, workspace_id):
+    manifests = [create_manifest(alice, LocalFileManifest) for _ in range(4)]
+
+    async with WorkspaceStorage.run(alice, tmpdir, workspace_id, manifest_cache_size=2) as aws:
+        ms = aws.manifest_storage
+        await aws.set_manifest(manifests[0].id, manifests[0], check_lock_status=False)
+        for manifest in manifests[1:]:
+            await aws.set_manifest(
+                manifest.id, manifest.evolve(need_sync=False), check_lock_status=False
+            )
+        await aws.set_manifest(
+            manifests[3].id, manifests[3], cache_only=True, check_lock_status=False
+        )
+        await aws.update_realm_checkpoint(1, {manifests[1].id: 2})
+
+        # Only the cached manifests that need sync are tracked in memory,
+        # the evicted ones are listed by the local database
+        assert manifests[0].id not in ms._cache
+        assert ms._cache_need_sync == {manifests[3].id}
+        assert await aws.get_need_sync_entries() == (
+            {manifests[0].id, manifests[3].id},
+            {manifests[1].id},
+        )
+
+        # The local database doesn't have to scan the whole table
+        async with ms._open_read_cursor() as cursor:
+            cursor.execute(
+                "EXPLAIN QUERY PLAN SELECT vlob_id, need_sync, base_version, remote_version "
+                "FROM vlobs WHERE need_sync = 1 OR base_version != remote_version"
+            )
+            (*_, plan), = cursor.fetchall()
+        assert "COVERING INDEX vlobs_need_sync" in plan
+
+        await aws.clear_memory_cache(flush=False)
+        assert not ms._cache_need_sync
+        assert await aws.get_need_sync_entries() == ({manifests[0].id}, {manifests[1].id})
+
+
 @pytest.mark.trio
 async def test_storage_file_tree(alice, tmpdir, workspace_id):
     path = Path(tmpdir)
@@ -0,0 +1,86 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import os
+import time
+import threading
+import trio
+import pytest
+
+from parsec.crypto import SecretKey, CryptoError
+from parsec.core.types import DEFAULT_BLOCK_SIZE
+from parsec.core.fs.crypto_executor import (
+    CRYPTO_THREAD_THRESHOLD,
+    run_crypto,
+    encrypt,
+    decrypt,
+    encrypt_many,
+    decrypt_many,
+)
+
+
+@pytest.mark.trio
+async def test_run_crypto_threshold():
+    def _get_thread(data):
+        return threading.current_thread()
+
+    # Small data is processed right away, large data in another thread
+    small = bytes(CRYPTO_THREAD_THRESHOLD - 1)
+    large = bytes(CRYPTO_THREAD_THRESHOLD)
+    assert await run_crypto(len(small), _get_thread, small) is threading.current_thread()
+    assert await run_crypto(len(large), _get_thread, large) is not threading.current_thread()
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("size", [0, 1024, DEFAULT_BLOCK_SIZE])
+async def test_encrypt_decrypt(size):
+    key = SecretKey.generate()
+    data = os.urandom(size)
+
+    ciphered = await encrypt(key, data)
+    assert key.decrypt(ciphered) == data
+    assert await decrypt(key, ciphered) == data
+    with pytest.raises(CryptoError):
+        await decrypt(SecretKey.generate(), ciphered)
+
+    # The order of the items is kept
+    items = [os.urandom(length) for length in (10, DEFAULT_BLOCK_SIZE, 0, DEFAULT_BLOCK_SIZE, 20)]
+    ciphered_items = await encrypt_many(key, items)
+    assert [key.decrypt(ciphered) for ciphered in ciphered_items] == items
+    assert await decrypt_many(key, ciphered_items) == items
+    assert await encrypt_many(key, []) == []
+
+
+# Basically a benchmark to measure how long the trio thread is blocked
+# while blocks are being decrypted
+@pytest.mark.slow
+@pytest.mark.trio
+async def test_crypto_executor_bench():
+    key = SecretKey.generate()
+    ciphered_blocks = [key.encrypt(os.urandom(DEFAULT_BLOCK_SIZE)) for _ in range(64)]
+
+    async def _measure_latency(task_status=trio.TASK_STATUS_IGNORED):
+        nonlocal max_latency
+        task_status.started()
+        while True:
+            before = time.monotonic()
+            await trio.sleep(0)
+            max_latency = max(max_latency, time.monotonic() - before)
+
+    for name, decrypt_blocks in [
+        ("inline", lambda: [key.decrypt(ciphered) for ciphered in ciphered_blocks]),
+        ("executor", lambda: decrypt_many(key, ciphered_blocks)),
+    ]:
+        max_latency = 0.0
+        async with trio.open_nursery() as nursery:
+            await nursery.start(_measure_latency)
+            await trio.sleep(0.01)
+            start = time.monotonic()
+            result = decrypt_blocks()
+            if not isinstance(result, list):
+                result = await result
+            duration = time.monotonic() - start
+            # Let the latency be measured
+            await trio.sleep(0.01)
+            nursery.cancel_scope.cancel()
+        assert len(result) == 64
+        print(f"{name}: duration={duration:.3f}s max_latency={max_latency * 1000:.1f}ms")
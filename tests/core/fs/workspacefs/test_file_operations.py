@@ -1,12 +1,15 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+import time
+import random
 import pytest
 from typing import Tuple
-from hypothesis import strategies
+from hypothesis import given, settings, strategies
 from hypothesis.stateful import RuleBasedStateMachine, rule, invariant, run_state_machine_as_test
 
 from parsec.api.protocol import DeviceID
-from parsec.core.types import EntryID, ChunkID, Chunk, LocalFileManifest
+from parsec.core.types import EntryID, ChunkID, Chunk, ChunkIndex, LocalFileManifest
+from parsec.core.types import chunk_index as chunk_index_module
 from parsec.core.fs.workspacefs.file_transactions import padded_data
 from parsec.core.fs.workspacefs.file_operations import (
     prepare_read,
@@ -186,6 +189,92 @@ def test_complete_scenario():
     assert manifest == base.evolve(size=25, blocks=((chunk10,), (chunk11,)), updated=t7)
 
 
+@given(
+    operations=strategies.lists(
+        strategies.tuples(
+            strategies.sampled_from(["set", "extend", "truncate"]),
+            strategies.integers(min_value=0, max_value=1200),
+            strategies.booleans(),
+        ),
+        max_size=20,
+    )
+)
+@settings(deadline=None)
+def test_chunk_index(operations):
+    clean = (Chunk.new(0, 1).evolve_as_block(b"x"),)
+    oracle = []
+    index = ChunkIndex()
+    for operation, value, reshaped in operations:
+        chunks = clean if reshaped else (Chunk.new(0, 1),)
+        previous, previous_oracle = index, list(oracle)
+        if operation == "set":
+            value = min(value, len(oracle))
+            index = index.set(value, chunks)
+            oracle[value : value + 1] = [chunks]
+        elif operation == "extend":
+            for _ in range(value):
+                index = index.set(len(index), chunks)
+                oracle.append(chunks)
+        else:
+            index = index.truncate(value)
+            del oracle[value:]
+
+        # The previous version is left untouched
+        assert list(previous) == previous_oracle
+        assert len(index) == len(oracle)
+        assert list(index) == oracle
+        assert index == ChunkIndex.from_blocks(oracle) == tuple(oracle)
+        assert [index[i] for i in range(len(oracle))] == oracle
+        assert index[-3:] == tuple(oracle[-3:])
+        not_reshaped = [(i, chunks) for i, chunks in enumerate(oracle) if chunks is not clean]
+        assert list(index.iter_not_reshaped()) == not_reshaped
+        assert index.is_reshaped() == (not not_reshaped)
+    with pytest.raises(IndexError):
+        index[len(oracle)]
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("blocks", [1000, 100000])
+def test_random_writes_bench(blocks, monkeypatch):
+    blocksize = 16
+    manifest = LocalFileManifest.new_placeholder(
+        DeviceID.new(), parent=EntryID.new(), blocksize=blocksize
+    )
+    manifest = manifest.evolve(
+        size=blocks * blocksize,
+        blocks=[
+            (Chunk.new(i * blocksize, (i + 1) * blocksize).evolve_as_block(b""),)
+            for i in range(blocks)
+        ],
+    )
+    assert manifest.is_reshaped()
+
+    # Keep track of the tree nodes copied by the updates
+    created_nodes = []
+    vanilla_node_init = chunk_index_module._Node.__init__
+
+    def _node_init(self, children, dirty):
+        created_nodes.append(self)
+        vanilla_node_init(self, children, dirty)
+
+    monkeypatch.setattr(chunk_index_module._Node, "__init__", _node_init)
+
+    # Small writes all over a big file, then reshape the written blocks
+    offsets = [random.randrange(manifest.size) for _ in range(1000)]
+    start = time.monotonic()
+    for offset in offsets:
+        manifest, _, _ = prepare_write(manifest, 4, offset)
+    for _, new_chunk, update, _ in prepare_reshape(manifest):
+        manifest = update(manifest, new_chunk)
+    duration = time.monotonic() - start
+    print(f"blocks={blocks}: {duration / len(offsets) * 1e6:.1f}us per write")
+
+    # Each write updates at most two blocks, then each updated block is reshaped:
+    # only the path from the root to those blocks is copied, whatever the file size
+    depth = manifest.blocks._shift // chunk_index_module.BITS + 1
+    assert len(created_nodes) <= 2 * 2 * len(offsets) * depth
+
+
 @pytest.mark.slow
 def test_file_operations(hypothesis_settings, tmpdir):
     class FileOperations(RuleBasedStateMachine):
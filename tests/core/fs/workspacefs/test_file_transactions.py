@@ -2,6 +2,10 @@
 
 import os
 import sys
+import random
+import time
+import tracemalloc
+import trio
 import pytest
 from pendulum import datetime
 from pathlib import Path
@@ -13,8 +17,9 @@ from hypothesis_trio.stateful import (
 )
 from hypothesis import strategies as st
 
-from parsec.core.types import EntryID, LocalFileManifest, Chunk
+from parsec.core.types import DEFAULT_BLOCK_SIZE, EntryID, LocalFileManifest, Chunk, ChunkID
 from parsec.core.fs.storage import WorkspaceStorage
+from parsec.core.fs.workspacefs import file_transactions as file_transactions_module
 from parsec.core.fs.workspacefs.file_transactions import FSInvalidFileDescriptor
 from parsec.core.fs.exceptions import FSRemoteBlockNotFound
 
@@ -137,7 +142,12 @@ async def test_flush_file(alice_file_transactions, foo_txt):
         await file_transactions.fd_write(fd, b"hello ", 0)
         await file_transactions.fd_write(fd, b"world !", -1)
 
-    assert foo_txt.is_cache_ahead_of_persistance()
+    # The data is still buffered
+    assert not foo_txt.is_cache_ahead_of_persistance()
+    foo_txt.ensure_manifest(size=0, need_sync=False)
+
+    await file_transactions.fd_flush(fd)
+    assert not foo_txt.is_cache_ahead_of_persistance()
     foo_txt.ensure_manifest(
         size=13,
         is_placeholder=False,
@@ -147,9 +157,6 @@ async def test_flush_file(alice_file_transactions, foo_txt):
         updated=datetime(2000, 1, 3),
     )
 
-    await file_transactions.fd_flush(fd)
-    assert not foo_txt.is_cache_ahead_of_persistance()
-
     await file_transactions.fd_close(fd)
     assert not foo_txt.is_cache_ahead_of_persistance()
     foo_txt.ensure_manifest(
@@ -212,6 +219,395 @@ async def test_load_block_from_remote(alice_file_transactions, foo_txt):
     assert data == chunk1_data + chunk2_data[:4]
 
 
+@pytest.mark.trio
+async def test_read_ahead(alice_file_transactions, foo_txt):
+    file_transactions = alice_file_transactions
+    local_storage = file_transactions.local_storage
+
+    # Prepare the backend with a file made of 8 remote blocks
+    workspace_id = file_transactions.remote_loader.workspace_id
+    await file_transactions.remote_loader.create_realm(workspace_id)
+    chunks = [Chunk.new(i * 4, i * 4 + 4).evolve_as_block(b"%4d" % i) for i in range(8)]
+    for i, chunk in enumerate(chunks):
+        await file_transactions.remote_loader.upload_block(chunk.access, b"%4d" % i)
+        await local_storage.clear_clean_block(chunk.access.id)
+    foo_manifest = await foo_txt.get_manifest()
+    foo_manifest = foo_manifest.evolve(
+        blocksize=4, size=32, blocks=tuple((chunk,) for chunk in chunks)
+    )
+    await foo_txt.set_manifest(foo_manifest)
+
+    async def is_fetched(chunk):
+        return await local_storage.is_chunk(ChunkID(chunk.id))
+
+    fd = foo_txt.open()
+    async with trio.open_nursery() as nursery:
+        file_transactions._read_ahead.nursery = nursery
+
+        # Random accesses don't trigger the read-ahead
+        assert await file_transactions.fd_read(fd, 4, 8) == b"   2"
+        assert await file_transactions.fd_read(fd, 4, 0) == b"   0"
+        await trio.testing.wait_all_tasks_blocked()
+        assert [await is_fetched(chunk) for chunk in chunks] == [1, 0, 1, 0, 0, 0, 0, 0]
+
+        # Sequential accesses fetch the next blocks in the background
+        assert await file_transactions.fd_read(fd, 4, 4) == b"   1"
+        with trio.fail_after(1):
+            while not await is_fetched(chunks[5]):
+                await trio.sleep(0.01)
+        assert [await is_fetched(chunk) for chunk in chunks] == [1, 1, 1, 1, 1, 1, 0, 0]
+
+        # Read-ahead is not affected by the other file descriptors
+        await file_transactions.fd_read(foo_txt.open(), 4, 28)
+
+        # Keep reading until the end of the file
+        for i in range(2, 8):
+            assert await file_transactions.fd_read(fd, 4, i * 4) == b"%4d" % i
+        assert [await is_fetched(chunk) for chunk in chunks] == [1] * 8
+
+    await file_transactions.fd_close(fd)
+    assert not file_transactions._read_ahead._fetching
+
+
+@pytest.mark.trio
+async def test_load_blocks_concurrently(alice_file_transactions, monkeypatch):
+    remote_loader = alice_file_transactions.remote_loader
+    local_storage = alice_file_transactions.local_storage
+
+    # Prepare the backend
+    await remote_loader.create_realm(remote_loader.workspace_id)
+    accesses = []
+    for i in range(8):
+        chunk = Chunk.new(0, 4).evolve_as_block(b"%4d" % i)
+        await remote_loader.upload_block(chunk.access, b"%4d" % i)
+        await local_storage.clear_clean_block(chunk.access.id)
+        accesses.append(chunk.access)
+    missing_access = Chunk.new(0, 4).evolve_as_block(b"miss").access
+
+    # Spy on the actual downloads
+    downloading = set()
+    downloaded = []
+    max_downloading = 0
+    vanilla_download_block = remote_loader._download_block
+
+    async def _download_block(access):
+        nonlocal max_downloading
+        downloading.add(access.id)
+        max_downloading = max(max_downloading, len(downloading))
+        try:
+            await vanilla_download_block(access)
+        finally:
+            downloading.remove(access.id)
+            downloaded.append(access.id)
+
+    monkeypatch.setattr(remote_loader, "_download_block", _download_block)
+    monkeypatch.setattr(remote_loader.backend_cmds, "max_concurrency", 4)
+
+    # Downloads are bounded by the number of available transports
+    await remote_loader.load_blocks(accesses[:6])
+    assert max_downloading == 4
+    assert sorted(downloaded) == sorted(access.id for access in accesses[:6])
+
+    # Readers asking for the same blocks share the downloads
+    downloaded.clear()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(remote_loader.load_block, accesses[6])
+        nursery.start_soon(remote_loader.load_blocks, accesses[6:])
+        nursery.start_soon(remote_loader.load_blocks, accesses[6:])
+    assert sorted(downloaded) == sorted(access.id for access in accesses[6:])
+    for access in accesses:
+        assert await local_storage.is_chunk(ChunkID(access.id))
+
+    # Errors are shared too
+    downloaded.clear()
+    errors = []
+
+    async def _load_missing_block():
+        try:
+            await remote_loader.load_block(missing_access)
+        except FSRemoteBlockNotFound as exc:
+            errors.append(exc)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_load_missing_block)
+        nursery.start_soon(_load_missing_block)
+    assert downloaded == [missing_access.id]
+    assert len(errors) == 2
+    assert not remote_loader._block_downloads
+
+
+@pytest.mark.trio
+async def test_write_buffer(alice_file_transactions, foo_txt):
+    file_transactions = alice_file_transactions
+    foo_manifest = await foo_txt.get_manifest()
+    await foo_txt.set_manifest(foo_manifest.evolve(blocksize=8))
+    fd = foo_txt.open()
+
+    # Contiguous writes are merged into full blocks
+    for i in range(5):
+        await file_transactions.fd_write(fd, b"%4d" % i, -1)
+    foo_manifest = await foo_txt.get_manifest()
+    assert foo_manifest.size == 16
+    assert [len(chunks) for chunks in foo_manifest.blocks] == [1, 1]
+    assert file_transactions._write_buffers.size == 4
+
+    # The buffered data is available through the other file descriptors
+    fd2 = foo_txt.open()
+    assert await file_transactions.fd_size(fd2) == 20
+    assert await file_transactions.fd_read(fd2, -1, 0) == b"   0   1   2   3   4"
+    assert file_transactions._write_buffers.size == 0
+
+    # Closing the file descriptor writes the buffered data
+    await file_transactions.fd_write(fd, b"x", 0)
+    foo_txt.ensure_manifest(size=20)
+    await file_transactions.fd_close(fd)
+    assert not foo_txt.is_cache_ahead_of_persistance()
+    assert await file_transactions.fd_read(fd2, -1, 0) == b"x  0   1   2   3   4"
+    await file_transactions.fd_close(fd2)
+
+
+@pytest.mark.trio
+async def test_write_buffer_flush(alice_file_transactions, foo_txt, monkeypatch):
+    file_transactions = alice_file_transactions
+    write_buffers = file_transactions._write_buffers
+    fd = foo_txt.open()
+
+    # Too much buffered data
+    monkeypatch.setattr(write_buffers, "max_size", 4)
+    await file_transactions.fd_write(fd, b"hello", 0)
+    foo_txt.ensure_manifest(size=5)
+    assert write_buffers.size == 0
+
+    # Buffered data for too long
+    monkeypatch.setattr(write_buffers, "max_size", 1024)
+    monkeypatch.setattr(file_transactions_module, "WRITE_BUFFER_FLUSH_DELAY", 0.01)
+    async with trio.open_nursery() as nursery:
+        file_transactions.background_nursery = nursery
+        await file_transactions.fd_write(fd, b" world", -1)
+        foo_txt.ensure_manifest(size=5)
+        with trio.fail_after(1):
+            while write_buffers.size:
+                await trio.sleep(0.01)
+    foo_txt.ensure_manifest(size=11)
+    await file_transactions.fd_close(fd)
+
+
+@pytest.mark.trio
+async def test_write_buffer_flushed_on_cancellation(user_fs_factory, alice):
+    with trio.CancelScope() as cancel_scope:
+        async with user_fs_factory(alice) as user_fs:
+            wid = await user_fs.workspace_create("w")
+            workspace = user_fs.get_workspace(wid)
+            await workspace.touch("/foo.txt")
+            f = await workspace.open_file("/foo.txt", "rb+")
+            await f.write(b"hello")
+            assert workspace.transactions._write_buffers.size == 5
+
+            # The user fs gets cancelled while the data is still buffered
+            cancel_scope.cancel()
+            await trio.sleep_forever()
+
+    # The buffered data has been written before stopping
+    async with user_fs_factory(alice) as user_fs:
+        workspace = user_fs.get_workspace(wid)
+        assert await workspace.read_bytes("/foo.txt") == b"hello"
+
+
+@pytest.mark.trio
+async def test_background_reshape(alice_file_transactions, foo_txt, monkeypatch):
+    file_transactions = alice_file_transactions
+    local_storage = file_transactions.local_storage
+    foo_manifest = await foo_txt.get_manifest()
+    await foo_txt.set_manifest(foo_manifest.evolve(blocksize=8))
+    monkeypatch.setattr(file_transactions._write_buffers, "max_size", 0)
+    fd = foo_txt.open()
+
+    # Spy on the reshaping
+    inline_reshapes = 0
+    built = []
+    vanilla_manifest_reshape = file_transactions._manifest_reshape
+    vanilla_build_block = file_transactions._build_block
+
+    async def _manifest_reshape(*args, **kwargs):
+        nonlocal inline_reshapes
+        inline_reshapes += 1
+        return await vanilla_manifest_reshape(*args, **kwargs)
+
+    async def _build_block(data, source, destination, removed_ids):
+        built.append(destination)
+        # Concurrent write on the second block while building it in the background
+        if destination.start == 8 and len(built) == 2:
+            await file_transactions.fd_write(fd, b"X", 8)
+        return await vanilla_build_block(data, source, destination, removed_ids)
+
+    monkeypatch.setattr(file_transactions, "_manifest_reshape", _manifest_reshape)
+    monkeypatch.setattr(file_transactions, "_build_block", _build_block)
+
+    async def wait_for_reshape():
+        with trio.fail_after(1):
+            while file_transactions._reshape_worker_running:
+                await trio.sleep(0.01)
+
+    async with trio.open_nursery() as nursery:
+        file_transactions.background_nursery = nursery
+
+        # The writes don't reshape the file themselves
+        for i in range(8):
+            await file_transactions.fd_write(fd, b"%d" % i, i)
+        assert inline_reshapes == 0
+        await wait_for_reshape()
+        foo_manifest = await foo_txt.get_manifest()
+        assert foo_manifest.is_reshaped()
+        assert len(built) == 1
+
+        # The block changed while being built, it is left as is
+        for i in range(8):
+            await file_transactions.fd_write(fd, b"%d" % i, 8 + i)
+        await wait_for_reshape()
+        foo_manifest = await foo_txt.get_manifest()
+        assert not foo_manifest.is_reshaped()
+        assert not await local_storage.chunk_storage.is_chunk(built[1].id)
+        file_transactions.background_nursery = None
+
+    # Flushing still reshapes the file right away
+    await file_transactions.fd_flush(fd)
+    assert inline_reshapes == 1
+    foo_manifest = await foo_txt.get_manifest()
+    assert foo_manifest.is_reshaped()
+    assert await file_transactions.fd_read(fd, -1, 0) == b"01234567X1234567"
+    await file_transactions.fd_close(fd)
+
+
+@pytest.mark.trio
+async def test_read_without_copy(alice_file_transactions, foo_txt):
+    file_transactions = alice_file_transactions
+    local_storage = file_transactions.local_storage
+    fd = foo_txt.open()
+
+    # Fragmented block, the chunks are copied once into a single buffer
+    await file_transactions.fd_write(fd, b"56789", 5)
+    await file_transactions.fd_write(fd, b"01234", 0)
+    data = await file_transactions.fd_read(fd, 4, 3)
+    assert data == b"3456"
+    assert not data.readonly
+
+    # Single block, the data is a view on the decrypted block
+    await file_transactions.fd_flush(fd)
+    manifest = await foo_txt.get_manifest()
+    (chunk,) = manifest.blocks[0]
+    block_data = await local_storage.get_chunk(chunk.id)
+    data = await file_transactions.fd_read(fd, 4, 3)
+    assert data == b"3456"
+    assert data.obj is block_data
+
+    # Out of bound
+    assert await file_transactions.fd_read(fd, 4, 20) == b""
+    await file_transactions.fd_close(fd)
+
+
+# Basically a benchmark to measure the data copied while reading a file
+@pytest.mark.slow
+@pytest.mark.trio
+@pytest.mark.parametrize("across_blocks", [False, True])
+async def test_read_copies_bench(alice_file_transactions, foo_txt, across_blocks):
+    file_transactions = alice_file_transactions
+    fd = foo_txt.open()
+    size = 4 * DEFAULT_BLOCK_SIZE
+    await file_transactions.fd_write(fd, os.urandom(size), 0)
+    await file_transactions.fd_flush(fd)
+
+    # Fill the chunk cache
+    await file_transactions.fd_read(fd, size, 0)
+
+    # Typical FUSE reads, either within a block or across two blocks
+    read_size = 128 * 1024
+    if across_blocks:
+        offsets = range(DEFAULT_BLOCK_SIZE - read_size // 2, size - read_size, DEFAULT_BLOCK_SIZE)
+    else:
+        offsets = range(0, size, read_size)
+
+    # The allocated memory is a good measure of the copies
+    allocated = 0
+    start = time.monotonic()
+    for offset in offsets:
+        tracemalloc.start()
+        data = await file_transactions.fd_read(fd, read_size, offset)
+        allocated += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert len(data) == read_size
+    duration = time.monotonic() - start
+    ratio = allocated / (len(offsets) * read_size)
+    print(
+        f"across_blocks={across_blocks}: {ratio:.2f} bytes copied per byte read in {duration:.3f}s"
+    )
+    assert ratio < (1.5 if across_blocks else 0.5)
+
+
+@pytest.mark.slow
+@pytest.mark.trio
+@pytest.mark.parametrize("buffered", [False, True])
+async def test_write_coalescing_bench(alice_file_transactions, foo_txt, monkeypatch, buffered):
+    file_transactions = alice_file_transactions
+    local_storage = file_transactions.local_storage
+    if not buffered:
+        monkeypatch.setattr(file_transactions._write_buffers, "max_size", 0)
+    fd = foo_txt.open()
+
+    # Count the chunks written to the local storage
+    written = 0
+    vanilla_set_chunks = local_storage.set_chunks
+
+    async def _set_chunks(items):
+        nonlocal written
+        written += sum(len(data) for _, data in items)
+        await vanilla_set_chunks(items)
+
+    monkeypatch.setattr(local_storage, "set_chunks", _set_chunks)
+
+    # Typical sequential writes from the operating system
+    size = 4 * DEFAULT_BLOCK_SIZE
+    data = os.urandom(size)
+    start = time.monotonic()
+    for offset in range(0, size, 4096):
+        await file_transactions.fd_write(fd, data[offset : offset + 4096], offset)
+    await file_transactions.fd_close(fd)
+    duration = time.monotonic() - start
+    ratio = written / size
+    print(f"buffered={buffered}: {ratio:.2f} bytes written per byte in {duration:.3f}s")
+    assert ratio == (1 if buffered else 2)
+
+
+@pytest.mark.slow
+@pytest.mark.trio
+@pytest.mark.parametrize("background", [False, True])
+async def test_write_latency_bench(alice_file_transactions, foo_txt, monkeypatch, background):
+    file_transactions = alice_file_transactions
+    monkeypatch.setattr(file_transactions._write_buffers, "max_size", 0)
+    fd = foo_txt.open()
+
+    # Random writes, each block being reshaped once fully written
+    size = 4 * DEFAULT_BLOCK_SIZE
+    offsets = list(range(0, size, 4096))
+    random.Random(0).shuffle(offsets)
+    data = os.urandom(4096)
+    latencies = []
+    async with trio.open_nursery() as nursery:
+        if background:
+            file_transactions.background_nursery = nursery
+        for offset in offsets:
+            start = time.monotonic()
+            await file_transactions.fd_write(fd, data, offset)
+            latencies.append(time.monotonic() - start)
+        file_transactions.background_nursery = None
+
+    await file_transactions.fd_flush(fd)
+    await file_transactions.fd_close(fd)
+    mean = sum(latencies) / len(latencies)
+    print(f"background={background}: {mean * 1e3:.2f}ms mean, {max(latencies) * 1e3:.2f}ms max")
+    if background:
+        assert max(latencies) < 20 * mean
+
+
 size = st.integers(min_value=0, max_value=4 * 1024 ** 2)  # Between 0 and 4MB
 
 
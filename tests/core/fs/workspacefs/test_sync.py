@@ -1,9 +1,16 @@
 # Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
 
+from uuid import uuid4
 from functools import partial
 import pytest
 
-from parsec.core.types import FsPath
+from pendulum import now as pendulum_now
+
+from parsec.crypto import SecretKey, HashDigest
+from parsec.api.transport import Transport
+from parsec.api.data import FileManifest as RemoteFileManifest
+from parsec.backend import vlob as backend_vlob_module
+from parsec.core.types import FsPath, EntryID, BlockAccess, BlockID, DEFAULT_BLOCK_SIZE
 
 from tests.common import create_shared_workspace
 
@@ -92,3 +99,150 @@ async def test_sync_by_id_couple(alice_workspace, bob_workspace):
     expected = [FsPath("/a"), FsPath("/b")]
     assert await bob_workspace.listdir("/") == expected
     assert await alice_workspace.listdir("/") == expected
+
+
+@pytest.mark.trio
+async def test_load_manifests(alice_workspace, bob_workspace, monkeypatch):
+    await bob_workspace.mkdir("/a")
+    await bob_workspace.write_bytes("/b", b"abc")
+    await bob_workspace.sync()
+    entry_ids = [
+        bob_workspace.workspace_id,
+        await bob_workspace.path_id("/a"),
+        await bob_workspace.path_id("/b"),
+    ]
+    remote_loader = alice_workspace.remote_loader
+    expected = {entry_id: await remote_loader.load_manifest(entry_id) for entry_id in entry_ids}
+
+    # The manifests unknown to the backend are omitted
+    assert await remote_loader.load_manifests([*entry_ids, EntryID.new()]) == expected
+
+    # Older backends don't provide `vlob_read_batch`
+    async def _vlob_read_batch(*args, **kwargs):
+        return {"status": "unknown_command"}
+
+    monkeypatch.setattr(remote_loader.backend_cmds, "vlob_read_batch", _vlob_read_batch)
+    assert await remote_loader.load_manifests([*entry_ids, EntryID.new()]) == expected
+
+
+@pytest.mark.trio
+async def test_load_large_manifests(alice_workspace, bob_workspace, monkeypatch):
+    # Scaled down limits: the manifests don't fit in a single transport message
+    monkeypatch.setattr(backend_vlob_module, "VLOB_READ_BATCH_MAX_BYTES", 2 ** 18)
+    monkeypatch.setattr(Transport, "MAX_MESSAGE_BYTES", 2 ** 19)
+
+    # Each block access weighs about 90 bytes once signed and encrypted
+    now = pendulum_now()
+    manifests = {}
+    for _ in range(8):
+        manifest = RemoteFileManifest(
+            author=bob_workspace.device.device_id,
+            timestamp=now,
+            id=EntryID.new(),
+            parent=bob_workspace.workspace_id,
+            version=1,
+            created=now,
+            updated=now,
+            size=1000 * DEFAULT_BLOCK_SIZE,
+            blocksize=DEFAULT_BLOCK_SIZE,
+            blocks=tuple(
+                BlockAccess(
+                    id=BlockID(uuid4()),
+                    key=SecretKey.generate(),
+                    offset=i * DEFAULT_BLOCK_SIZE,
+                    size=DEFAULT_BLOCK_SIZE,
+                    digest=HashDigest.from_data(b"%d" % i),
+                )
+                for i in range(1000)
+            ),
+        )
+        await bob_workspace.remote_loader.upload_manifest(manifest.id, manifest)
+        manifests[manifest.id] = manifest
+
+    remote_loader = alice_workspace.remote_loader
+    vanilla_vlob_read_batch = remote_loader.backend_cmds.vlob_read_batch
+    replies = []
+
+    async def _vlob_read_batch(*args, **kwargs):
+        rep = await vanilla_vlob_read_batch(*args, **kwargs)
+        replies.append(rep)
+        return rep
+
+    monkeypatch.setattr(remote_loader.backend_cmds, "vlob_read_batch", _vlob_read_batch)
+    loaded = await remote_loader.load_manifests([*manifests, EntryID.new()])
+    assert loaded.keys() == manifests.keys()
+    for entry_id, manifest in manifests.items():
+        assert loaded[entry_id].blocks == manifest.blocks
+
+    # The client kept asking for the manifests omitted from the truncated replies
+    assert len(replies) > 1
+    assert all(rep["truncated"] for rep in replies[:-1])
+    assert not replies[-1]["truncated"]
+
+
+@pytest.mark.trio
+async def test_deduplicated_blocks(alice_workspace, bob_workspace, monkeypatch):
+    monkeypatch.setattr(alice_workspace.remote_loader, "deduplicate_blocks", True)
+    data = b"".join(bytes([i]) * DEFAULT_BLOCK_SIZE for i in range(3)) + b"end"
+
+    uploaded = []
+    vanilla_upload_ciphered_block = alice_workspace.remote_loader.upload_ciphered_block
+
+    async def _upload_ciphered_block(access, data, ciphered):
+        uploaded.append(access.id)
+        await vanilla_upload_ciphered_block(access, data, ciphered)
+
+    monkeypatch.setattr(
+        alice_workspace.remote_loader, "upload_ciphered_block", _upload_ciphered_block
+    )
+
+    # First copy, all the blocks are uploaded
+    await alice_workspace.write_bytes("/foo", data)
+    await alice_workspace.sync()
+    assert len(uploaded) == 4
+
+    # Second copy, the blocks are reused
+    await alice_workspace.write_bytes("/bar", data)
+    await alice_workspace.sync()
+    assert len(uploaded) == 4
+    foo_manifest = await alice_workspace.local_storage.get_manifest(
+        await alice_workspace.path_id("/foo")
+    )
+    bar_manifest = await alice_workspace.local_storage.get_manifest(
+        await alice_workspace.path_id("/bar")
+    )
+    assert not bar_manifest.need_sync
+    assert bar_manifest.base.blocks == foo_manifest.base.blocks
+
+    # Same content at another offset, the blocks are reused as well
+    await alice_workspace.write_bytes("/baz", data[DEFAULT_BLOCK_SIZE:] + b"!")
+    await alice_workspace.sync()
+    assert len(uploaded) == 5
+    baz_manifest = await alice_workspace.local_storage.get_manifest(
+        await alice_workspace.path_id("/baz")
+    )
+    assert [access.id for access in baz_manifest.base.blocks[:2]] == [
+        access.id for access in foo_manifest.base.blocks[1:3]
+    ]
+    assert baz_manifest.base.blocks[2].id == uploaded[-1]
+
+    # The other users get the content as usual
+    await bob_workspace.sync()
+    assert await bob_workspace.read_bytes("/bar") == data
+    assert await bob_workspace.read_bytes("/baz") == data[DEFAULT_BLOCK_SIZE:] + b"!"
+
+
+@pytest.mark.trio
+async def test_deduplication_disabled(alice_workspace, monkeypatch):
+    data = b"a" * DEFAULT_BLOCK_SIZE
+    await alice_workspace.write_bytes("/foo", data)
+    await alice_workspace.write_bytes("/bar", data)
+    await alice_workspace.sync()
+
+    manifests = [
+        await alice_workspace.local_storage.get_manifest(await alice_workspace.path_id(path))
+        for path in ("/foo", "/bar")
+    ]
+    foo_ids, bar_ids = ([access.id for access in m.base.blocks] for m in manifests)
+    assert len(foo_ids) == len(bar_ids) == 1
+    assert foo_ids != bar_ids
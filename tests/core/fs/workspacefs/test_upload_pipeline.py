@@ -0,0 +1,64 @@
+# Parsec Cloud (https://parsec.cloud) Copyright (c) AGPLv3 2016-2021 Scille SAS
+
+import trio
+import pytest
+
+from parsec.core.types import DEFAULT_BLOCK_SIZE, ChunkID
+from parsec.core.fs.workspacefs.upload_pipeline import AdaptiveConcurrency
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("link_capacity", [1, 3, 8])
+async def test_adaptive_concurrency(autojump_clock, link_capacity):
+    concurrency = AdaptiveConcurrency(max_concurrency=6)
+    max_seen = 0
+
+    # Simulate a link able to upload `link_capacity` blocks per second,
+    # each request taking at least one second
+    async def _upload():
+        nonlocal max_seen
+        async with concurrency.limiter:
+            started_on = concurrency.upload_started()
+            max_seen = max(max_seen, concurrency._uploading)
+            await trio.sleep(max(1, concurrency._uploading / link_capacity))
+            concurrency.upload_finished(DEFAULT_BLOCK_SIZE, started_on)
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(300):
+            nursery.start_soon(_upload)
+    assert max_seen <= 6
+
+    # The concurrency covers the link capacity, plus one to probe for more
+    assert concurrency.min_duration == 1
+    assert concurrency.concurrency == min(link_capacity + 1, 6)
+
+
+@pytest.mark.trio
+async def test_upload_blocks_pipeline(alice_workspace, monkeypatch):
+    data = b"".join(bytes([i]) * DEFAULT_BLOCK_SIZE for i in range(5)) + b"end"
+    await alice_workspace.write_bytes("/foo/bar", data)
+    entry_id = await alice_workspace.path_id("/foo/bar")
+
+    uploaded = []
+    vanilla_upload_ciphered_block = alice_workspace.remote_loader.upload_ciphered_block
+
+    async def _upload_ciphered_block(access, data, ciphered):
+        uploaded.append(access.id)
+        await vanilla_upload_ciphered_block(access, data, ciphered)
+
+    monkeypatch.setattr(
+        alice_workspace.remote_loader, "upload_ciphered_block", _upload_ciphered_block
+    )
+    monkeypatch.setattr(alice_workspace.upload_concurrency, "max_concurrency", 3)
+    await alice_workspace.sync()
+
+    manifest = await alice_workspace.local_storage.get_manifest(entry_id)
+    assert not manifest.need_sync
+    assert sorted(uploaded) == sorted(access.id for access in manifest.base.blocks)
+    assert len(uploaded) == 6
+
+    # The uploaded blocks are now clean and can be downloaded again
+    for access in manifest.base.blocks:
+        assert not await alice_workspace.local_storage.chunk_storage.is_chunk(ChunkID(access.id))
+        await alice_workspace.local_storage.clear_clean_block(access.id)
+    assert await alice_workspace.read_bytes("/foo/bar") == data
@@ -8,8 +8,17 @@ from unittest.mock import ANY
 from parsec.core.backend_connection import BackendConnStatus
 from parsec.backend.backend_events import BackendEvent
 from parsec.core.core_events import CoreEvent
-from parsec.core.types import WorkspaceRole
+from parsec.core.types import EntryID, WorkspaceRole
 from parsec.core.fs.exceptions import FSReadOnlyError
+from parsec.core.sync_monitor import (
+    SyncBudget,
+    SyncContext,
+    SyncDebounce,
+    timestamp,
+    SYNC_PRIORITY_USER_MANIFEST,
+    SYNC_PRIORITY_METADATA,
+    SYNC_PRIORITY_DATA,
+)
 
 from tests.common import create_shared_workspace
 
@@ -436,3 +445,217 @@ async def test_sync_with_concurrent_reencryption(
         info = await workspace.path_info("/test.txt")
         assert not info["need_sync"]
         assert info["base_version"] == 3
+
+
+@pytest.mark.trio
+async def test_sync_budget():
+    budget = SyncBudget(max_concurrency=1)
+    granted = []
+
+    async def _sync(name, priority, task_status=trio.TASK_STATUS_IGNORED):
+        task_status.started()
+        async with budget.acquire(priority):
+            granted.append(name)
+
+    async with trio.open_nursery() as nursery:
+        async with budget.acquire(SYNC_PRIORITY_DATA):
+            for name, priority in [
+                ("data1", SYNC_PRIORITY_DATA),
+                ("metadata", SYNC_PRIORITY_METADATA),
+                ("data2", SYNC_PRIORITY_DATA),
+                ("user manifest", SYNC_PRIORITY_USER_MANIFEST),
+            ]:
+                await nursery.start(_sync, name, priority)
+                await trio.testing.wait_all_tasks_blocked()
+
+            # A cancelled waiter gives up its turn
+            with trio.move_on_after(0.01):
+                await _sync("cancelled", SYNC_PRIORITY_USER_MANIFEST)
+
+    # By order of priority, then by order of arrival
+    assert granted == ["user manifest", "metadata", "data1", "data2"]
+    assert budget.running == 0
+
+
+@pytest.mark.trio
+async def test_local_changes_debounce(autojump_clock):
+    ctx = SyncContext(None, EntryID.new(), debounce=SyncDebounce(1, 60, 2))
+    foo_id = EntryID.new()
+    bar_id = EntryID.new()
+    start = timestamp()
+
+    def _sync(entry_id):
+        ctx._set_local_change_synced(entry_id, ctx._local_changes.pop(entry_id), timestamp())
+
+    # A one-off change is synchronized after the minimal wait
+    ctx.set_local_change(foo_id)
+    assert ctx.due_time == start + 1
+
+    # The entries starting to change in a row are synchronized together
+    autojump_clock.jump(0.5)
+    ctx.set_local_change(bar_id)
+    assert ctx._local_changes[foo_id].due_time == start + 1.5
+    assert ctx._local_changes[bar_id].due_time == start + 1.5
+    autojump_clock.jump(1.5)
+    _sync(foo_id)
+    _sync(bar_id)
+
+    # An entry modified again shortly after its sync waits longer
+    autojump_clock.jump(10)
+    ctx.set_local_change(foo_id)
+    assert ctx._local_changes[foo_id].due_time == start + 14
+
+    # An entry modified continuously is synchronized every `max_wait` seconds
+    for _ in range(100):
+        autojump_clock.jump(1)
+        ctx.set_local_change(foo_id)
+    assert ctx._local_changes[foo_id].due_time == start + 72
+    autojump_clock.jump(1)
+    _sync(foo_id)
+    ctx.set_local_change(foo_id)
+    assert ctx._local_changes[foo_id].due_time == start + 113 + 4
+
+    # Back to the minimal wait once the entry has not been modified for a while
+    _sync(foo_id)
+    assert bar_id not in ctx._synced_local_changes
+    autojump_clock.jump(60)
+    ctx.set_local_change(bar_id)
+    ctx.set_local_change(foo_id)
+    assert ctx._local_changes[foo_id].due_time == start + 174
+    assert ctx._local_changes[bar_id].due_time == start + 174
+
+
+@pytest.mark.trio
+async def test_local_change_during_sync(autojump_clock):
+    class _SyncContext(SyncContext):
+        async def _load_changes(self):
+            return True
+
+        async def _sync(self, entry_id, remote_manifest=None):
+            # The entry is modified again while being synchronized
+            self.set_local_change(entry_id)
+
+    ctx = _SyncContext(None, EntryID.new(), debounce=SyncDebounce(1, 60, 2))
+    foo_id = EntryID.new()
+    start = timestamp()
+
+    ctx.set_local_change(foo_id)
+    autojump_clock.jump(1)
+    await ctx.tick()
+
+    # The new change waits longer, as if it occurred right after the sync
+    assert ctx._local_changes[foo_id].due_time == start + 3
+    assert ctx.due_time == start + 3
+
+
+@pytest.mark.trio
+async def test_autosync_on_continuous_modifications(autojump_clock, running_backend, alice_core):
+    wid = await alice_core.user_fs.workspace_create("w")
+    workspace = alice_core.user_fs.get_workspace(wid)
+    await workspace.touch("/log.txt")
+    log_id = await workspace.path_id("/log.txt")
+    with trio.fail_after(60):  # autojump, so not *really* 60s
+        await alice_core.wait_idle_monitors()
+
+    # A file written every other second (e.g. a log) is not synchronized after each write
+    with alice_core.event_bus.listen() as spy:
+        for i in range(60):
+            await workspace.write_bytes("/log.txt", b"line\n" * i)
+            await trio.sleep(2)
+        with trio.fail_after(60):  # autojump, so not *really* 60s
+            await alice_core.wait_idle_monitors()
+    synced = [
+        event
+        for event in spy.events
+        if event.event == CoreEvent.FS_ENTRY_SYNCED and event.kwargs["id"] == log_id
+    ]
+    assert 2 <= len(synced) <= 4
+    assert not (await workspace.path_info("/log.txt"))["need_sync"]
+
+
+@pytest.mark.trio
+async def test_sync_monitor_concurrent_workspaces(
+    running_backend, alice_core, autojump_clock, monkeypatch
+):
+    wid1 = await alice_core.user_fs.workspace_create("w1")
+    wid2 = await alice_core.user_fs.workspace_create("w2")
+    workspace1 = alice_core.user_fs.get_workspace(wid1)
+    workspace2 = alice_core.user_fs.get_workspace(wid2)
+    await alice_core.wait_idle_monitors()
+
+    # The synchronization of the first workspace takes forever (e.g. a large upload)
+    release_workspace1 = trio.Event()
+    vanilla_sync_by_id = workspace1.sync_by_id
+
+    async def _sync_by_id(*args, **kwargs):
+        await release_workspace1.wait()
+        return await vanilla_sync_by_id(*args, **kwargs)
+
+    monkeypatch.setattr(workspace1, "sync_by_id", _sync_by_id)
+
+    # It doesn't prevent the other workspace from being synchronized
+    with alice_core.event_bus.listen() as spy:
+        await workspace1.write_bytes("/foo.txt", b"foo")
+        await workspace2.mkdir("/bar")
+        bar_id = await workspace2.path_id("/bar")
+        await spy.wait_with_timeout(
+            CoreEvent.FS_ENTRY_SYNCED, {"workspace_id": wid2, "id": bar_id}, timeout=60
+        )
+    assert not alice_core.are_monitors_idle()
+    assert (await workspace1.path_info("/foo.txt"))["need_sync"]
+
+    release_workspace1.set()
+    with trio.fail_after(60):  # autojump, so not *really* 60s
+        await alice_core.wait_idle_monitors()
+    assert not (await workspace1.path_info("/foo.txt"))["need_sync"]
+
+
+@pytest.mark.trio
+async def test_sync_remote_changes_in_batch(
+    autojump_clock, running_backend, alice_core, alice2_user_fs, monkeypatch
+):
+    wid = await alice_core.user_fs.workspace_create("w")
+    alice_w = alice_core.user_fs.get_workspace(wid)
+    for i in range(10):
+        await alice_w.touch(f"/foo{i}.txt")
+    await alice_core.wait_idle_monitors()
+
+    loaded = []
+    batch_loaded = []
+    vanilla_load_manifest = alice_w.remote_loader.load_manifest
+    vanilla_load_manifests = alice_w.remote_loader.load_manifests
+
+    async def _load_manifest(entry_id, *args, **kwargs):
+        loaded.append(entry_id)
+        return await vanilla_load_manifest(entry_id, *args, **kwargs)
+
+    async def _load_manifests(entry_ids, *args, **kwargs):
+        batch_loaded.append(set(entry_ids))
+        return await vanilla_load_manifests(entry_ids, *args, **kwargs)
+
+    monkeypatch.setattr(alice_w.remote_loader, "load_manifest", _load_manifest)
+    monkeypatch.setattr(alice_w.remote_loader, "load_manifests", _load_manifests)
+
+    with running_backend.offline_for(alice_core.device.device_id):
+        # Modify all the files while alice is offline
+        await alice2_user_fs.sync()
+        alice2_w = alice2_user_fs.get_workspace(wid)
+        for i in range(10):
+            await alice2_w.write_bytes(f"/foo{i}.txt", b"v2")
+        await alice2_w.sync()
+        foo_ids = {await alice2_w.path_id(f"/foo{i}.txt") for i in range(10)}
+
+    # Back online, alice downloads all the remote changes in a single batch
+    with alice_core.event_bus.listen() as spy:
+        await spy.wait_multiple_with_timeout(
+            [
+                (CoreEvent.FS_ENTRY_DOWNSYNCED, {"workspace_id": wid, "id": foo_id})
+                for foo_id in foo_ids
+            ],
+            in_order=False,
+            timeout=60,  # autojump, so not *really* 60s
+        )
+    assert batch_loaded == [foo_ids]
+    assert not loaded
+    for i in range(10):
+        assert await alice_w.read_bytes(f"/foo{i}.txt") == b"v2"